@@ -1,11 +1,31 @@
+import logging
 import math
 import random
+import time
+from collections import namedtuple
+from contextlib import contextmanager
 from functools import wraps
 
+import numpy as np
+
 # Note: unable to import Gallery from model specifically because model imports arrange too
 import model
+import spatial
 
 DEFAULT_MARGIN = 2
+# Spatial index used for conflict checks of galleries of more than
+# INDEX_MIN_SIZE pictures. Measured by benchmark.py, smaller galleries are
+# checked faster by scanning every picture than by keeping an index
+DEFAULT_INDEX = 'grid'
+INDEX_MIN_SIZE = 100
+
+# Preferred width to height ratio of a wall, when scoring wall quality
+TARGET_ASPECT = 1.5
+
+# Pictures per cluster when large galleries are arranged hierarchically
+CLUSTER_SIZE = 100
+
+log = logging.getLogger(__name__)
 
 # Decorator for instance methods of workspace
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
@@ -19,63 +39,190 @@ def adjust_for_wall(func):
         # This wrapper does have access to instance
 
         # Calling the arrangement function
-        func(self)
+        with self.phase('arrange'):
+            func(self)
+
+        # Enough to arrange the same pictures the same way again, unless the
+        # arrangement depended on how much time it had, when there is no seed
+        seed = self.seed if self.reproducible else None
+        self.ws.arranged_by = (self.algorithm_type, self.version, seed)
 
         # These calls readjust the workspace to the origin, calculate precise
         # placments for wall hanging, and save other information for display
-        self.realign_to_origin()
-        self.get_wall_size()
-        self.remove_margins()
+        with self.phase('realign_to_origin'):
+            self.realign_to_origin()
+        with self.phase('get_wall_size'):
+            self.get_wall_size()
+        with self.phase('remove_margins'):
+            self.remove_margins()
+
+        if self.trace is not None:
+            log.debug('%s arrangement of %d pictures: %s', self.algorithm_type,
+                      self.ws.len, self.trace.summary())
 
     return wrapper
 
+
+@contextmanager
+def untimed(name):
+    """Stand in for Trace.phase when not tracing."""
+
+    yield
+
+
+class Trace(object):
+    """Counts and phase times of an arrangement, kept when tracing is enabled.
+
+    Enabled by the workspace 'trace' option. The arranger adds to the trace of
+    its workspace as it goes, so after arrangement it holds counts of calls
+    and moves, steps walked by each picture, and seconds spent in each phase.
+    """
+
+    def __init__(self):
+
+        self.counts = dict.fromkeys(['any_conflict', 'blocking_pics',
+                                     'is_conflict', 'walk_steps',
+                                     'pull_in_sweeps', 'pull_in_moves'], 0)
+        self.walk_steps = {}
+        self.phases = {}
+
+    def count(self, name, n=1):
+        """Add to a count."""
+
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def walked(self, pic_id, steps):
+        """Record the steps a picture walked to find its place."""
+
+        self.walk_steps[pic_id] = self.walk_steps.get(pic_id, 0) + steps
+        self.counts['walk_steps'] += steps
+
+    @contextmanager
+    def phase(self, name):
+        """Time the enclosed block, adding to the seconds of the named phase."""
+
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.time() - start
+
+    def summary(self):
+        """Return dictionary of the counts, phase times and most steps walked."""
+
+        summary = dict(self.counts)
+        summary['most_walk_steps'] = max(self.walk_steps.values() + [0])
+        summary['phases'] = dict(self.phases)
+
+        return summary
+
+    def as_dict(self):
+        """Return everything traced as a dictionary, for export."""
+
+        return {
+            'counts': dict(self.counts),
+            'phases': dict(self.phases),
+            'walk_steps': dict(self.walk_steps),
+        }
+
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 class Arranger(object):
-    """Arranges items in a workspace. Base class"""
+    """Arranges items in a workspace. Base class
+
+    All random choices are drawn from the arranger's own generator, and pics
+    are always visited in dimension order, so the same seed on pictures of
+    the same dimensions gives the same arrangement, whatever their ids. Bump
+    an arranger's version whenever a change to it would arrange the same seed
+    differently.
+    """
+
+    algorithm_type = None
+    version = 2
+
+    # How arrangement time scales with the number of pictures n: seconds for
+    # 1000 sample sized pictures, as measured by benchmark.py, and the power
+    # of n it grows with. Also the largest gallery the arranger is
+    # recommended for (None for any), and the algorithm type to use instead
+    # for larger galleries or when it would take too long.
+    seconds_per_1000 = 0.05
+    time_exponent = 1.0
+    max_size = None
+    downgrade = 'skyline'
 
-    def __init__(self, workspace):
+    def __init__(self, workspace, seed=None, deadline=None, refine=True):
 
         self.ws = workspace
 
+        # Tracing is enabled by the workspace, and is None when it is not
+        self.trace = workspace.trace
+
+        if seed is None:
+            seed = new_seed()
+        self.seed = seed
+        self.random = random.Random(seed)
+
+        # Time (from time.time) by which arrangers that can stop early return
+        # the best arrangement they have, None to always run to completion
+        self.deadline = deadline
+
+        # Whether arrangers that can try again do so while time remains, rather
+        # than only stopping early at the deadline
+        self.refine = refine
+
+        # Cleared once the arrangement depends on timing, not only the seed
+        self.reproducible = True
+
         # TODO: Arrangment tracking that is calc'ed once from workspace stuff
-        self.pics_remaining = set(self.ws.pics.keys())
+        self.pic_ids = dimension_order(self.ws.records)
+        self.pics_remaining = set(self.pic_ids)
+        self.remaining_bag = RandomBag(self.pic_ids)
 
-        # TODO: reimplement
         # Because it is common to need the largest, tallest, smallest, etc,
         # prepare these ahead fo time for the workspace
-        self.area_sort = sorted([self.ws.pics[p].id for p in self.ws.pics],
-                                key=lambda x: self.ws.pics[x].a)
-        self.width_sort = sorted([self.ws.pics[p].id for p in self.ws.pics],
-                                 key=lambda x: self.ws.pics[x].w)
-        self.height_sort = sorted([self.ws.pics[p].id for p in self.ws.pics],
-                                  key=lambda x: self.ws.pics[x].h)
+        self.area_sort = sorted(self.pic_ids, key=lambda x: self.ws.pics[x].a)
+        self.width_sort = sorted(self.pic_ids, key=lambda x: self.ws.pics[x].w)
+        self.height_sort = sorted(self.pic_ids, key=lambda x: self.ws.pics[x].h)
+
+        # Selection indexes on the sorts, pictures are dropped as they are used
+        self.by_area = PicSelector(self.area_sort, self.pics_remaining)
+        self.by_width = PicSelector(self.width_sort, self.pics_remaining)
+        self.by_height = PicSelector(self.height_sort, self.pics_remaining)
 
     # Methods to select rough sizes/heights/widths or other elections for use in
     # arrangments
 
+    def use(self, p):
+        """Remove picture from those remaining, returns the picture."""
+
+        self.pics_remaining.remove(p)
+        self.remaining_bag.discard(p)
+
+        for selector in (self.by_area, self.by_width, self.by_height):
+            selector.discard(p)
+
+        return p
+
     def pop_any_n(self, n):
         """ Return any n remaining pictures, removes returned from pictures remaining."""
 
-        ps = random.sample(self.pics_remaining, n)
+        ps = self.random.sample(self.remaining_bag.items, n)
         for p in ps:
-            self.pics_remaining.remove(p)
+            self.use(p)
         return ps
 
     def pop_tallest(self):
         """Return tallest picture reminaing, and remove from list of those remaining."""
 
-        for p in self.height_sort[::-1]:
-            if p in self.pics_remaining:
-                self.pics_remaining.remove(p)
-                return p
+        p = self.by_height.largest()
+        if p is not None:
+            return self.use(p)
 
     def pop_widest(self):
         """Return widest picture reminaing, and remove from list of those remaining."""
 
-        for p in self.width_sort[::-1]:
-            if p in self.pics_remaining:
-                self.pics_remaining.remove(p)
-                return p
+        p = self.by_width.largest()
+        if p is not None:
+            return self.use(p)
 
     def pop_narrow(self):
         """Return a picture from the narrow third of original gallery, or narrowest remaining.
@@ -83,16 +230,13 @@ class Arranger(object):
         Removes returned from pictures remaining.
         """
 
-        narrows = set(self.width_sort[:(self.ws.len / 3)]).intersection(self.pics_remaining)
-        if narrows:
-            p = random.sample(narrows, 1)[0]
-            self.pics_remaining.remove(p)
-            return p
+        if self.by_width.lower_third:
+            p = self.random.choice(self.by_width.lower_third.items)
         else:
-            for p in self.width_sort:
-                if p in self.pics_remaining:
-                    self.pics_remaining.remove(p)
-                    return p
+            p = self.by_width.smallest()
+
+        if p is not None:
+            return self.use(p)
 
     def pop_small(self):
         """Return a picture from the small third of areas in original gallery,
@@ -101,16 +245,13 @@ class Arranger(object):
         Removes returned from pictures remaining.
         """
 
-        smalls = set(self.area_sort[:(self.ws.len / 3)]).intersection(self.pics_remaining)
-        if smalls:
-            p = random.sample(smalls, 1)[0]
-            self.pics_remaining.remove(p)
-            return p
+        if self.by_area.lower_third:
+            p = self.random.choice(self.by_area.lower_third.items)
         else:
-            for p in self.area_sort:
-                if p in self.pics_remaining:
-                    self.pics_remaining.remove(p)
-                    return p
+            p = self.by_area.smallest()
+
+        if p is not None:
+            return self.use(p)
 
     def pop_large(self):
         """Return a picture from the large third of areas in original gallery,
@@ -119,16 +260,13 @@ class Arranger(object):
         Removes returned from pictures remaining.
         """
 
-        larges = set(self.area_sort[-(self.ws.len / 3):]).intersection(self.pics_remaining)
-        if larges:
-            p = random.sample(larges, 1)[0]
-            self.pics_remaining.remove(p)
-            return p
+        if self.by_area.upper_third:
+            p = self.random.choice(self.by_area.upper_third.items)
         else:
-            for p in self.area_sort[::-1]:
-                if p in self.pics_remaining:
-                    self.pics_remaining.remove(p)
-                    return p
+            p = self.by_area.largest()
+
+        if p is not None:
+            return self.use(p)
 
     @property
     def height_tallest(self):
@@ -137,6 +275,34 @@ class Arranger(object):
         return self.height_sort[-1]
 
 
+    @classmethod
+    def estimate_seconds(cls, n):
+        """Return rough seconds to arrange n pictures."""
+
+        return cls.seconds_per_1000 * (n / 1000.0) ** cls.time_exponent
+
+    @classmethod
+    def suits(cls, n, budget=None):
+        """Return true if recommended for n pictures, in budget seconds if given."""
+
+        if cls.max_size is not None and n > cls.max_size:
+            return False
+
+        return budget is None or cls.estimate_seconds(n) <= budget
+
+    def out_of_time(self):
+        """Return true if the arranger has a deadline and it has passed."""
+
+        return self.deadline is not None and time.time() >= self.deadline
+
+    def phase(self, name):
+        """Return context timing a phase of arrangement in the trace, if tracing."""
+
+        if self.trace is None:
+            return untimed(name)
+
+        return self.trace.phase(name)
+
     # Methods used for each arrangement (so far)
     # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -200,27 +366,212 @@ class Arranger(object):
 
         return move
 
+    def slide_in_picture(self, pic_id):
+        """From placed workspace, slide single picture towards center as far as possible.
+
+        On each axis in turn the picture moves by whole steps, until one more
+        would touch another picture ahead of it or take its center further from
+        the origin than it started. Pictures already touching it alongside or
+        behind do not hold it back. Return tuple of steps moved in x and in y.
+        """
+
+        pic = self.ws.pics[pic_id]
+
+        return self.slide_in_x(pic), self.slide_in_y(pic)
+
+    def slide_in_x(self, pic):
+        """Slide a placed picture in x towards center, as slide_in_picture. Return steps."""
+
+        # Towards origin, stopping short of pictures in the way
+        center = (pic.x1 + pic.x2) / 2.0
+        x_steps = int(math.floor(abs(center)))
+        x_inc = -1 if center > 0 else 1
+
+        if x_steps:
+            if x_inc < 0:
+                in_way = self.blocking_pics(pic.x1 - x_steps, pic.x2, pic.y1, pic.y2, pic)
+                gaps = [pic.x1 - b.x2 for b in in_way if b.x2 <= pic.x1]
+            else:
+                in_way = self.blocking_pics(pic.x1, pic.x2 + x_steps, pic.y1, pic.y2, pic)
+                gaps = [b.x1 - pic.x2 for b in in_way if b.x1 >= pic.x2]
+
+            x_steps = min([x_steps] + [steps_before_contact(gap) for gap in gaps])
+            pic.x1 += x_steps * x_inc
+            pic.x2 += x_steps * x_inc
+
+        return x_steps
+
+    def slide_in_y(self, pic):
+        """Slide a placed picture in y towards center, as slide_in_picture. Return steps."""
+
+        center = (pic.y1 + pic.y2) / 2.0
+        y_steps = int(math.floor(abs(center)))
+        y_inc = -1 if center > 0 else 1
+
+        if y_steps:
+            if y_inc < 0:
+                in_way = self.blocking_pics(pic.x1, pic.x2, pic.y1 - y_steps, pic.y2, pic)
+                gaps = [pic.y1 - b.y2 for b in in_way if b.y2 <= pic.y1]
+            else:
+                in_way = self.blocking_pics(pic.x1, pic.x2, pic.y1, pic.y2 + y_steps, pic)
+                gaps = [b.y1 - pic.y2 for b in in_way if b.y1 >= pic.y2]
+
+            y_steps = min([y_steps] + [steps_before_contact(gap) for gap in gaps])
+            pic.y1 += y_steps * y_inc
+            pic.y2 += y_steps * y_inc
+
+        return y_steps
+
+    def conflict_free(self, pic, x1s, y1s):
+        """Check many candidate placements for a picture in one go.
+
+        Candidates are given by upper left corners. Return boolean array, true
+        for each candidate that conflicts with no placed picture other than
+        this one.
+        """
+
+        x1s = np.asarray(x1s, dtype=float)
+        y1s = np.asarray(y1s, dtype=float)
+
+        rects = [(p.x1, p.x2, p.y1, p.y2) for p in self.ws.pics.values()
+                 if (p.x1 is not None) and (p is not pic)]
+        x1_b, x2_b, y1_b, y2_b = zip(*rects) if rects else ([], [], [], [])
+
+        conflicts = batch_conflicts(x1s, x1s + pic.w, y1s, y1s + pic.h,
+                                    x1_b, x2_b, y1_b, y2_b)
+
+        return ~conflicts.any(axis=1)
+
     def any_conflict(self, x1_try, x2_try, y1_try, y2_try, this_pic=None):
         """Check placed pictures, return true if any conflict with this placement."""
 
+        if self.ws.index is not None:
+            # Only pictures near the attempted placement need checking
+            nearby = self.ws.index.query(x1_try, x2_try, y1_try, y2_try)
+        else:
+            nearby = self.ws.pics.values()
+
+        checked = 0
+        conflict = False
+
         # Check each picture in workspace
-        for p in self.ws.pics:
-            pic = self.ws.pics[p]
+        for pic in nearby:
             if (pic.x1 is not None) and (pic is not this_pic):
                 # This picture has been placed, so check for conflict
+                checked += 1
                 if is_conflict(pic.x1, pic.x2, pic.y1, pic.y2,
                                x1_try, x2_try, y1_try, y2_try):
                     # Conflicts with attempted placement, fail fast
+                    conflict = True
+                    break
 
-                    return True
+        if self.trace is not None:
+            self.trace.count('any_conflict')
+            self.trace.count('is_conflict', checked)
 
-        # No conflicts found
-        return False
+        return conflict
+
+    def blocking_pics(self, x1_try, x2_try, y1_try, y2_try, this_pic=None):
+        """Return list of all placed pictures that conflict with this placement."""
+
+        if self.ws.index is not None:
+            nearby = self.ws.index.query(x1_try, x2_try, y1_try, y2_try)
+        else:
+            nearby = self.ws.pics.values()
+
+        # Only placed pictures other than this one are checked
+        placed = [pic for pic in nearby
+                  if (pic.x1 is not None) and (pic is not this_pic)]
+
+        if self.trace is not None:
+            self.trace.count('blocking_pics')
+            self.trace.count('is_conflict', len(placed))
+
+        return [pic for pic in placed
+                if is_conflict(pic.x1, pic.x2, pic.y1, pic.y2,
+                               x1_try, x2_try, y1_try, y2_try)]
+
+
+class RandomBag(object):
+    """Unordered collection of ids with constant time removal and random draws.
+
+    Draw from the list of items, for example rng.choice(bag.items).
+    """
+
+    def __init__(self, ids):
+
+        self.items = list(ids)
+        self.positions = dict((p, i) for i, p in enumerate(self.items))
+
+    def discard(self, p):
+        """Remove id if present, by moving the last item into its place."""
+
+        i = self.positions.pop(p, None)
+        if i is None:
+            return
+
+        last = self.items.pop()
+        if last != p:
+            self.items[i] = last
+            self.positions[last] = i
+
+    def __len__(self):
+        return len(self.items)
+
+
+class PicSelector(object):
+    """Selection index of pic ids presorted ascending by some size.
+
+    The smallest and largest remaining are found by advancing a cursor from
+    either end past ids no longer remaining, so draining them is linear in
+    total. The smallest and largest thirds of the original sort are bags for
+    random draws.
+    """
+
+    def __init__(self, sort, remaining):
+
+        self.sort = sort
+        self.remaining = remaining
+        self.low = 0
+        self.high = len(sort) - 1
+
+        third = len(sort) / 3
+        self.lower_third = RandomBag(sort[:third])
+        self.upper_third = RandomBag(sort[-third:])
+
+    def discard(self, p):
+        """Drop a picture that is no longer remaining from the thirds."""
+
+        self.lower_third.discard(p)
+        self.upper_third.discard(p)
+
+    def smallest(self):
+        """Return smallest remaining id, or None if none remain."""
+
+        while self.low <= self.high and self.sort[self.low] not in self.remaining:
+            self.low += 1
+
+        if self.low <= self.high:
+            return self.sort[self.low]
+
+    def largest(self):
+        """Return largest remaining id, or None if none remain."""
+
+        while self.high >= self.low and self.sort[self.high] not in self.remaining:
+            self.high -= 1
+
+        if self.high >= self.low:
+            return self.sort[self.high]
 
 
 class GalleryFloorArranger(Arranger):
     """Arranges display for galleries, in rows by descending height, aligned bottom."""
 
+    algorithm_type = 'gallery'
+
+    seconds_per_1000 = 0.03
+    max_size = 100
+
     @adjust_for_wall
     def arrange(self):
         """Arranges display for galleries, in rows by descending height, aligned bottom."""
@@ -258,6 +609,11 @@ class GalleryFloorArranger(Arranger):
 class ColumnArranger(Arranger):
     """Arrange in columns by a few rules."""
 
+    algorithm_type = 'column'
+
+    seconds_per_1000 = 0.05
+    max_size = 100
+
     @adjust_for_wall
     def arrange(self):
         """Arrange in columns by a few rules."""
@@ -272,12 +628,12 @@ class ColumnArranger(Arranger):
         i = 0
         while (i < (self.ws.len / 7)) and (len(self.pics_remaining) > 5):
             self.make_nested_column()
-            self.make_stacked_column(random.choice([2, 3]))
+            self.make_stacked_column(self.random.choice([2, 3]))
             i += 1
 
         # Then make stacks as long as possible
         while len(self.pics_remaining) > 2:
-            self.make_stacked_column(random.choice([2, 3]))
+            self.make_stacked_column(self.random.choice([2, 3]))
 
         while len(self.pics_remaining) > 1:
             self.make_stacked_column(2)
@@ -294,7 +650,7 @@ class ColumnArranger(Arranger):
         Currently uses a random order of the generated columns.
         """
 
-        random.shuffle(self.columns)
+        self.random.shuffle(self.columns)
 
         wall_width = 0
         for column in self.columns:
@@ -365,7 +721,7 @@ class ColumnArranger(Arranger):
         self.ws.pics[pair2].x1 = self.ws.pics[pair1].x2 + pair_margin
         self.ws.pics[pair2].x2 = self.ws.pics[pair2].x1 + self.ws.pics[pair2].w
 
-        if random.random() > 0.5:
+        if self.random.random() > 0.5:
             # Place single above
             self.ws.pics[single].y1 = 0
             self.ws.pics[single].y2 = self.ws.pics[single].h
@@ -391,6 +747,11 @@ class ColumnArranger(Arranger):
 class LinearArranger(Arranger):
     """Arrange gallery pictures in horizontal line, vertically centered."""
 
+    algorithm_type = 'linear'
+
+    seconds_per_1000 = 0.03
+    max_size = 50
+
     @adjust_for_wall
     def arrange(self):
 
@@ -406,18 +767,230 @@ class LinearArranger(Arranger):
             row_width = self.ws.pics[p].x2
 
 
+class SkylineArranger(Arranger):
+    """Pack pictures tallest first into a wall of the target aspect, skyline style.
+
+    The wall is filled from the top, keeping its skyline, the lowest edge
+    reached so far at each position across. Each picture goes where its
+    bottom edge will be highest, leftmost of equals, so pictures settle into
+    the lowest gaps. Scales to galleries of thousands of pictures.
+    """
+
+    algorithm_type = 'skyline'
+
+    seconds_per_1000 = 0.035
+    time_exponent = 1.1
+    downgrade = None
+
+    @adjust_for_wall
+    def arrange(self):
+        """Pack pictures in descending height under the skyline."""
+
+        pics = self.ws.pics
+
+        # Width for a wall of the target aspect if fully packed, at least
+        # wide enough for the widest picture
+        area = sum([pic.a for pic in pics.values()])
+        wall_width = max([math.sqrt(area * TARGET_ASPECT)] +
+                         [pic.w for pic in pics.values()])
+
+        # Tallest first, pictures of the same height in random order
+        order = list(self.pic_ids)
+        self.random.shuffle(order)
+        order.sort(key=lambda p: -pics[p].h)
+
+        # Skyline as list of [x, y] of segments left to right, each extending
+        # to the x of the next, and the last to the wall width
+        skyline = [[0, 0]]
+
+        for p in order:
+            pic = pics[p]
+            i, x, y = self.lowest_fit(skyline, pic.w, wall_width)
+
+            pic.x1 = x
+            pic.x2 = x + pic.w
+            pic.y1 = y
+            pic.y2 = y + pic.h
+
+            self.raise_skyline(skyline, i, pic.x1, pic.x2, pic.y2)
+            self.use(p)
+
+    def lowest_fit(self, skyline, width, wall_width):
+        """Return (segment index, x, y) where a picture of the width sits highest.
+
+        A picture placed at the start of a segment rests on the lowest edge
+        of the segments it spans.
+        """
+
+        best = None
+
+        for i, (x, y_start) in enumerate(skyline):
+
+            if x + width > wall_width:
+                break
+
+            y = y_start
+            j = i + 1
+            while j < len(skyline) and skyline[j][0] < x + width:
+                y = max(y, skyline[j][1])
+                j += 1
+
+            if best is None or y < best[2]:
+                best = (i, x, y)
+
+        return best
+
+    def raise_skyline(self, skyline, i, x1, x2, y):
+        """Raise the skyline to y between x1 and x2, x1 being the start of segment i."""
+
+        # Last segment the picture covers part of
+        j = i
+        while j + 1 < len(skyline) and skyline[j + 1][0] < x2:
+            j += 1
+
+        replaced = [[x1, y]]
+
+        # The rest of the last covered segment stays at its height
+        if j + 1 == len(skyline) or skyline[j + 1][0] > x2:
+            replaced.append([x2, skyline[j][1]])
+
+        skyline[i:j + 1] = replaced
+
+        # Merge with neighbouring segments at the same height
+        if i + 1 < len(skyline) and skyline[i + 1][1] == y:
+            del skyline[i + 1]
+        if i > 0 and skyline[i - 1][1] == y:
+            del skyline[i]
+
+
 class GridArranger(Arranger):
 
+    algorithm_type = 'grid'
+
+    # Walking out and pulling in check more pictures as the wall grows
+    seconds_per_1000 = 6.0
+    time_exponent = 1.75
+    max_size = 1000
+
+    def __init__(self, workspace, seed=None, walk='jump', pull_in='slide',
+                 deadline=None, refine=True):
+
+        super(GridArranger, self).__init__(workspace, seed, deadline, refine)
+
+        # How pictures walk out from grid locations to a valid placement:
+        # 'step' moves one unit per conflict check, 'jump' skips past blockers
+        self.walk = walk
+
+        # How placed pictures are brought towards center: 'step' moves each one
+        # unit per sweep, 'slide' moves each as far as it can go at once
+        self.pull_in = pull_in
+        self.pull_in_sweeps = 0
+        self.pull_in_sweeps_saved = 0
+
+        # Arrangements tried, whether the deadline cut the last one short, and
+        # placed_quality of the one kept when there is a deadline
+        self.attempts = 0
+        self.cut_short = False
+        self.best_quality = None
+
+        # Deadline of the arrangement being tried again, if any
+        self.round_deadline = None
+
     @adjust_for_wall
     def arrange(self):
-        """Arrangment via an initial placement in a grid."""
+        """Arrangment via an initial placement in a grid.
+
+        Given a deadline this is an anytime arrangement. Every picture is
+        always placed without conflict, but once the deadline passes
+        pictures not yet walked out are placed quickly to one side, and
+        pulling in stops. Unless told not to refine, while time remains after
+        the first arrangement more are tried from new grid placements, each
+        given as long as the first took, until one scores no better than the
+        best so far.
+        """
+
+        start = time.time()
+        self.arrange_once()
+
+        if self.deadline is None or not self.refine:
+            # Only timing can make this differ from what the seed alone gives
+            self.reproducible = not self.cut_short
+            return
+
+        first = best = (placed_quality(self.ws), self.placements())
+        first_cut_short = self.cut_short
+        share = time.time() - start
+
+        while not self.out_of_time():
+
+            self.round_deadline = time.time() + share
+
+            with self.phase('rearrange'):
+                self.unplace()
+                self.arrange_once()
+
+            self.round_deadline = None
+
+            score = placed_quality(self.ws)
+            if score <= best[0]:
+                break
+
+            best = (score, self.placements())
+
+        self.best_quality, placements = best
+        self.restore(placements)
+
+        # Only a complete first arrangement is the one the seed alone gives
+        self.reproducible = (best is first) and not first_cut_short
+
+    def out_of_time(self):
+        """Return true if the deadline, or that of the current round, has passed."""
+
+        if self.round_deadline is not None and time.time() >= self.round_deadline:
+            return True
+
+        return super(GridArranger, self).out_of_time()
+
+    def arrange_once(self):
+        """Place pictures in a grid, walk them out to places and pull them in."""
+
+        self.attempts += 1
+        self.cut_short = False
+
+        with self.phase('place_in_grid'):
+            pics_in_grid = self.random_place_in_grid()
+            # pics_in_grid = self.large_center_place_in_grid()
+
+        with self.phase('expand_grid'):
+            self.expand_grid_to_arrangment(pics_in_grid)
+
+        with self.phase('pull_in'):
+            self.pull_in_pictures()
 
-        pics_in_grid = self.random_place_in_grid()
-        # pics_in_grid = self.large_center_place_in_grid()
+    def placements(self):
+        """Return dict of coordinates (x1, x2, y1, y2) of each pic by id."""
 
-        self.expand_grid_to_arrangment(pics_in_grid)
+        return dict((p, (pic.x1, pic.x2, pic.y1, pic.y2))
+                    for p, pic in self.ws.pics.items())
 
-        self.pull_in_pictures()
+    def restore(self, placements):
+        """Place pics at coordinates as returned by placements."""
+
+        for p, (x1, x2, y1, y2) in placements.items():
+            pic = self.ws.pics[p]
+            pic.x1 = x1
+            pic.x2 = x2
+            pic.y1 = y1
+            pic.y2 = y2
+
+    def unplace(self):
+        """Take every pic off the workspace, to arrange again."""
+
+        for pic in self.ws.pics.values():
+            pic.x1 = None
+            pic.x2 = None
+            pic.y1 = None
+            pic.y2 = None
 
     def random_place_in_grid(self):
         """Place pics in random grid indicies.
@@ -433,9 +1006,9 @@ class GridArranger(Arranger):
         grid_pairs = [(i, j) for i in range(min_grid, max_grid)
                              for j in range(min_grid, max_grid)]
 
-        grid_sample = random.sample(grid_pairs, self.ws.len)
+        grid_sample = self.random.sample(grid_pairs, self.ws.len)
 
-        grid_pics = {grid_sample[i]:pic for i, pic in enumerate(self.ws.pics.keys())}
+        grid_pics = {grid_sample[i]:pic for i, pic in enumerate(self.pic_ids)}
 
         return grid_pics
 
@@ -453,11 +1026,11 @@ class GridArranger(Arranger):
         grid_pairs = [(i, j) for i in range(min_grid, max_grid)
                              for j in range(min_grid, max_grid)]
 
-        grid_sample = set(random.sample(grid_pairs, self.ws.len))
+        grid_sample = set(self.random.sample(grid_pairs, self.ws.len))
 
-        cols, rows = zip(*grid_sample)
-        mag_sort_j = sorted(set(cols), key=abs)
+        rows, cols = zip(*grid_sample)
         mag_sort_i = sorted(set(rows), key=abs)
+        mag_sort_j = sorted(set(cols), key=abs)
 
         grid_pics = {}
 
@@ -475,9 +1048,10 @@ class GridArranger(Arranger):
 
         (grid = relative psuedo locations without geometry)"""
 
-        cols, rows = zip(*pics_in_grid.keys())
-        mag_sort_j = sorted(set(cols), key=abs)
+        # Keys are (i, j), so every occupied index is visited below
+        rows, cols = zip(*pics_in_grid.keys())
         mag_sort_i = sorted(set(rows), key=abs)
+        mag_sort_j = sorted(set(cols), key=abs)
 
         # Ugh. HTML canvas coordinates:
         #        ^
@@ -486,15 +1060,42 @@ class GridArranger(Arranger):
         #  -i,j  | i,j
         #        v
 
+        # Pictures left to place once out of time
+        unplaced = []
+
         for i in mag_sort_i:
             for j in mag_sort_j:
 
                 pic_id = pics_in_grid.get((i, j), None)
 
                 if pic_id:
-                    # Picture existed at that grid location, place in workspace
-                    self.walk_out_to_place(pic_id, (i, j))
+                    if unplaced or self.out_of_time():
+                        unplaced.append(pic_id)
+                    else:
+                        # Picture existed at that grid location, place in workspace
+                        self.walk_out_to_place(pic_id, (i, j))
+
+        if unplaced:
+            self.cut_short = True
+            self.place_below(unplaced)
+
+    def place_below(self, pic_ids):
+        """Place pictures in a row below all those placed, quickly and without conflict."""
+
+        placed = [pic for pic in self.ws.pics.values() if pic.x1 is not None]
 
+        x = min([pic.x1 for pic in placed] + [0])
+        y = max([pic.y2 for pic in placed] + [-1]) + 1
+
+        for pic_id in pic_ids:
+            pic = self.ws.pics[pic_id]
+            pic.x1 = x
+            pic.x2 = x + pic.w
+            pic.y1 = y
+            pic.y2 = y + pic.h
+
+            # Edges touching count as conflict, so leave a step between
+            x = pic.x2 + 1
 
     def pull_in_pictures(self):
         """From placed workspace, where possible bring pictures towards center.
@@ -502,25 +1103,86 @@ class GridArranger(Arranger):
         Although this code might work on a non-centered arrangmet I suspec the
         results would be gnarly.
         """
+
+        if self.pull_in == 'slide':
+            self.slide_in_pictures()
+            return
+
         moves = 1
         count = 0
 
-        while moves > 0 and count < 500:
+        while moves > 0 and count < 500 and not self.cut_short:
 
             moves = 0
             count += 1
 
-            scrambled_pics = self.ws.pics.keys()
-            random.shuffle(scrambled_pics)
+            scrambled_pics = list(self.pic_ids)
+            self.random.shuffle(scrambled_pics)
 
             # Loop through pictures
             for p in scrambled_pics:
 
+                # Every move leaves a valid arrangement, so can stop anywhere
+                if self.out_of_time():
+                    self.cut_short = True
+                    break
+
                 move = self.pull_in_picture(p)
 
                 if move:
                     moves += 1
 
+            if self.trace is not None:
+                self.trace.count('pull_in_sweeps')
+                self.trace.count('pull_in_moves', moves)
+
+        self.pull_in_sweeps = count
+
+    def slide_in_pictures(self):
+        """From placed workspace, slide pictures towards center until none can move.
+
+        Records the number of sweeps made, and how many fewer that is than the
+        one step per sweep approach would have needed at least.
+        """
+
+        steps_moved = dict((p, [0, 0]) for p in self.ws.pics)
+        moves = 1
+        count = 0
+
+        while moves > 0 and not self.cut_short:
+
+            moves = 0
+            count += 1
+
+            scrambled_pics = list(self.pic_ids)
+            self.random.shuffle(scrambled_pics)
+
+            for p in scrambled_pics:
+
+                # Every slide leaves a valid arrangement, so can stop anywhere
+                if self.out_of_time():
+                    self.cut_short = True
+                    break
+
+                x_steps, y_steps = self.slide_in_picture(p)
+
+                if x_steps or y_steps:
+                    moves += 1
+                    steps_moved[p][0] += x_steps
+                    steps_moved[p][1] += y_steps
+
+            if self.trace is not None:
+                self.trace.count('pull_in_sweeps')
+                self.trace.count('pull_in_moves', moves)
+
+        # Stepping moves a picture at most one step per axis each sweep, and
+        # needs a last sweep to find nothing moves (up to its limit of 500)
+        most_steps = max([max(steps) for steps in steps_moved.values()] + [0])
+        step_sweeps = min(most_steps + 1, 500)
+
+        self.pull_in_sweeps = count
+        self.pull_in_sweeps_saved = max(step_sweeps - count, 0)
+
     def walk_out_to_place(self, pic_id, grid):
         """Given a picture and grid location, return valid workspace of placements.
 
@@ -545,46 +1207,648 @@ class GridArranger(Arranger):
         x_inc = 1 if j > 0 else -1
         y_inc = 1 if i > 0 else -1
 
-        while self.any_conflict(pic.x1, pic.x2, pic.y1, pic.y2, pic):
+        if self.walk == 'jump':
+            steps = self.jump_out_to_place(pic, ratio_i, x_inc, y_inc)
+
+        else:
+            steps = 0
 
-            if random.random() < ratio_i:
-                # Move in y direction
-                pic.y1 += y_inc
-                pic.y2 += y_inc
+            while self.any_conflict(pic.x1, pic.x2, pic.y1, pic.y2, pic):
 
-            else:
-                # Move in x direction
-                pic.x1 += x_inc
-                pic.x2 += x_inc
+                steps += 1
+
+                if self.random.random() < ratio_i:
+                    # Move in y direction
+                    pic.y1 += y_inc
+                    pic.y2 += y_inc
+
+                else:
+                    # Move in x direction
+                    pic.x1 += x_inc
+                    pic.x2 += x_inc
+
+        if self.trace is not None:
+            self.trace.walked(pic_id, steps)
+
+    def jump_out_to_place(self, pic, ratio_i, x_inc, y_inc):
+        """Move a picture out from its grid location until it has no conflict.
+
+        Same walk as one unit step at a time, drawing each step direction the
+        same way, but conflicts are only checked once the picture has cleared
+        every picture that was blocking it. Until then the picture is certain
+        to still be in conflict, so it moves straight to where the unit walk
+        would first find out otherwise. Returns the number of unit steps.
+        """
+
+        steps = 0
+        blocking = self.blocking_pics(pic.x1, pic.x2, pic.y1, pic.y2, pic)
+
+        while blocking:
+
+            # Steps needed in x and in y to clear each blocking picture
+            clear = [(steps_to_clear(pic.x1, pic.x2, b.x1, b.x2, x_inc),
+                      steps_to_clear(pic.y1, pic.y2, b.y1, b.y2, y_inc))
+                     for b in blocking]
+
+            x_steps = 0
+            y_steps = 0
+
+            # A blocker is cleared once either axis no longer overlaps
+            while any([(x_steps < x_clear) and (y_steps < y_clear)
+                       for x_clear, y_clear in clear]):
+                if self.random.random() < ratio_i:
+                    y_steps += 1
+                else:
+                    x_steps += 1
+
+            pic.x1 += x_steps * x_inc
+            pic.x2 += x_steps * x_inc
+            pic.y1 += y_steps * y_inc
+            pic.y2 += y_steps * y_inc
+            steps += x_steps + y_steps
+
+            blocking = self.blocking_pics(pic.x1, pic.x2, pic.y1, pic.y2, pic)
+
+        return steps
+
+
+class WallEditor(Arranger):
+    """Edits an arranged wall one picture at a time, leaving the rest in place.
+
+    Works on a workspace made from the wall's layout with Workspace.from_layout.
+    After adding and removing pictures, finish readjusts the wall as after
+    arrangement. Only pictures that had to move get new placements.
+    """
+
+    def add(self, pic_id):
+        """Place a picture at the free spot nearest the wall center.
+
+        Spots tried are beside each placed picture, one step clear of it and
+        aligned to its edges or center, so there is always one free on the
+        outside of the wall. Spots within the wall are taken first, then
+        those past its right or bottom, which leave the other pictures where
+        they are, and only then those past its left or top.
+        """
+
+        pic = self.ws.pics[pic_id]
+        placed = [p for p in self.ws.pics.values()
+                  if (p.x1 is not None) and (p is not pic)]
+
+        if not placed:
+            x1, y1 = -(pic.w / 2), -(pic.h / 2)
+
+        else:
+            x1s, y1s = candidate_spots(pic, placed)
+            free = self.conflict_free(pic, x1s, y1s)
+
+            # Distance of each spot's center from the wall center, the origin
+            distances = np.hypot(x1s + pic.w / 2.0, y1s + pic.h / 2.0)
+
+            tiers = np.zeros(len(x1s), dtype=int)
+            if self.ws.origin is not None:
+                # The wall is centered on the origin
+                left, top = self.ws.origin
+                past_start = (x1s < left - 1e-9) | (y1s < top - 1e-9)
+                past_end = ((x1s + pic.w > -left + 1e-9) |
+                            (y1s + pic.h > -top + 1e-9))
+                tiers[past_end] = 1
+                tiers[past_start] = 2
+            tiers[~free] = 3
+
+            best = int(np.lexsort((distances, tiers))[0])
+            x1, y1 = float(x1s[best]), float(y1s[best])
+
+        pic.x1 = x1
+        pic.x2 = x1 + pic.w
+        pic.y1 = y1
+        pic.y2 = y1 + pic.h
+
+        return pic_id
+
+    def remove(self, pic_id):
+        """Take a picture off the wall, and slide nearby pictures into the gap.
+
+        Returns set of ids of pictures moved.
+        """
+
+        pic = self.ws.pics.pop(pic_id)
+        self.ws.len -= 1
+
+        freed = (pic.x1, pic.x2, pic.y1, pic.y2)
+
+        pic.x1 = None
+        pic.x2 = None
+        pic.y1 = None
+        pic.y2 = None
+
+        return self.compact(*freed)
+
+    def compact(self, x1, x2, y1, y2):
+        """Slide pictures lined up with a freed rectangle into it, towards the wall center.
+
+        The nearest picture on each side of the gap away from the center may
+        slide across it, sideways if level with it along the top or bottom,
+        up or down if level along the left or right. Pictures level with
+        another across the way they would slide stay put, so rows and columns
+        stay lined up. The space a picture frees is closed in turn by the next
+        one along the same line. Other pictures stay where they are. Returns
+        set of ids moved.
+        """
+
+        moved = set()
+        freed = [(x1, x2, y1, y2)]
+
+        while freed:
+            fx1, fx2, fy1, fy2 = freed.pop(0)
+
+            for pic, slide in self.lined_up(fx1, fx2, fy1, fy2):
+                was = (pic.x1, pic.x2, pic.y1, pic.y2)
+
+                if slide(pic):
+                    moved.add(pic.id)
+                    freed.append(was)
+
+        return moved
+
+    def lined_up(self, x1, x2, y1, y2):
+        """Return list of (pic, slide method) of pictures to slide into a gap.
+
+        For each side of the gap away from the wall center, the nearest
+        picture level with the gap, and the method to slide it across.
+        """
+
+        def level(a, b):
+            return abs(a - b) < 1e-6
+
+        pics = [pic for pic in self.ws.pics.values() if pic.x1 is not None]
+        lined_up = []
+
+        def in_column(pic):
+            return any(level(pic.x1, other.x1) or level(pic.x2, other.x2)
+                       for other in pics if other is not pic)
+
+        def in_row(pic):
+            return any(level(pic.y1, other.y1) or level(pic.y2, other.y2)
+                       for other in pics if other is not pic)
+
+        # Right of the gap and of center, or left of both, sliding sideways
+        beside = [pic for pic in pics
+                  if (level(pic.y1, y1) or level(pic.y2, y2)) and not in_column(pic)]
+        right = [pic for pic in beside if pic.x1 >= x2 and pic.x1 + pic.x2 > 0]
+        left = [pic for pic in beside if pic.x2 <= x1 and pic.x1 + pic.x2 < 0]
+
+        # Below the gap and center, or above both, sliding up or down
+        over = [pic for pic in pics
+                if (level(pic.x1, x1) or level(pic.x2, x2)) and not in_row(pic)]
+        below = [pic for pic in over if pic.y1 >= y2 and pic.y1 + pic.y2 > 0]
+        above = [pic for pic in over if pic.y2 <= y1 and pic.y1 + pic.y2 < 0]
+
+        for side, distance, slide in [
+                (right, lambda pic: pic.x1 - x2, self.slide_in_x),
+                (left, lambda pic: x1 - pic.x2, self.slide_in_x),
+                (below, lambda pic: pic.y1 - y2, self.slide_in_y),
+                (above, lambda pic: y1 - pic.y2, self.slide_in_y)]:
+            if side:
+                lined_up.append((min(side, key=lambda pic: (distance(pic), pic.id)),
+                                 slide))
+
+        return lined_up
+
+    def finish(self):
+        """Readjust the edited wall to the origin and remove margins, as after arrangement.
+
+        The upper left of the wall stays where it was unless a picture now
+        extends past it, so pictures that did not move keep their placements.
+        """
+
+        if not self.ws.pics:
+            self.ws.width = 0
+            self.ws.height = 0
+            return
+
+        pics = self.ws.pics.values()
+        x_origin, y_origin = self.ws.origin or (float('inf'), float('inf'))
+
+        left = min([pic.x1 for pic in pics] + [x_origin])
+        top = min([pic.y1 for pic in pics] + [y_origin])
+
+        for pic in pics:
+            pic.x1 -= left
+            pic.x2 -= left
+            pic.y1 -= top
+            pic.y2 -= top
+
+        self.ws.width = max([pic.x2 for pic in pics])
+        self.ws.height = max([pic.y2 for pic in pics])
+
+        self.remove_margins()
+
+        # Edited walls can no longer be arranged again from a seed
+        self.ws.arranged_by = None
+
+
+# Arranger used for each algorithm type requested, others get DEFAULT_ARRANGER
+ARRANGERS = {
+    'gallery': GalleryFloorArranger,
+    'linear': LinearArranger,
+    'column': ColumnArranger,
+    'grid': GridArranger,
+    'skyline': SkylineArranger,
+}
+
+DEFAULT_ARRANGER = ColumnArranger
+
+
+def get_arranger(algorithm_type):
+    """Return the arranger class for an algorithm type."""
+
+    return ARRANGERS.get(algorithm_type, DEFAULT_ARRANGER)
+
+
+def choose_arranger(algorithm_type, n, budget=None):
+    """Return algorithm type to arrange n pictures with, given the one asked for.
+
+    Arrangers are downgraded in turn while the gallery is larger than
+    recommended, or, given a budget in seconds, arrangement is estimated to
+    take longer.
+
+        >>> choose_arranger('grid', 20)
+        'grid'
+        >>> choose_arranger('grid', 5000)
+        'skyline'
+        >>> choose_arranger('grid', 500, budget=0.5)
+        'skyline'
+        >>> choose_arranger('unknown', 20)
+        'column'
+    """
+
+    arranger = get_arranger(algorithm_type)
+
+    while arranger.downgrade is not None and not arranger.suits(n, budget):
+        arranger = ARRANGERS[arranger.downgrade]
+
+    return arranger.algorithm_type
+
+
+def get_gallery_records(gallery_id):
+    """Return list of PictureRecords for the pictures of a gallery."""
+
+    pictures = model.Gallery.query.get(gallery_id).pictures
+
+    return [PictureRecord(picture.picture_id, picture.width, picture.height)
+            for picture in pictures]
+
+
+def arrange_records(algorithm_type, records, gallery_id=None, options=None,
+                    seed=None, deadline=None, refine=True):
+    """Arrange pictures given as records, return the Layout.
+
+    Needs no database, so may be run in worker processes. Without a seed a
+    new one is drawn, either way it is recorded on the Layout. Arrangers that
+    can stop early return their best arrangement by the deadline, if given,
+    and unless refine is false try to improve on it while time remains.
+    """
+
+    workspace = Workspace.from_records(records, gallery_id, options)
+    get_arranger(algorithm_type)(workspace, seed, deadline=deadline,
+                                 refine=refine).arrange()
+
+    return workspace.get_layout()
+
+
+def arrange_scored_records(algorithm_type, records, gallery_id=None, options=None,
+                           seed=None, deadline=None, refine=True):
+    """Arrange pictures given as records, return tuple of quality score and Layout."""
+
+    workspace = Workspace.from_records(records, gallery_id, options)
+    get_arranger(algorithm_type)(workspace, seed, deadline=deadline,
+                                 refine=refine).arrange()
+
+    return wall_quality(workspace), workspace.get_layout()
+
+
+def arrange_hierarchical(algorithm_type, records, gallery_id=None, options=None,
+                         seed=None, cluster_size=CLUSTER_SIZE):
+    """Arrange a large gallery in clusters, then the clusters as blocks.
+
+    Clusters are arranged one after another here, ArrangementPool arranges
+    them in parallel. Returns the Layout, which has no seed since arranging
+    by the seed alone would not reproduce it.
+    """
+
+    if seed is None:
+        seed = new_seed()
+
+    layouts = [arrange_records(algorithm_type, cluster, None, options, cluster_seed)
+               for cluster, cluster_seed in partition_records(records,
+                                                              cluster_size, seed)]
+
+    return compose_layouts(algorithm_type, layouts, gallery_id, options, seed)
+
+
+def partition_records(records, cluster_size, seed):
+    """Return list of (records, seed) of clusters of at most cluster_size pictures.
+
+    Clusters are balanced in number and in sizes of pictures: pictures are
+    dealt out in dimension order, each cluster taking one of each run of
+    pictures of similar size, in an order drawn from the seed.
+    """
+
+    records = dict((r[0], PictureRecord(*r)) for r in records)
+    order = dimension_order(records.values())
+
+    rng = random.Random(seed)
+    n_clusters = int(math.ceil(len(order) / float(cluster_size)))
+    clusters = [[] for i in range(n_clusters)]
+
+    for start in range(0, len(order), n_clusters):
+        deal = range(n_clusters)
+        rng.shuffle(deal)
+
+        for picture_id, i in zip(order[start:start + n_clusters], deal):
+            clusters[i].append(records[picture_id])
+
+    return [(cluster, rng.randint(0, 2 ** 31 - 1)) for cluster in clusters]
+
+
+def compose_layouts(algorithm_type, layouts, gallery_id=None, options=None,
+                    seed=None):
+    """Arrange arranged layouts as blocks of a wall, return the combined Layout.
+
+    Each layout becomes one block the size of its wall, and blocks are
+    arranged like pictures, with the same margin between them.
+    """
+
+    blocks = [PictureRecord(i + 1, layout.width, layout.height)
+              for i, layout in enumerate(layouts)]
+
+    workspace = Workspace.from_records(blocks, gallery_id, options)
+    arranger = get_arranger(algorithm_type)(workspace, seed)
+    arranger.arrange()
+
+    composed = workspace.get_layout()
+    placements = {}
+
+    for block, layout in zip(blocks, layouts):
+        x, y = composed.placements[block.picture_id]
+
+        for picture_id, (x_in, y_in) in layout.placements.items():
+            placements[picture_id] = (x + x_in, y + y_in)
+
+    return Layout(gallery_id=gallery_id,
+                  width=composed.width,
+                  height=composed.height,
+                  placements=placements,
+                  algorithm_type=arranger.algorithm_type,
+                  algorithm_version=arranger.version,
+                  seed=None)
+
+
+def dimension_order(records):
+    """Return picture ids of records sorted by width, then height, then id.
+
+    Pictures of the same dimensions are interchangeable in an arrangement, so
+    this order pairs up the pictures of any two galleries with the same
+    dimensions.
+    """
+
+    ordered = sorted(records, key=lambda r: (r.width, r.height, r.picture_id))
+
+    return [r.picture_id for r in ordered]
+
+
+def new_seed():
+    """Return a fresh seed for an arrangement, that fits a database integer.
+
+    Drawn from the system source, so worker processes that start with copies of
+    the same random state still draw different seeds.
+    """
+
+    return random.SystemRandom().randint(0, 2 ** 31 - 1)
+
+
+def wall_quality(workspace, target_aspect=TARGET_ASPECT):
+    """Score an arranged workspace from 0 to 1, higher for a better looking wall.
+
+    The product of three measures, each 1 at best:
+    fill, the fraction of the wall's bounding box covered by pictures;
+    aspect, how close the wall's width to height ratio is to the target;
+    balance, how close the area weighted center of the pictures is to the
+    center of the wall, relative to half its diagonal.
+    """
+
+    pics = workspace.pics.values()
+
+    # Coordinates are of the upper left after margins are removed
+    centers = [(pic.x1 + pic.picture.width / 2.0,
+                pic.y1 + pic.picture.height / 2.0) for pic in pics]
+
+    return quality_score(workspace.width, workspace.height, pics, centers,
+                         target_aspect)
+
+
+def placed_quality(workspace, target_aspect=TARGET_ASPECT):
+    """Score pics as placed during arrangement, before adjusting for the wall.
+
+    Same measures as wall_quality, taken over the bounding box of the pics
+    with their margins, so arrangements can be compared as they are made.
+    """
+
+    pics = workspace.pics.values()
+
+    if not pics:
+        return 0.0
+
+    left = min([pic.x1 for pic in pics])
+    top = min([pic.y1 for pic in pics])
+    width = max([pic.x2 for pic in pics]) - left
+    height = max([pic.y2 for pic in pics]) - top
+
+    centers = [((pic.x1 + pic.x2) / 2.0 - left, (pic.y1 + pic.y2) / 2.0 - top)
+               for pic in pics]
+
+    return quality_score(width, height, pics, centers, target_aspect)
+
+
+def quality_score(width, height, pics, centers, target_aspect=TARGET_ASPECT):
+    """Return wall_quality of pics of a wall, given the center of each pic."""
+
+    width = float(width)
+    height = float(height)
+
+    if not (width and height):
+        return 0.0
+
+    areas = [pic.picture.width * pic.picture.height for pic in pics]
+    total_area = sum(areas)
+
+    fill = min(total_area / (width * height), 1.0)
+
+    aspect = width / height
+    aspect = min(aspect, target_aspect) / max(aspect, target_aspect)
+
+    x_center = sum([x * area for (x, y), area in zip(centers, areas)]) / total_area
+    y_center = sum([y * area for (x, y), area in zip(centers, areas)]) / total_area
+    offset = math.hypot(x_center - width / 2.0, y_center - height / 2.0)
+    balance = 1 - min(offset / math.hypot(width / 2.0, height / 2.0), 1.0)
+
+    return fill * aspect * balance
 
 
 class Workspace(object):
     """Class on which arrangments can be performed."""
 
-    def __init__(self, gallery_id):
-        """Constructor from picture list."""
+    def __init__(self, gallery_id, options=None):
+        """Constructor from picture list.
+
+        Options may include a 'margin', an 'index' naming the kind of spatial
+        index used for conflict checks (None checks every picture, by default
+        a grid for large galleries), and
+        'trace' set True to keep a Trace of counts and timings of arrangement.
+        """
+
+        # Only the dimensions are needed, so no ORM objects are kept
+        records = get_gallery_records(gallery_id)
+
+        self.setup(gallery_id, records, options)
+
+    @classmethod
+    def from_records(cls, records, gallery_id=None, options=None):
+        """Constructor from a sequence of (picture_id, width, height) records.
+
+        Needs no database, so arrangement can run anywhere, such as in other
+        processes. Options are as for the usual constructor.
+        """
+
+        workspace = cls.__new__(cls)
+        workspace.setup(gallery_id, [PictureRecord(*r) for r in records], options)
+
+        return workspace
+
+    @classmethod
+    def from_layout(cls, records, layout, options=None):
+        """Constructor from records, with pics placed as in an arranged layout.
+
+        Placements are converted back to arrangement coordinates, with margins
+        and the center of the wall at the origin. Pictures among the records but
+        not in the layout are left unplaced.
+        """
+
+        workspace = cls.from_records(records, layout.gallery_id, options)
+        workspace.origin = (-layout.width / 2.0, -layout.height / 2.0)
+
+        for pic_id, (x, y) in layout.placements.items():
+            pic = workspace.pics[pic_id]
+
+            pic.x1 = x - (pic.w - pic.picture.width) / 2.0 - layout.width / 2.0
+            pic.y1 = y - (pic.h - pic.picture.height) / 2.0 - layout.height / 2.0
+            pic.x2 = pic.x1 + pic.w
+            pic.y2 = pic.y1 + pic.h
 
-        pictures = model.Gallery.query.get(gallery_id).pictures
+        return workspace
 
-        options = {}
+    def setup(self, gallery_id, records, options):
+        """Initialize pics and supporting structures from picture records."""
+
+        options = options or {}
 
         self.gallery_id = gallery_id
         self.margin = options.get('margin', DEFAULT_MARGIN)
-        self.len = len(pictures)
+        self.len = len(records)
 
         # self.options = options
 
         self.pics = {}
 
-        for picture in pictures:
+        # Not arranged yet, then (algorithm_type, version, seed) once arranged
+        self.arranged_by = None
+
+        # Upper left of the wall in arrangement coordinates, when made from
+        # an arranged layout
+        self.origin = None
+
+        self.trace = Trace() if options.get('trace', False) else None
+
+        if 'index' in options:
+            index_type = options['index']
+        elif self.len > INDEX_MIN_SIZE:
+            index_type = DEFAULT_INDEX
+        else:
+            index_type = None
+
+        # Only pics with an index to keep up to date report their moves
+        pic_class = IndexedPic if index_type else Pic
+
+        for picture in records:
+
+            self.pics[picture.picture_id] = pic_class(picture=picture,
+                                                      margin=self.margin)
+
+        if index_type:
+            self.index = spatial.SPATIAL_INDEXES[index_type](self.pics.values())
+        else:
+            self.index = None
+
+    @property
+    def records(self):
+        """List of the (picture_id, width, height) records of the pictures."""
+
+        return [self.pics[p].picture for p in sorted(self.pics)]
+
+    def get_layout(self):
+        """Return the arranged wall as a Layout, detached from the workspace."""
+
+        placements = dict((p, (self.pics[p].x1, self.pics[p].y1)) for p in self.pics)
+        algorithm_type, version, seed = self.arranged_by or (None, None, None)
+
+        return Layout(gallery_id=self.gallery_id,
+                      width=self.width,
+                      height=self.height,
+                      placements=placements,
+                      algorithm_type=algorithm_type,
+                      algorithm_version=version,
+                      seed=seed)
+
+
+class PictureRecord(namedtuple('PictureRecord', 'picture_id width height')):
+    """Dimensions of a picture, all that arrangement needs to know of it."""
+
+    __slots__ = ()
+
+    @property
+    def display_name(self):
+        """Id as a string, as for a Picture without a name."""
+
+        return "Id {:d}".format(self.picture_id)
+
+
+# Placements are {picture_id: (x, y)} of the upper left corner of each picture,
+# and the arranger type, version and seed can arrange them that way again
+Layout = namedtuple('Layout', 'gallery_id width height placements '
+                              'algorithm_type algorithm_version seed')
 
-            self.pics[picture.picture_id] = Pic(picture=picture,
-                                                margin=self.margin)
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 # # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
+class Coordinate(object):
+    """Placement coordinate of an IndexedPic, changes are reported to its index."""
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, pic, owner):
+        if pic is None:
+            return self
+        return pic.__dict__[self.name]
+
+    def __set__(self, pic, value):
+        pic.__dict__[self.name] = value
+        if pic.index is not None:
+            pic.index.mark(pic)
+
+
 class Pic(object):
     """Pics are a data transfer object for placement genertion for pictures.
 
@@ -597,6 +1861,9 @@ class Pic(object):
         self.id = picture.picture_id
         self.picture = picture
 
+        # Spatial index of the workspace, if any, set when the index is built
+        self.index = None
+
         # Note, each side of each picture carries half the margin
         #
         #        w+m
@@ -663,6 +1930,139 @@ class Pic(object):
         self.y2 += - height_padding
 
 
+class IndexedPic(Pic):
+    """Pic of a workspace with a spatial index, which is told when it moves.
+
+    Plain pics keep their coordinates as ordinary attributes, so workspaces
+    without an index pay nothing for keeping one up to date.
+    """
+
+    x1 = Coordinate('x1')
+    x2 = Coordinate('x2')
+    y1 = Coordinate('y1')
+    y2 = Coordinate('y2')
+
+
+def candidate_spots(pic, placed):
+    """Return arrays of upper left x and y of spots for a pic beside placed ones.
+
+    For each placed pic there are spots one step clear of each of its sides,
+    aligned with either end or the middle of that side.
+    """
+
+    x1 = np.array([p.x1 for p in placed], dtype=float)
+    x2 = np.array([p.x2 for p in placed], dtype=float)
+    y1 = np.array([p.y1 for p in placed], dtype=float)
+    y2 = np.array([p.y2 for p in placed], dtype=float)
+
+    left = x1 - pic.w - 1
+    right = x2 + 1
+    above = y1 - pic.h - 1
+    below = y2 + 1
+
+    # Aligned along the side: to its start, to its end, and centered
+    x_along = [x1, x2 - pic.w, (x1 + x2 - pic.w) / 2.0]
+    y_along = [y1, y2 - pic.h, (y1 + y2 - pic.h) / 2.0]
+
+    x1s = ([left] * 3 + [right] * 3 + x_along + x_along)
+    y1s = (y_along + y_along + [above] * 3 + [below] * 3)
+
+    return np.concatenate(x1s), np.concatenate(y1s)
+
+
+def steps_to_clear(lo, hi, lo_block, hi_block, inc):
+    """Number of unit steps moving interval lo-hi by inc to no longer touch block.
+
+        >>> steps_to_clear(0, 4, 2, 6, 1)
+        7
+
+        >>> steps_to_clear(0, 4, 2, 6, -1)
+        3
+
+        >>> steps_to_clear(0.5, 4.5, 2, 6, 1)
+        6
+    """
+
+    if inc > 0:
+        gap = hi_block - lo
+    else:
+        gap = hi - lo_block
+
+    return int(math.floor(gap)) + 1
+
+
+def steps_before_contact(gap):
+    """Number of whole unit steps that can be taken across a gap without touching.
+
+        >>> steps_before_contact(3)
+        2
+
+        >>> steps_before_contact(2.5)
+        2
+
+        >>> steps_before_contact(1)
+        0
+    """
+
+    return max(int(math.ceil(gap)) - 1, 0)
+
+
+def batch_conflicts(x1_a, x2_a, y1_a, y2_a, x1_b, x2_b, y1_b, y2_b):
+    """Check every rectangle of a against every rectangle of b for overlap.
+
+    Coordinates are sequences, one entry per rectangle. Returns a boolean
+    array with a row for each rectangle in a and a column for each in b. Same
+    test as is_conflict: rectangles overlap unless separated along an axis,
+    and touching edges are not a separation. NaN coordinates never conflict.
+
+        >>> def check(*coords):
+        ...     return bool(batch_conflicts(*[[c] for c in coords])[0, 0])
+
+        >>> check(1, 2, 1, 2, 1, 2, 1, 2)
+        True
+
+        >>> check(1, 2, 1, 2, -2, -1, -2, -1)
+        False
+
+        >>> check(1, 10, 1, 10, 2, 4, 2, 4)
+        True
+
+        >>> check(2, 4, 2, 4, 1, 10, 1, 10,)
+        True
+
+        >>> check(1, 10, 1, 10, 2, 4, 6, 11)
+        True
+
+        >>> check(2, 4, 6, 11, 1, 10, 1, 10)
+        True
+
+        >>> check(0, 11, -1, 8, -1, 9, 0, 12)
+        True
+
+        >>> check(0, 8, 2, 6, 2, 6, 1, 7)
+        True
+        >>> check(2, 6, 1, 7, 0, 8, 2, 6)
+        True
+
+    Many candidates against many placed rectangles at once:
+
+        >>> batch_conflicts([0, 10], [4, 14], [0, 0], [4, 4],
+        ...                 [4, 20, 5], [8, 24, 9], [0, 0, 0], [4, 4, 4])
+        array([[ True, False, False],
+               [False, False, False]])
+    """
+
+    x1_a, x2_a, y1_a, y2_a = [np.asarray(c, dtype=float)[:, np.newaxis]
+                              for c in (x1_a, x2_a, y1_a, y2_a)]
+    x1_b, x2_b, y1_b, y2_b = [np.asarray(c, dtype=float)[np.newaxis, :]
+                              for c in (x1_b, x2_b, y1_b, y2_b)]
+
+    # Comparisons with NaN are always false, so those never overlap
+    with np.errstate(invalid='ignore'):
+        return ((x1_a <= x2_b) & (x1_b <= x2_a) &
+                (y1_a <= y2_b) & (y1_b <= y2_a))
+
+
 def is_conflict(x1_a, x2_a, y1_a, y2_a, x1_b, x2_b, y1_b, y2_b):
     """Check if the rectangles a and b described by the input coordinates overlap.
 
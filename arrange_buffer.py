@@ -0,0 +1,197 @@
+"""Buffers of layouts arranged ahead of time, so a request can take one at once.
+
+Each buffer is for one kind of request, such as a gallery arranged by one
+algorithm, and is filled by calling a producer given with the request. Taking
+a layout starts a background refill, so the next request finds one ready too.
+Buffers not used for a while are dropped, so only recently viewed galleries
+keep layouts ready. Buffers may also be discarded when what their layouts were
+arranged from changes, along with refills in progress for them.
+"""
+
+import threading
+import time
+from collections import deque
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+class LayoutBuffer(object):
+    """Buffers of ready layouts by key, refilled by a few background threads."""
+
+    def __init__(self, depth=2, refill_workers=2, idle_timeout=600.0):
+
+        self.depth = depth
+        self.refill_workers = refill_workers
+        self.idle_timeout = idle_timeout
+
+        # Threads are started on first use, not when the server is imported
+        self.executor = None
+
+        self.lock = threading.Lock()
+
+        # By key: deque of layouts, producer, refills in progress, last use
+        self.layouts = {}
+        self.producers = {}
+        self.refilling = {}
+        self.last_used = {}
+
+        # By key: times discarded, so refills started before are not kept
+        self.generations = {}
+
+        self.counts = {
+            'hits': 0,
+            'misses': 0,
+            'refills': 0,
+            'discarded': 0,
+            'errors': 0,
+            'evictions': 0,
+            'cleared': 0,
+        }
+
+    def pop(self, key, produce):
+        """Return a ready layout for key, or None if none ready.
+
+        Either way the buffer is refilled in the background by calling produce,
+        which takes no arguments and returns a layout, or None if it could not
+        make a layout worth keeping. It is called in other threads, so it
+        should not use the database session.
+        """
+
+        with self.lock:
+            self.producers[key] = produce
+            self.last_used[key] = time.time()
+
+            ready = self.layouts.setdefault(key, deque())
+            layout = ready.popleft() if ready else None
+
+            if layout is None:
+                self.counts['misses'] += 1
+            else:
+                self.counts['hits'] += 1
+
+        self.evict_idle()
+        self.refill(key)
+
+        return layout
+
+    def warm(self, key, produce):
+        """Start filling the buffer for key, ahead of the first request."""
+
+        with self.lock:
+            self.producers[key] = produce
+            self.last_used[key] = time.time()
+            self.layouts.setdefault(key, deque())
+
+        self.evict_idle()
+        self.refill(key)
+
+    def refill(self, key):
+        """Start enough background refills to bring the buffer up to depth."""
+
+        with self.lock:
+            if key not in self.producers:
+                return
+
+            needed = (self.depth - len(self.layouts[key])
+                      - self.refilling.get(key, 0))
+
+            if needed <= 0:
+                return
+
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.refill_workers)
+
+            self.refilling[key] = self.refilling.get(key, 0) + needed
+            produce = self.producers[key]
+            generation = self.generations.get(key, 0)
+
+        for i in range(needed):
+            self.executor.submit(self.produce_into, key, produce, generation)
+
+    def produce_into(self, key, produce, generation=0):
+        """Call a producer and add its layout to the buffer, run in background."""
+
+        failed = False
+
+        try:
+            layout = produce()
+
+        except Exception:
+            layout = None
+            failed = True
+
+        with self.lock:
+            # Arranged from what has since changed
+            if self.generations.get(key, 0) != generation:
+                return
+
+            self.refilling[key] = self.refilling.get(key, 1) - 1
+
+            if failed:
+                self.counts['errors'] += 1
+
+            elif layout is None:
+                self.counts['discarded'] += 1
+
+            # Kept unless the buffer was evicted or filled meanwhile
+            elif key in self.layouts and len(self.layouts[key]) < self.depth:
+                self.layouts[key].append(layout)
+                self.counts['refills'] += 1
+
+            if not self.refilling[key]:
+                del self.refilling[key]
+
+    def evict_idle(self):
+        """Drop the buffers of keys not used within the idle timeout."""
+
+        cutoff = time.time() - self.idle_timeout
+
+        with self.lock:
+            for key, used in self.last_used.items():
+                if used < cutoff:
+                    del self.last_used[key]
+                    del self.producers[key]
+                    del self.layouts[key]
+                    self.counts['evictions'] += 1
+
+    def discard(self, match):
+        """Drop the buffers of keys for which match(key) is true.
+
+        For when what their layouts were arranged from has changed, such as
+        the pictures of a gallery. Layouts being refilled for them are dropped
+        when they finish.
+        """
+
+        with self.lock:
+            for key in set(self.layouts) | set(self.refilling):
+                if not match(key):
+                    continue
+
+                self.generations[key] = self.generations.get(key, 0) + 1
+                self.refilling.pop(key, None)
+
+                if key in self.layouts:
+                    del self.layouts[key]
+                    del self.producers[key]
+                    del self.last_used[key]
+                    self.counts['cleared'] += 1
+
+    def stats(self):
+        """Return dictionary of counts, including layouts ready and buffers kept."""
+
+        with self.lock:
+            stats = dict(self.counts)
+            stats['buffers'] = len(self.layouts)
+            stats['ready'] = sum([len(ready) for ready in self.layouts.values()])
+            stats['refilling'] = sum(self.refilling.values())
+
+        stats['depth'] = self.depth
+
+        return stats
+
+    def shutdown(self):
+        """Stop the refill threads, waiting for refills in progress."""
+
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
@@ -0,0 +1,247 @@
+"""Cache of arrangement results, shared by galleries with the same dimensions.
+
+An arranger given the same seed arranges pictures of the same dimensions the
+same way, whatever their ids. So results are keyed by a fingerprint of the
+sorted picture dimensions, the margin, the arranger and its version, and the
+seed, and stored as positions in dimension order. A hit is remapped onto the
+ids of the gallery asked for.
+
+Entries live in an in-process LRU, and optionally in a directory shared by
+processes on the same machine. Both tiers drop entries older than the maximum
+age, and keep to a maximum number of entries.
+"""
+
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+import arrange as ar
+
+
+# Positions are (x, y) in the dimension order of the pictures
+CachedArrangement = namedtuple('CachedArrangement', 'width height positions score')
+
+
+class ArrangementCache(object):
+    """LRU of arrangement results with an optional on-disk tier."""
+
+    def __init__(self, max_entries=1024, max_age=3600.0, directory=None,
+                 max_disk_entries=10000):
+
+        self.max_entries = max_entries
+        self.max_age = max_age
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+
+        if directory is not None and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stores_since_prune = 0
+
+        self.counts = {
+            'hits': 0,
+            'disk_hits': 0,
+            'misses': 0,
+            'stores': 0,
+            'evictions': 0,
+            'expirations': 0,
+        }
+
+    def get(self, algorithm_type, records, gallery_id=None, options=None,
+            seed=None):
+        """Return tuple of score and Layout for the records if cached, else None."""
+
+        if seed is None:
+            return None
+
+        records = [ar.PictureRecord(*r) for r in records]
+        key = fingerprint(algorithm_type, records, options, seed)
+
+        cached = self.get_memory(key)
+        if cached is None:
+            cached = self.get_disk(key)
+
+        if cached is None:
+            with self.lock:
+                self.counts['misses'] += 1
+            return None
+
+        arranger = ar.get_arranger(algorithm_type)
+        placements = dict(zip(ar.dimension_order(records), cached.positions))
+
+        layout = ar.Layout(gallery_id=gallery_id,
+                           width=cached.width,
+                           height=cached.height,
+                           placements=placements,
+                           algorithm_type=arranger.algorithm_type,
+                           algorithm_version=arranger.version,
+                           seed=seed)
+
+        return cached.score, layout
+
+    def put(self, layout, records, options=None, score=None):
+        """Store an arranged layout of the records, with its quality score."""
+
+        if layout.seed is None:
+            return
+
+        records = [ar.PictureRecord(*r) for r in records]
+        key = fingerprint(layout.algorithm_type, records, options, layout.seed)
+
+        positions = [layout.placements[p] for p in ar.dimension_order(records)]
+        cached = CachedArrangement(layout.width, layout.height, positions, score)
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time(), cached)
+            self.counts['stores'] += 1
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counts['evictions'] += 1
+
+        if self.directory is not None:
+            self.put_disk(key, cached)
+
+    def get_memory(self, key):
+        """Return cached arrangement from memory, marking it recently used."""
+
+        with self.lock:
+            entry = self.entries.pop(key, None)
+
+            if entry is None:
+                return None
+
+            stored, cached = entry
+
+            if time.time() - stored > self.max_age:
+                self.counts['expirations'] += 1
+                return None
+
+            self.entries[key] = entry
+            self.counts['hits'] += 1
+
+        return cached
+
+    def get_disk(self, key):
+        """Return cached arrangement from disk, copying it into memory."""
+
+        if self.directory is None:
+            return None
+
+        path = os.path.join(self.directory, key)
+
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                os.remove(path)
+                with self.lock:
+                    self.counts['expirations'] += 1
+                return None
+
+            with open(path, 'rb') as cache_file:
+                cached = pickle.load(cache_file)
+
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            # Missing, or removed or being replaced by another process
+            return None
+
+        with self.lock:
+            self.entries[key] = (time.time(), cached)
+            self.counts['disk_hits'] += 1
+
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.counts['evictions'] += 1
+
+        return cached
+
+    def put_disk(self, key, cached):
+        """Write cached arrangement to disk, replacing any other atomically."""
+
+        handle, temp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+
+        with os.fdopen(handle, 'wb') as cache_file:
+            pickle.dump(cached, cache_file, 2)
+
+        os.rename(temp_path, os.path.join(self.directory, key))
+
+        with self.lock:
+            self.stores_since_prune += 1
+            prune = self.stores_since_prune >= max(self.max_disk_entries / 10, 1)
+            if prune:
+                self.stores_since_prune = 0
+
+        if prune:
+            self.prune_disk()
+
+    def prune_disk(self):
+        """Remove expired files, then the oldest while there are too many."""
+
+        now = time.time()
+        files = []
+
+        for name in os.listdir(self.directory):
+            if name.startswith('.tmp'):
+                continue
+
+            path = os.path.join(self.directory, name)
+            try:
+                files.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+
+        files.sort()
+        excess = len(files) - self.max_disk_entries
+
+        for i, (modified, path) in enumerate(files):
+            if i >= excess and now - modified <= self.max_age:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+            with self.lock:
+                self.counts['evictions'] += 1
+
+    def stats(self):
+        """Return dictionary of counts, including current entries in memory."""
+
+        with self.lock:
+            stats = dict(self.counts)
+            stats['entries'] = len(self.entries)
+
+        return stats
+
+    def clear(self):
+        """Remove all entries from memory and disk."""
+
+        with self.lock:
+            self.entries.clear()
+
+        if self.directory is not None:
+            for name in os.listdir(self.directory):
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+
+
+def fingerprint(algorithm_type, records, options=None, seed=None):
+    """Return cache key for arranging records of these dimensions."""
+
+    options = options or {}
+    arranger = ar.get_arranger(algorithm_type)
+    margin = options.get('margin', ar.DEFAULT_MARGIN)
+
+    dimensions = sorted((float(r.width), float(r.height)) for r in records)
+
+    parts = (arranger.algorithm_type, arranger.version, margin, seed, dimensions)
+
+    return hashlib.sha1(repr(parts)).hexdigest()
@@ -0,0 +1,405 @@
+"""Runs arrangements in a bounded pool of worker processes, with a time limit.
+
+A slow arrangement then cannot hold up the web worker that asked for it. When
+an arrangement takes longer than the timeout it is cancelled if it has not yet
+started, and the request gets a layout from a fast fallback arranger instead.
+An arrangement already running is left to finish in its worker and its result
+is discarded, the pool size bounds how many of those there can be.
+
+Large galleries may be arranged hierarchically, their clusters spread across
+the workers.
+
+Every arrangement is given a deadline, by the timeout from when it was asked
+for or any earlier deadline of the request, so arrangers that can stop early
+return their best so far by then rather than keep a worker busy after the
+request has stopped waiting. The request waits no longer than the deadline
+plus a short grace for the result to come back. Arrangers use time left over
+to try for a better arrangement only when the request gave a deadline.
+
+An arrangement that fails in its worker is logged and counted, and treated
+like one out of time.
+"""
+
+import logging
+import math
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError, wait
+
+import arrange as ar
+
+
+log = logging.getLogger(__name__)
+
+
+class ArrangementPool(object):
+    """Pool of worker processes for arrangement, with counts for monitoring."""
+
+    def __init__(self, workers=2, timeout=5.0, fallback='linear', cache=None,
+                 grace=0.25):
+
+        self.workers = workers
+        self.timeout = timeout
+        self.fallback = fallback
+
+        # Seconds past a deadline to wait for an arrangement to be returned
+        self.grace = grace
+
+        # Optional ArrangementCache, consulted for arrangements given a seed
+        self.cache = cache
+
+        # Processes are started on first use, not when the server is imported
+        self.executor = None
+
+        self.lock = threading.Lock()
+        self.counts = {
+            'queued': 0,
+            'submitted': 0,
+            'completed': 0,
+            'timeouts': 0,
+            'cancelled': 0,
+            'fallbacks': 0,
+            'errors': 0,
+        }
+
+    def submit(self, job, *args):
+        """Start a job in the pool, return its future."""
+
+        with self.lock:
+            if self.executor is None:
+                self.executor = ProcessPoolExecutor(max_workers=self.workers)
+            self.counts['queued'] += 1
+            self.counts['submitted'] += 1
+
+        future = self.executor.submit(job, *args)
+        future.add_done_callback(self.finished)
+
+        return future
+
+    def finished(self, future):
+        """Callback when a job completes or is cancelled."""
+
+        with self.lock:
+            self.counts['queued'] -= 1
+            if future.cancelled():
+                self.counts['cancelled'] += 1
+            else:
+                self.counts['completed'] += 1
+
+    def failed(self, algorithm_type, gallery_id):
+        """Log and count an arrangement that raised in its worker."""
+
+        log.exception('Could not arrange gallery %s by %s in the pool',
+                      gallery_id, algorithm_type)
+
+        with self.lock:
+            self.counts['errors'] += 1
+
+    def job_deadline(self, deadline=None):
+        """Return deadline for a job, the timeout from now unless given one sooner.
+
+        Short of the timeout by the grace, so a result made by then still comes
+        back in time.
+        """
+
+        timeout_deadline = time.time() + max(self.timeout - self.grace, 0)
+
+        if deadline is None:
+            return timeout_deadline
+
+        return min(deadline, timeout_deadline)
+
+    def wait_time(self, deadline=None):
+        """Return seconds to wait for a result, within the deadline if any."""
+
+        if deadline is None:
+            return self.timeout
+
+        return min(self.timeout, max(deadline - time.time(), 0) + self.grace)
+
+    def share_deadline(self, n, deadline=None):
+        """Return list of deadlines for n jobs run a pool's worth at a time.
+
+        The time left before the deadline is split evenly between the turns,
+        so jobs of later turns are not left without time by those before.
+        """
+
+        if deadline is None:
+            return [None] * n
+
+        now = time.time()
+        turns = max(int(math.ceil(n / float(self.workers))), 1)
+        share = max(deadline - now, 0) / turns
+
+        return [now + (k // self.workers + 1) * share for k in range(n)]
+
+    def arrange(self, algorithm_type, records, gallery_id=None, options=None,
+                seed=None, deadline=None):
+        """Return Layout arranged in the pool, or by the fallback if out of time.
+
+        Given a seed, a cached arrangement is returned if there is one.
+        """
+
+        if seed is not None:
+            cached = self.get_cached(algorithm_type, records, gallery_id,
+                                     options, seed)
+            if cached is not None:
+                return cached[1]
+        else:
+            seed = ar.new_seed()
+
+        job_deadline = self.job_deadline(deadline)
+
+        future = self.submit(ar.arrange_scored_records, algorithm_type, records,
+                             gallery_id, options, seed, job_deadline,
+                             deadline is not None)
+
+        try:
+            score, layout = future.result(timeout=self.wait_time(job_deadline))
+
+        except TimeoutError:
+            future.cancel()
+
+            with self.lock:
+                self.counts['timeouts'] += 1
+
+            return self.arrange_fallback(records, gallery_id, options)
+
+        except Exception:
+            self.failed(algorithm_type, gallery_id)
+
+            return self.arrange_fallback(records, gallery_id, options)
+
+        self.put_cached(layout, records, options, score)
+
+        return layout
+
+    def arrange_best(self, algorithm_type, records, candidates, gallery_id=None,
+                     options=None, seeds=None, deadline=None):
+        """Return best scoring Layout of several arranged in parallel in the pool.
+
+        Candidates not finished within the timeout, or that fail, are
+        cancelled or discarded, and if none finish the fallback arranger is
+        used. Given seeds, one candidate is arranged for each, using cached
+        arrangements if there are.
+        """
+
+        scored = []
+        futures = []
+
+        job_deadline = self.job_deadline(deadline)
+        refine = deadline is not None
+
+        if seeds is None:
+            seeds = [ar.new_seed() for i in range(candidates)]
+
+            futures = [self.submit(ar.arrange_scored_records, algorithm_type,
+                                   records, gallery_id, options, seed,
+                                   job_deadline, refine)
+                       for seed in seeds]
+
+        else:
+            for seed in seeds:
+                cached = self.get_cached(algorithm_type, records, gallery_id,
+                                         options, seed)
+                if cached is not None:
+                    scored.append(cached)
+                else:
+                    futures.append(self.submit(ar.arrange_scored_records,
+                                               algorithm_type, records,
+                                               gallery_id, options, seed,
+                                               job_deadline, refine))
+
+        if futures:
+            done, not_done = wait(futures, timeout=self.wait_time(job_deadline))
+
+            for future in not_done:
+                future.cancel()
+
+            if not_done:
+                with self.lock:
+                    self.counts['timeouts'] += 1
+
+            for future in done:
+                try:
+                    score, layout = future.result()
+                except Exception:
+                    self.failed(algorithm_type, gallery_id)
+                    continue
+
+                self.put_cached(layout, records, options, score)
+                scored.append((score, layout))
+
+        if not scored:
+            return self.arrange_fallback(records, gallery_id, options)
+
+        score, layout = max(scored, key=lambda result: result[0])
+
+        return layout
+
+    def arrange_hierarchical(self, algorithm_type, records, gallery_id=None,
+                             options=None, seed=None, cluster_size=ar.CLUSTER_SIZE,
+                             deadline=None):
+        """Return Layout of a large gallery arranged in clusters across the pool.
+
+        Each cluster is arranged in a worker, using cached arrangements if
+        there are, and the clusters are composed here. If any cluster is not
+        finished within the timeout, or it or the composition fails, the
+        fallback arranger is used instead.
+
+        Clusters are arranged a pool's worth at a time, so given a deadline
+        each cluster gets its own share of the time left, in turn.
+        """
+
+        if seed is None:
+            seed = ar.new_seed()
+
+        clusters = ar.partition_records(records, cluster_size, seed)
+        layouts = [None] * len(clusters)
+        futures = {}
+
+        uncached = []
+        for i, (cluster, cluster_seed) in enumerate(clusters):
+            cached = self.get_cached(algorithm_type, cluster, None, options,
+                                     cluster_seed)
+            if cached is not None:
+                layouts[i] = cached[1]
+            else:
+                uncached.append(i)
+
+        job_deadline = self.job_deadline(deadline)
+        deadlines = self.share_deadline(len(uncached), job_deadline)
+
+        for i, cluster_deadline in zip(uncached, deadlines):
+            cluster, cluster_seed = clusters[i]
+            futures[self.submit(ar.arrange_scored_records, algorithm_type,
+                                cluster, None, options, cluster_seed,
+                                cluster_deadline, deadline is not None)] = i
+
+        if futures:
+            done, not_done = wait(futures, timeout=self.wait_time(job_deadline))
+
+            if not_done:
+                for future in not_done:
+                    future.cancel()
+
+                with self.lock:
+                    self.counts['timeouts'] += 1
+
+                return self.arrange_fallback(records, gallery_id, options)
+
+            for future in done:
+                cluster = clusters[futures[future]][0]
+
+                try:
+                    score, layout = future.result()
+                except Exception:
+                    self.failed(algorithm_type, gallery_id)
+                    return self.arrange_fallback(records, gallery_id, options)
+
+                self.put_cached(layout, cluster, options, score)
+                layouts[futures[future]] = layout
+
+        try:
+            return ar.compose_layouts(algorithm_type, layouts, gallery_id,
+                                      options, seed)
+        except Exception:
+            self.failed(algorithm_type, gallery_id)
+            return self.arrange_fallback(records, gallery_id, options)
+
+    def arrange_many(self, algorithm_type, jobs, options=None, fallback=True):
+        """Return list of Layouts of many galleries, arranged in parallel in the pool.
+
+        Jobs are (records, gallery_id) pairs. Those not finished within the
+        timeout, or that fail, are arranged by the fallback arranger instead,
+        or are None if fallback is false.
+        """
+
+        job_deadline = self.job_deadline()
+
+        futures = [self.submit(ar.arrange_scored_records, algorithm_type, records,
+                               gallery_id, options, None, job_deadline, False)
+                   for records, gallery_id in jobs]
+
+        done, not_done = wait(futures, timeout=self.wait_time(job_deadline))
+
+        if not_done:
+            with self.lock:
+                self.counts['timeouts'] += 1
+
+        layouts = []
+
+        for future, (records, gallery_id) in zip(futures, jobs):
+            layout = None
+
+            if future in done:
+                try:
+                    score, layout = future.result()
+                except Exception:
+                    self.failed(algorithm_type, gallery_id)
+                else:
+                    self.put_cached(layout, records, options, score)
+            else:
+                future.cancel()
+
+            if layout is None and fallback:
+                layout = self.arrange_fallback(records, gallery_id, options)
+
+            layouts.append(layout)
+
+        return layouts
+
+    def arrange_fallback(self, records, gallery_id=None, options=None):
+        """Return Layout from the fast fallback arranger, run right here."""
+
+        with self.lock:
+            self.counts['fallbacks'] += 1
+
+        score, layout = ar.arrange_scored_records(self.fallback, records,
+                                                  gallery_id, options)
+        self.put_cached(layout, records, options, score)
+
+        return layout
+
+    def get_cached(self, algorithm_type, records, gallery_id, options, seed):
+        """Return tuple of score and Layout from the cache, None if not there."""
+
+        if self.cache is None:
+            return None
+
+        cached = self.cache.get(algorithm_type, records, gallery_id, options, seed)
+
+        # Only scored arrangements can be compared with other candidates
+        if cached is None or cached[0] is None:
+            return None
+
+        return cached
+
+    def put_cached(self, layout, records, options, score):
+        """Store a finished arrangement in the cache, if there is one."""
+
+        if self.cache is not None:
+            self.cache.put(layout, records, options, score)
+
+    def stats(self):
+        """Return dictionary of counts, including current queue depth."""
+
+        with self.lock:
+            stats = dict(self.counts)
+
+        stats['workers'] = self.workers
+        stats['timeout'] = self.timeout
+
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+
+        return stats
+
+    def shutdown(self):
+        """Stop the worker processes, waiting for running jobs."""
+
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
@@ -0,0 +1,225 @@
+"""Benchmark the arrangers on synthetic galleries of increasing size.
+
+Picture sizes are drawn from those of the sample pictures, so galleries look
+like ones users make. Each arrangement runs in a fresh process so its peak
+memory can be measured, and no database is needed. Counts and phase times
+come from the arrangement trace.
+
+Results are written as JSON, one entry per arranger, size and repeat, with the
+wall time, peak memory, conflict checks and walk steps. Cases over the size
+limit of an arranger are listed as skipped. Given a baseline from an earlier
+run, cases that got slower than the allowed ratio are reported and the exit
+status is 1.
+
+    python benchmark.py --output results.json
+    python benchmark.py --sizes 10 100 --compare results.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import platform
+import random
+import resource
+import sys
+import time
+
+import arrange as ar
+
+SIZES = [10, 100, 1000, 10000]
+ARRANGERS = ['gallery', 'column', 'linear', 'grid', 'skyline']
+SIZE_SOURCE = "seed/seed_pictures.txt"
+
+# Largest gallery each arranger is run on unless limits are turned off, grid
+# arrangement grows much faster than linear in the number of pictures
+MAX_SIZES = {'grid': 2500}
+
+# Allowed slowdown against a baseline before a case counts as a regression
+REGRESSION_RATIO = 1.25
+
+
+def load_sizes(seed_file_path=SIZE_SOURCE):
+    """Return list of (width, height) of the sample pictures.
+
+    Data file is pipe seperated, as for seeding the database:
+    picture_id | user_id | width | height | ...
+    """
+
+    sizes = []
+
+    with open(seed_file_path) as seed_file:
+        for line in seed_file:
+            fields = line.split("|")
+            sizes.append((float(fields[2]), float(fields[3])))
+
+    return sizes
+
+
+def make_records(n, sizes, seed):
+    """Return n PictureRecords with sizes drawn from those given."""
+
+    rng = random.Random(seed)
+
+    return [ar.PictureRecord(picture_id, *rng.choice(sizes))
+            for picture_id in range(1, n + 1)]
+
+
+def run_case(case):
+    """Arrange one synthetic gallery, return dictionary of measurements.
+
+    Run in its own process, so the peak memory is of this case alone.
+    """
+
+    algorithm_type, n, repeat, seed, sizes, options = case
+
+    records = make_records(n, sizes, seed)
+    baseline_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    options = dict(options or {}, trace=True)
+
+    start = time.time()
+
+    workspace = ar.Workspace.from_records(records, options=options)
+    ar.get_arranger(algorithm_type)(workspace, seed).arrange()
+
+    wall_time = time.time() - start
+    peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    trace = workspace.trace.summary()
+
+    return {
+        'arranger': algorithm_type,
+        'size': n,
+        'repeat': repeat,
+        'seed': seed,
+        'wall_time': wall_time,
+        'peak_memory_kb': peak_kb,
+        'added_memory_kb': peak_kb - baseline_kb,
+        'conflict_checks': trace['any_conflict'] + trace['blocking_pics'],
+        'is_conflict': trace['is_conflict'],
+        'walk_steps': trace['walk_steps'],
+        'most_walk_steps': trace['most_walk_steps'],
+        'pull_in_sweeps': trace['pull_in_sweeps'],
+        'phases': trace['phases'],
+        'wall_width': workspace.width,
+        'wall_height': workspace.height,
+        'quality': ar.wall_quality(workspace),
+    }
+
+
+def run_benchmark(arrangers, sizes, repeats=1, seed=0, options=None,
+                  max_sizes=MAX_SIZES, size_source=SIZE_SOURCE):
+    """Run every arranger on galleries of every size within its limit.
+
+    Returns list of results.
+    """
+
+    picture_sizes = load_sizes(size_source)
+
+    cases = [(algorithm_type, n, repeat, seed + repeat, picture_sizes, options)
+             for n in sizes
+             for algorithm_type in arrangers
+             for repeat in range(repeats)
+             if n <= max_sizes.get(algorithm_type, n)]
+
+    # A new process for each case, so memory peaks are not carried over
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+
+    results = []
+    try:
+        for result in pool.imap(run_case, cases):
+            print >> sys.stderr, '{arranger:>8} {size:>6} {wall_time:9.3f}s'.format(
+                **result)
+            results.append(result)
+    finally:
+        pool.terminate()
+
+    return results
+
+
+def find_regressions(results, baseline, ratio=REGRESSION_RATIO):
+    """Return list of (result, baseline time) for cases slower than the baseline.
+
+    Cases are matched on arranger, size and repeat, and compared by wall time.
+    """
+
+    before = dict(((r['arranger'], r['size'], r['repeat']), r['wall_time'])
+                  for r in baseline['results'])
+
+    regressions = []
+    for result in results:
+        key = (result['arranger'], result['size'], result['repeat'])
+        if key in before and result['wall_time'] > ratio * before[key]:
+            regressions.append((result, before[key]))
+
+    return regressions
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=SIZES)
+    parser.add_argument('--arrangers', nargs='+', default=ARRANGERS,
+                        choices=sorted(ar.ARRANGERS))
+    parser.add_argument('--repeats', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--index', default='auto',
+                        help="spatial index type, 'none', or 'auto' to "
+                             "choose by gallery size")
+    parser.add_argument('--no-limits', action='store_true',
+                        help="run every arranger on every size")
+    parser.add_argument('--output', help="file to write results, else stdout")
+    parser.add_argument('--compare', help="results file of an earlier run")
+    parser.add_argument('--ratio', type=float, default=REGRESSION_RATIO)
+    args = parser.parse_args(argv)
+
+    if args.index == 'auto':
+        options = {}
+    else:
+        options = {'index': None if args.index == 'none' else args.index}
+
+    max_sizes = {} if args.no_limits else MAX_SIZES
+
+    results = run_benchmark(args.arrangers, args.sizes, args.repeats,
+                            args.seed, options, max_sizes)
+
+    skipped = [{'arranger': algorithm_type, 'size': n}
+               for n in args.sizes
+               for algorithm_type in args.arrangers
+               if n > max_sizes.get(algorithm_type, n)]
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'options': options,
+        'results': results,
+        'skipped': skipped,
+    }
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            output_file.write(output + '\n')
+    else:
+        print output
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)
+
+        regressions = find_regressions(results, baseline, args.ratio)
+
+        for result, before in regressions:
+            print >> sys.stderr, 'Slower: {} {} {:.3f}s was {:.3f}s'.format(
+                result['arranger'], result['size'], result['wall_time'], before)
+
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,117 @@
+"""Background making of gallery display walls, so no page waits to arrange one.
+
+A gallery's display wall is asked for as soon as the gallery is curated, and
+is made by a background thread calling a function given to the worker. Until
+it is stored the gallery is pending, shown by a placeholder; a pending
+gallery is not asked for again until its request expires, so a failed or
+lost request is retried by a later view of the galleries page.
+"""
+
+import logging
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+log = logging.getLogger(__name__)
+
+
+class DisplayWallWorker(object):
+    """Makes display walls of galleries in a few background threads."""
+
+    def __init__(self, make_walls, workers=1, pending_timeout=60.0):
+
+        # Takes a list of gallery ids and stores their display walls, returns
+        # dictionary of wall ids made by gallery id
+        self.make_walls = make_walls
+        self.workers = workers
+        self.pending_timeout = pending_timeout
+
+        # Threads are started on first use, not when the server is imported
+        self.executor = None
+
+        self.lock = threading.Lock()
+
+        # Time requested, by gallery id, of galleries with walls being made
+        self.requested = {}
+
+        self.counts = {
+            'requests': 0,
+            'made': 0,
+            'errors': 0,
+            'expired': 0,
+        }
+
+    def request(self, gallery_ids):
+        """Start making display walls of galleries not already pending.
+
+        Returns list of the gallery ids that were requested now.
+        """
+
+        now = time.time()
+
+        with self.lock:
+            new_ids = []
+
+            for gallery_id in gallery_ids:
+                requested = self.requested.get(gallery_id)
+
+                if requested is not None:
+                    if requested > now - self.pending_timeout:
+                        continue
+                    self.counts['expired'] += 1
+
+                self.requested[gallery_id] = now
+                new_ids.append(gallery_id)
+
+            if not new_ids:
+                return new_ids
+
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+            self.counts['requests'] += 1
+
+        self.executor.submit(self.run, new_ids, now)
+
+        return new_ids
+
+    def run(self, gallery_ids, requested):
+        """Make display walls of galleries, run in background."""
+
+        made = None
+
+        try:
+            made = self.make_walls(gallery_ids)
+
+        except Exception:
+            log.exception('Could not make display walls of galleries %s',
+                          gallery_ids)
+
+        with self.lock:
+            if made is None:
+                self.counts['errors'] += 1
+            else:
+                self.counts['made'] += len(made)
+
+            # Unless requested again after expiring meanwhile
+            for gallery_id in gallery_ids:
+                if self.requested.get(gallery_id) == requested:
+                    del self.requested[gallery_id]
+
+    def stats(self):
+        """Return dictionary of counts, including galleries pending."""
+
+        with self.lock:
+            stats = dict(self.counts)
+            stats['pending'] = len(self.requested)
+
+        return stats
+
+    def shutdown(self):
+        """Stop the threads, waiting for walls being made."""
+
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
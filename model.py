@@ -1,6 +1,9 @@
 """Models and database functions for Gallery Wall project."""
 
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+
+from timing import span
 # import arrange
 
 def lazy_load_of_workspace():
@@ -18,6 +21,9 @@ def lazy_load_of_workspace():
 
 db = SQLAlchemy()
 
+# Most placements written by one INSERT, within the bind parameter limit
+PLACEMENT_INSERT_ROWS = 5000
+
 
 class Picture(db.Model):
     """Picture to be included in gallery walls."""
@@ -103,34 +109,135 @@ class Gallery(db.Model):
 
     @property
     def display_wall_id(self):
+        """Id of the wall displaying the gallery, arranged if there is none yet."""
 
-        wall_id = (db.session.query(Wall.wall_id)
-                             .join(Gallery)
-                             .filter(Gallery.gallery_id == self.gallery_id,
-                                     Wall.gallery_display == True)
-                             .first())
+        return Gallery.display_wall_ids([self])[self.gallery_id]
 
-        if not wall_id:
+    @classmethod
+    def display_wall_ids(cls, galleries, arrange_many=None):
+        """Return dictionary of display wall id by gallery id, for many galleries.
 
-            arrange_options = {}
+        Existing display walls are found in one query, and those missing are
+        made together, as by make_display_walls.
+        """
 
-            lazy_load_of_workspace()
-            wkspc = ar.Workspace(self.gallery_id)
-            arranger_instance = ar.GalleryFloorArranger(wkspc)
-            # import pdb
-            # pdb.set_trace()
-            arranger_instance.arrange()
-            wall_id = Wall.init_from_workspace(wkspc)
-            # db.session.flush()
-            Wall.query.get(wall_id).set_gallery_display()
+        gallery_ids = [gallery.gallery_id for gallery in galleries]
 
-        else:
-            # TODO: there should be a more graceful way to deal with that query
-            # returning either None or a tuple
-            wall_id = wall_id[0]
+        wall_ids = cls.find_display_wall_ids(gallery_ids)
+
+        missing = [gallery_id for gallery_id in gallery_ids
+                   if gallery_id not in wall_ids]
+
+        if missing:
+            wall_ids.update(cls.make_display_walls(missing, arrange_many))
+
+            # Reload the galleries expired by the commit in one query
+            cls.query.filter(cls.gallery_id.in_(gallery_ids)).all()
+
+        return wall_ids
 
-        return wall_id
+    @classmethod
+    def find_display_wall_ids(cls, gallery_ids):
+        """Return dictionary of display wall id by gallery id, of those that have one.
+
+        Found in one query, nothing is arranged.
+        """
+
+        if not gallery_ids:
+            return {}
+
+        with span('load'):
+            return dict(db.session.query(Wall.gallery_id,
+                                         db.func.min(Wall.wall_id))
+                                  .filter(Wall.gallery_id.in_(gallery_ids),
+                                          Wall.gallery_display == True)
+                                  .group_by(Wall.gallery_id)
+                                  .all())
 
+    @classmethod
+    def make_display_walls(cls, gallery_ids, arrange_many=None):
+        """Arrange and store display walls of galleries that have none, and commit.
+
+        Galleries are arranged together, by arrange_many if given, which
+        takes an algorithm type and list of (records, gallery_id) and returns
+        a list of Layouts, so it may arrange them in parallel. A layout may be
+        None, for a gallery not arranged in time, which is left without a
+        display wall to be made another time. Walls and placements of the
+        rest are then stored in bulk. Returns dictionary of new wall id by
+        gallery id.
+
+        Other threads and processes may be making the same walls, so the
+        galleries' rows are locked while checking again and storing.
+        """
+
+        existing = cls.find_display_wall_ids(gallery_ids)
+        missing = [gallery_id for gallery_id in gallery_ids
+                   if gallery_id not in existing]
+
+        if not missing:
+            return {}
+
+        lazy_load_of_workspace()
+
+        with span('load'):
+            records = cls.get_records(missing)
+
+        jobs = [(records[gallery_id], gallery_id)
+                for gallery_id in missing if gallery_id in records]
+
+        with span('arrange'):
+            if arrange_many is None:
+                layouts = [ar.arrange_records('gallery', gallery_records,
+                                              gallery_id)
+                           for gallery_records, gallery_id in jobs]
+            else:
+                layouts = [layout for layout in arrange_many('gallery', jobs)
+                           if layout is not None]
+
+        # Galleries with no pictures get an empty wall
+        layouts += [ar.Layout(gallery_id, 0, 0, {}, None, None, None)
+                    for gallery_id in missing if gallery_id not in records]
+
+        # Kept for every gallery view, so worth storing placements
+        with span('persist'):
+            # Held until the commit, in gallery order so lockers cannot deadlock
+            (db.session.query(cls.gallery_id)
+                       .filter(cls.gallery_id.in_(missing))
+                       .order_by(cls.gallery_id)
+                       .with_for_update()
+                       .all())
+
+            # Made by someone else while these were arranged
+            existing = cls.find_display_wall_ids(missing)
+            layouts = [layout for layout in layouts
+                       if layout.gallery_id not in existing]
+
+            wall_ids = Wall.insert_display_walls(layouts) if layouts else {}
+            db.session.commit()
+
+        return wall_ids
+
+    @classmethod
+    def get_records(cls, gallery_ids):
+        """Return dictionary of lists of PictureRecords by gallery id, in one query."""
+
+        lazy_load_of_workspace()
+
+        rows = (db.session.query(GalleryMembership.gallery_id,
+                                 Picture.picture_id,
+                                 Picture.width,
+                                 Picture.height)
+                          .join(Picture,
+                                Picture.picture_id == GalleryMembership.picture_id)
+                          .filter(GalleryMembership.gallery_id.in_(gallery_ids))
+                          .all())
+
+        records = {}
+        for row in rows:
+            records.setdefault(row.gallery_id, []).append(
+                ar.PictureRecord(row.picture_id, row.width, row.height))
+
+        return records
 
     @classmethod
     def make_from_pictures(cls, curator_id, picture_list, gallery_name=None):
@@ -152,6 +259,56 @@ class Gallery(db.Model):
 
         return gallery
 
+    def add_picture(self, picture):
+        """Add a picture to the gallery, and place it on walls already placed.
+
+        Other pictures on those walls stay where they are. Returns list of ids
+        of walls edited.
+        """
+
+        if picture in self.pictures:
+            return []
+
+        walls = self.placed_walls()
+        for wall in walls:
+            wall.edit_pictures(add=picture)
+
+        db.session.add(GalleryMembership(gallery_id=self.gallery_id,
+                                         picture_id=picture.picture_id))
+        db.session.commit()
+
+        return [wall.wall_id for wall in walls]
+
+    def remove_picture(self, picture):
+        """Remove a picture from the gallery, and from walls already placed.
+
+        Pictures lined up with the gap on those walls slide along to close
+        it, the rest stay where they are. Returns list of ids of walls edited.
+        """
+
+        if picture not in self.pictures:
+            return []
+
+        walls = self.placed_walls()
+        for wall in walls:
+            wall.edit_pictures(remove=picture)
+
+        (GalleryMembership.query
+                          .filter_by(gallery_id=self.gallery_id,
+                                     picture_id=picture.picture_id)
+                          .delete())
+        db.session.commit()
+
+        return [wall.wall_id for wall in walls]
+
+    def placed_walls(self):
+        """Return list of walls of this gallery with stored placements."""
+
+        return (Wall.query.filter(Wall.gallery_id == self.gallery_id,
+                                  Wall.placements.any())
+                          .order_by(Wall.wall_id)
+                          .all())
+
     def print_seed(self):
         """Print the seed format of a gallery to save as a sample."""
 
@@ -185,6 +342,12 @@ class Wall(db.Model):
 
     gallery_display = db.Column(db.Boolean(), nullable=False, default=False)
 
+    # How the wall was arranged, for telling arrangements apart. Null for
+    # walls edited since, or that only exist as placements.
+    algorithm_type = db.Column(db.String(16), nullable=True)
+    algorithm_version = db.Column(db.Integer, nullable=True)
+    seed = db.Column(db.Integer, nullable=True)
+
     # Relationships
     gallery = db.relationship("Gallery")
     placements = db.relationship("Placement")
@@ -194,26 +357,156 @@ class Wall(db.Model):
     def init_from_workspace(cls, workspace):
         """Initialize a wall and the related placements from a workspace."""
 
-        wall = cls(gallery_id=workspace.gallery_id,
-                   wall_width=workspace.width,
-                   wall_height=workspace.height,
+        return cls.init_from_layout(workspace.get_layout())
+
+    @classmethod
+    def init_from_layout(cls, layout):
+        """Initialize a wall and the related placements from an arranged layout."""
+
+        wall = cls(gallery_id=layout.gallery_id,
+                   wall_width=layout.width,
+                   wall_height=layout.height,
+                   algorithm_type=layout.algorithm_type,
+                   algorithm_version=layout.algorithm_version,
+                   seed=layout.seed,
                    )
         db.session.add(wall)
         db.session.flush()
 
-        wall_id = wall.wall_id
-
-        # Store placements in database
-        for pic_id in workspace.pics:
-            placement = Placement(wall_id=wall_id,
-                                  picture_id=pic_id,
-                                  x_coord=workspace.pics[pic_id].x1,
-                                  y_coord=workspace.pics[pic_id].y1)
+        wall.store_placements(layout)
 
-            db.session.add(placement)
         db.session.commit()
 
-        return wall_id
+        return wall.wall_id
+
+    def store_placements(self, layout):
+        """Insert placements of the layout for this wall, in bulk.
+
+        Written in the session's transaction as a few statements, rather than
+        added to the session one by one.
+        """
+
+        insert_placements(placement_rows(self.wall_id, layout))
+
+        # Placements already loaded for the wall do not include these
+        db.session.expire(self, ['placements'])
+
+    @classmethod
+    def insert_display_walls(cls, layouts):
+        """Insert gallery display walls of layouts, with placements, in bulk.
+
+        On Postgres the walls are one multi-row INSERT returning their ids,
+        elsewhere one INSERT each. Returns dictionary of wall id by gallery id.
+        """
+
+        rows = [{'gallery_id': layout.gallery_id,
+                 'wall_width': layout.width,
+                 'wall_height': layout.height,
+                 'gallery_display': True,
+                 'saved': False,
+                 'algorithm_type': layout.algorithm_type,
+                 'algorithm_version': layout.algorithm_version,
+                 'seed': layout.seed}
+                for layout in layouts]
+
+        insert = cls.__table__.insert()
+
+        if db.engine.dialect.name == 'postgresql':
+            inserted = db.session.execute(
+                insert.values(rows).returning(cls.gallery_id, cls.wall_id))
+            wall_ids = dict(inserted.fetchall())
+        else:
+            wall_ids = {}
+            for row in rows:
+                inserted = db.session.execute(insert, row)
+                wall_ids[row['gallery_id']] = inserted.inserted_primary_key[0]
+
+        insert_placements([placement
+                           for layout in layouts
+                           for placement in placement_rows(
+                               wall_ids[layout.gallery_id], layout)])
+
+        return wall_ids
+
+    def edit_pictures(self, add=None, remove=None):
+        """Place one more picture on the wall, or take one off, or both.
+
+        Works from the stored placements, leaving pictures in place except
+        those that slide in to close a gap. Only changed placements are
+        written, and the record of how the wall was arranged is cleared.
+        Returns the number of placements added, moved or deleted.
+        """
+
+        lazy_load_of_workspace()
+
+        placements = (Placement.query
+                               .options(db.joinedload('picture'))
+                               .filter_by(wall_id=self.wall_id)
+                               .all())
+        placements = dict((placement.picture_id, placement)
+                          for placement in placements)
+
+        pictures = [placement.picture for placement in placements.values()]
+        if add is not None and add.picture_id not in placements:
+            pictures.append(add)
+
+        records = [ar.PictureRecord(picture.picture_id, picture.width,
+                                    picture.height)
+                   for picture in pictures]
+        layout = ar.Layout(gallery_id=self.gallery_id,
+                           width=self.wall_width,
+                           height=self.wall_height,
+                           placements=dict((p, (placement.x_coord,
+                                                placement.y_coord))
+                                           for p, placement in placements.items()),
+                           algorithm_type=None,
+                           algorithm_version=None,
+                           seed=None)
+
+        with span('arrange'):
+            wkspc = ar.Workspace.from_layout(records, layout)
+            editor = ar.WallEditor(wkspc)
+
+            if add is not None and add.picture_id not in placements:
+                editor.add(add.picture_id)
+            if remove is not None and remove.picture_id in placements:
+                editor.remove(remove.picture_id)
+
+            editor.finish()
+            edited = wkspc.get_layout()
+
+        written = 0
+
+        for picture_id, placement in placements.items():
+            if picture_id not in edited.placements:
+                db.session.delete(placement)
+                written += 1
+                continue
+
+            x, y = edited.placements[picture_id]
+            if (abs(x - placement.x_coord) > 1e-6 or
+                    abs(y - placement.y_coord) > 1e-6):
+                placement.x_coord = x
+                placement.y_coord = y
+                written += 1
+
+        for picture_id, (x, y) in edited.placements.items():
+            if picture_id not in placements:
+                db.session.add(Placement(wall_id=self.wall_id,
+                                         picture_id=picture_id,
+                                         x_coord=x,
+                                         y_coord=y))
+                written += 1
+
+        self.wall_width = edited.width
+        self.wall_height = edited.height
+
+        # No longer as the arranger left it, so the seed would not reproduce it
+        self.algorithm_type = None
+        self.algorithm_version = None
+        self.seed = None
+
+        return written
 
     def save(self):
         """Sets wall state to saved."""
@@ -232,27 +525,65 @@ class Wall(db.Model):
     def get_hanging_info(self):
         """Returns a dictionary containing the needed information for display."""
 
-        pictures_to_hang = {}
+        return Wall.load_hanging_info(self.wall_id)
 
-        for placement in self.placements:
-            pictures_to_hang[placement.picture_id] = {
-                'x': placement.x_coord,
-                'y': placement.y_coord,
-                'width': placement.picture.width,
-                'height': placement.picture.height,
-                'image': placement.picture.image_file,
-                }
-
-        hanging_info = {
-                        'id': self.wall_id,
-                        'height': self.wall_height,
-                        'width': self.wall_width,
-                        'pictures_to_hang': pictures_to_hang,
-                        'is_gallery': self.gallery_display,
-                        }
+    @classmethod
+    def load_hanging_info(cls, wall_id):
+        """Returns the hanging info of a wall by id, or None if there is no such wall."""
 
-        return hanging_info
+        return cls.load_hanging_infos([wall_id]).get(wall_id)
 
+    @classmethod
+    def load_hanging_infos(cls, wall_ids):
+        """Returns dictionary of hanging info by wall id, of the walls that exist.
+
+        Walls, placements and the picture columns needed come from one joined
+        query of just those columns, without loading ORM objects.
+        """
+
+        wall_ids = list(set(wall_ids))
+
+        if not wall_ids:
+            return {}
+
+        rows = (db.session.query(Wall.wall_id,
+                                 Wall.wall_width,
+                                 Wall.wall_height,
+                                 Wall.gallery_display,
+                                 Placement.picture_id,
+                                 Placement.x_coord,
+                                 Placement.y_coord,
+                                 Picture.width,
+                                 Picture.height,
+                                 Picture.image_file)
+                          .outerjoin(Placement, Placement.wall_id == Wall.wall_id)
+                          .outerjoin(Picture,
+                                     Picture.picture_id == Placement.picture_id)
+                          .filter(Wall.wall_id.in_(wall_ids))
+                          .all())
+
+        hanging_infos = {}
+
+        for row in rows:
+            if row.wall_id not in hanging_infos:
+                hanging_infos[row.wall_id] = {
+                    'id': row.wall_id,
+                    'height': row.wall_height,
+                    'width': row.wall_width,
+                    'pictures_to_hang': {},
+                    'is_gallery': row.gallery_display,
+                    }
+
+            if row.picture_id is not None:
+                hanging_infos[row.wall_id]['pictures_to_hang'][row.picture_id] = {
+                    'x': row.x_coord,
+                    'y': row.y_coord,
+                    'width': row.width,
+                    'height': row.height,
+                    'image': row.image_file,
+                    }
+
+        return hanging_infos
 
     def print_seed(self):
         """Print the seed format of a wall to save as a sample."""
@@ -284,6 +615,44 @@ class Wall(db.Model):
                                                     self.gallery.gallery_id)
 
 
+# At most one display wall per gallery, however many servers make them. This
+# needs a partial index, so is only made on dialects that have them, rather
+# than limit other databases to one wall of any kind per gallery.
+event.listen(Wall.__table__, 'after_create',
+             db.DDL('CREATE UNIQUE INDEX walls_gallery_display_key '
+                    'ON walls (gallery_id) WHERE gallery_display')
+               .execute_if(dialect=('postgresql', 'sqlite')))
+
+
+def placement_rows(wall_id, layout):
+    """Return list of placement table rows of a wall arranged as the layout."""
+
+    return [{'wall_id': wall_id,
+             'picture_id': pic_id,
+             'x_coord': x,
+             'y_coord': y}
+            for pic_id, (x, y) in sorted(layout.placements.items())]
+
+
+def insert_placements(rows):
+    """Insert placement table rows in the session's transaction, in bulk.
+
+    On Postgres each batch is a single multi-row INSERT, elsewhere an
+    executemany.
+    """
+
+    insert = Placement.__table__.insert()
+    multi_row = db.engine.dialect.name == 'postgresql'
+
+    for start in range(0, len(rows), PLACEMENT_INSERT_ROWS):
+        batch = rows[start:start + PLACEMENT_INSERT_ROWS]
+
+        if multi_row:
+            db.session.execute(insert.values(batch))
+        else:
+            db.session.execute(insert, batch)
+
+
 class Placement(db.Model):
     """Location of a picture within a wall arrangment."""
 
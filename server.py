@@ -11,8 +11,17 @@ import secrets
 
 import arrange as ar
 import utilities as utils
-
+import timing
+from timing import span
+from arrange_pool import ArrangementPool
+from arrange_cache import ArrangementCache
+from arrange_buffer import LayoutBuffer
+from display_worker import DisplayWallWorker
+
+import math
 import os
+import random
+import time
 
 app = Flask(__name__)
 
@@ -39,6 +48,93 @@ app.config['BOOSTRAP_CSS_PATH'] = resources.boostrap_css_path
 app.config['BOOSTRAP_JS_PATH'] = resources.boostrap_js_path
 app.config['CHARTJS_PATH'] = resources.chartjs_path
 
+# Arrangement runs in worker processes, a request waits at most the timeout
+# (seconds) before falling back to a fast arrangement
+app.config['ARRANGE_WORKERS'] = 2
+app.config['ARRANGE_TIMEOUT'] = 5.0
+app.config['ARRANGE_FALLBACK'] = 'linear'
+# A request may give a latency budget (milliseconds) for arrangement, from
+# which this much (seconds) is kept back for saving the wall and responding
+app.config['ARRANGE_BUDGET_RESERVE'] = 0.05
+# Arrangers are downgraded to faster ones for galleries they are not
+# recommended for, or estimated to take longer than this (seconds) on
+app.config['ARRANGE_LATENCY_BUDGET'] = 2.0
+# Galleries of more pictures than this are arranged by these types in
+# clusters of the cluster size, arranged in parallel and then composed
+app.config['ARRANGE_HIERARCHICAL_SIZE'] = 200
+app.config['ARRANGE_HIERARCHICAL_ALGORITHMS'] = ['column', 'grid']
+app.config['ARRANGE_CLUSTER_SIZE'] = ar.CLUSTER_SIZE
+# Most candidate arrangements a request may ask for, the best is returned
+app.config['ARRANGE_MAX_CANDIDATES'] = 8
+# Seeds are drawn from a pool of this many, so repeat arrangements of a
+# gallery come from cache once each seed has been arranged, while there are
+# still plenty of different layouts to regenerate. None draws fresh seeds, so
+# every arrangement can differ but none are cached.
+app.config['ARRANGE_SEEDS'] = 32
+# Cached arrangements kept in memory, and optionally in a shared directory
+app.config['ARRANGE_CACHE_ENTRIES'] = 1024
+app.config['ARRANGE_CACHE_AGE'] = 24 * 60 * 60
+app.config['ARRANGE_CACHE_DIR'] = os.environ.get('ARRANGE_CACHE_DIR')
+arrange_cache = ArrangementCache(max_entries=app.config['ARRANGE_CACHE_ENTRIES'],
+                                 max_age=app.config['ARRANGE_CACHE_AGE'],
+                                 directory=app.config['ARRANGE_CACHE_DIR'])
+arrange_pool = ArrangementPool(workers=app.config['ARRANGE_WORKERS'],
+                               timeout=app.config['ARRANGE_TIMEOUT'],
+                               fallback=app.config['ARRANGE_FALLBACK'],
+                               cache=arrange_cache)
+# Layouts arranged ahead of time for recently viewed galleries, so rearranging
+# is instant. Depth is layouts kept ready per gallery, algorithm and number
+# of candidates; buffers unused for the idle time (seconds) are dropped.
+# They are arranged in a pool of their own processes, so warming buffers never
+# queues live requests behind it.
+app.config['ARRANGE_BUFFER_DEPTH'] = 2
+app.config['ARRANGE_BUFFER_WORKERS'] = 2
+app.config['ARRANGE_BUFFER_PROCESSES'] = 1
+app.config['ARRANGE_BUFFER_IDLE'] = 10 * 60
+app.config['ARRANGE_BUFFER_ALGORITHMS'] = ['column', 'grid']
+# Candidates asked for by the arrange page, so buffers are warmed to match
+app.config['ARRANGE_BUFFER_CANDIDATES'] = 4
+buffer_pool = ArrangementPool(workers=app.config['ARRANGE_BUFFER_PROCESSES'],
+                              timeout=app.config['ARRANGE_TIMEOUT'],
+                              fallback=app.config['ARRANGE_FALLBACK'],
+                              cache=arrange_cache)
+layout_buffer = LayoutBuffer(depth=app.config['ARRANGE_BUFFER_DEPTH'],
+                             refill_workers=app.config['ARRANGE_BUFFER_WORKERS'],
+                             idle_timeout=app.config['ARRANGE_BUFFER_IDLE'])
+
+
+def make_display_walls(gallery_ids):
+    """Arrange and store display walls of galleries, run in background.
+
+    Display walls are kept, so galleries not arranged in time are left to be
+    asked for again rather than stored as arranged by the fallback.
+    """
+
+    def arrange_many(algorithm_type, jobs):
+        return arrange_pool.arrange_many(algorithm_type, jobs, fallback=False)
+
+    with app.app_context():
+        return Gallery.make_display_walls(gallery_ids, arrange_many)
+
+# Display walls are made in the background as soon as a gallery is curated, so
+# the galleries page never arranges. Galleries still pending after this many
+# seconds are asked for again by the next view of the page.
+app.config['DISPLAY_WALL_WORKERS'] = 1
+app.config['DISPLAY_WALL_PENDING'] = 60.0
+display_wall_worker = DisplayWallWorker(make_display_walls,
+                                        workers=app.config['DISPLAY_WALL_WORKERS'],
+                                        pending_timeout=app.config['DISPLAY_WALL_PENDING'])
+
+# Stage times of these routes are sent as Server-Timing headers, and kept as
+# histograms shown by /timing-stats.json
+request_timings = timing.init_app(app, routes=['/arrange.json', '/getwall.json',
+                                               '/getwalls.json', '/galleries',
+                                               '/display-walls.json'])
+
+# Most walls, or galleries, that can be asked for in one request to
+# /getwalls.json or /display-walls.json
+app.config['WALLS_BATCH_MAX'] = 100
+
 # Default user ID used to display sample images when no other user logged in
 DEFAULT_USER_ID = 1
 
@@ -145,9 +241,11 @@ def show_pictures():
 @app.route('/process-curation', methods=["POST"])
 def process_curation():
 
-    curate_success = utils.attempt_curation()
+    gallery = utils.attempt_curation()
 
-    if curate_success:
+    if gallery:
+        # Ready, or nearly, by the time the galleries page asks for it
+        display_wall_worker.request([gallery.gallery_id])
         return redirect('/galleries')
     else:
         flash('Cannot create empty gallery.')
@@ -159,10 +257,21 @@ def show_galleries():
     """Show a user's galleries that they can choose to arrange."""
 
     user_id = session.get('user_id', DEFAULT_USER_ID)
-    galleries = User.query.get(user_id).galleries
 
-    return render_template("galleries.html",
-                           galleries=galleries)
+    with span('load'):
+        galleries = User.query.get(user_id).galleries
+
+    # Display walls not yet made are shown as pending, and made in background
+    with span('display_walls'):
+        gallery_ids = [gallery.gallery_id for gallery in galleries]
+        display_walls = Gallery.find_display_wall_ids(gallery_ids)
+        display_wall_worker.request([gallery_id for gallery_id in gallery_ids
+                                     if gallery_id not in display_walls])
+
+    with span('render'):
+        return render_template("galleries.html",
+                               galleries=galleries,
+                               display_walls=display_walls)
 
 
 @app.route('/arrange', methods=["GET"])
@@ -180,9 +289,28 @@ def prompt_arrangment():
 
     arrange_options = utils.get_arrange_options_for_display()
 
+    # Have layouts ready by the time they are asked for
+    records = ar.get_gallery_records(gallery.gallery_id)
+    candidates = app.config['ARRANGE_BUFFER_CANDIDATES']
+
+    buffered = set(choose_algorithm(algorithm_type, len(records), candidates)
+                   for algorithm_type in app.config['ARRANGE_BUFFER_ALGORITHMS'])
+
+    for algorithm_type in buffered:
+        layout_buffer.warm((gallery.gallery_id, algorithm_type, candidates),
+                           layout_producer(gallery.gallery_id, algorithm_type,
+                                           candidates, records,
+                                           fallback_ok=False, pool=buffer_pool))
+
+    # Shown as pending until made in background, never arranged here
+    display_walls = Gallery.find_display_wall_ids([gallery.gallery_id])
+    if gallery.gallery_id not in display_walls:
+        display_wall_worker.request([gallery.gallery_id])
+
     return render_template("arrange.html",
                            gallery=gallery,
                            arrange_options=arrange_options,
+                           display_wall_id=display_walls.get(gallery.gallery_id),
                            )
 
 
@@ -249,15 +377,90 @@ def get_wall_data():
     Response to an AJAX request.
     """
 
-    wall_id = request.args.get('wallid')
-    wall = Wall.query.get(wall_id)
+    wall_id = request.args.get('wallid', type=int)
 
-    if wall:
-        wall_to_hang = wall.get_hanging_info()
-    else:
-        wall_to_hang = {'id': None}
+    # Wall, placements and pictures are loaded in one query
+    with span('hanging_info'):
+        wall_to_hang = None
+        if wall_id is not None:
+            wall_to_hang = Wall.load_hanging_info(wall_id)
+        if wall_to_hang is None:
+            wall_to_hang = {'id': None}
+
+    with span('render'):
+        return jsonify(wall_to_hang)
+
+
+@app.route('/getwalls.json')
+def get_walls_data():
+    """Get the information needed for displaying many walls at once.
+
+    Response to an AJAX request, with wall ids as a comma separated list.
+    Hanging info comes back by wall id, and walls that cannot be hung get an
+    error message instead, without failing the others.
+    """
+
+    wall_ids = []
+    errors = {}
+
+    for wall_id in request.args.get('wallids', '').split(','):
+        if not wall_id.strip():
+            continue
+        try:
+            wall_ids.append(int(wall_id))
+        except ValueError:
+            errors[wall_id] = "That is not a wall id."
+
+    batch_max = app.config['WALLS_BATCH_MAX']
+    for wall_id in wall_ids[batch_max:]:
+        errors[str(wall_id)] = "Too many walls asked for at once."
+    wall_ids = wall_ids[:batch_max]
+
+    with span('hanging_info'):
+        hanging_infos = Wall.load_hanging_infos(wall_ids)
+
+    walls = {}
 
-    return jsonify(wall_to_hang)
+    for wall_id in wall_ids:
+        if wall_id not in hanging_infos:
+            errors[str(wall_id)] = "This is not the wall you're looking for."
+        else:
+            walls[str(wall_id)] = hanging_infos[wall_id]
+
+    with span('render'):
+        return jsonify({'walls': walls, 'errors': errors})
+
+
+@app.route('/display-walls.json')
+def get_display_walls_data():
+    """Get the display wall ids of galleries, asking for those not made yet.
+
+    Response to an AJAX request, with gallery ids as a comma separated list,
+    polled by pages showing galleries still pending. Nothing is arranged
+    here, galleries without a display wall are listed as pending and made in
+    background.
+    """
+
+    gallery_ids = []
+
+    for gallery_id in request.args.get('galleryids', '').split(','):
+        try:
+            gallery_ids.append(int(gallery_id))
+        except ValueError:
+            pass
+
+    gallery_ids = gallery_ids[:app.config['WALLS_BATCH_MAX']]
+
+    with span('display_walls'):
+        display_walls = Gallery.find_display_wall_ids(gallery_ids)
+        pending = [gallery_id for gallery_id in gallery_ids
+                   if gallery_id not in display_walls]
+        display_wall_worker.request(pending)
+
+    with span('render'):
+        return jsonify({'walls': dict((str(gallery_id), wall_id) for
+                                      gallery_id, wall_id in display_walls.items()),
+                        'pending': pending})
 
 
 @app.route('/getgallery.json')
@@ -278,6 +481,69 @@ def get_gallery_data():
     return jsonify(gallery_to_hang)
 
 
+@app.route('/gallery-add-picture.json', methods=['POST'])
+def add_gallery_picture():
+    """Add a picture to a gallery, placing it on its walls without rearranging.
+
+    Response to an AJAX request, with the ids of walls edited.
+    """
+
+    gallery, picture = get_curated_gallery_picture()
+
+    if gallery is None:
+        return jsonify({'id': None})
+
+    wall_ids = gallery.add_picture(picture)
+    discard_buffered_layouts(gallery.gallery_id)
+
+    return jsonify({'id': gallery.gallery_id,
+                    'wall_ids': wall_ids})
+
+
+@app.route('/gallery-remove-picture.json', methods=['POST'])
+def remove_gallery_picture():
+    """Remove a picture from a gallery and its walls, closing the gaps locally.
+
+    Response to an AJAX request, with the ids of walls edited.
+    """
+
+    gallery, picture = get_curated_gallery_picture()
+
+    if gallery is None:
+        return jsonify({'id': None})
+
+    wall_ids = gallery.remove_picture(picture)
+    discard_buffered_layouts(gallery.gallery_id)
+
+    return jsonify({'id': gallery.gallery_id,
+                    'wall_ids': wall_ids})
+
+
+def discard_buffered_layouts(gallery_id):
+    """Drop layouts arranged ahead of time for a gallery, as its pictures changed."""
+
+    layout_buffer.discard(lambda key: key[0] == gallery_id)
+
+
+def get_curated_gallery_picture():
+    """Return gallery and picture of the form if the user may edit with them.
+
+    Galleries must be the user's own, pictures their own or public. Returns
+    (None, None) otherwise.
+    """
+
+    user_id = session.get('user_id')
+    gallery = Gallery.query.get(request.form.get('gallery_id', type=int))
+    picture = Picture.query.get(request.form.get('picture_id', type=int))
+
+    if (gallery is None or picture is None or user_id is None or
+            gallery.curator_id != user_id or
+            not (picture.user_id == user_id or picture.public)):
+        return None, None
+
+    return gallery, picture
+
+
 @app.route('/arrange.json', methods=['POST'])
 def get_arranged_data():
     """Get the information needed for displaying a gallery.
@@ -285,29 +551,164 @@ def get_arranged_data():
     Response to an AJAX request.
     """
 
+    started = time.time()
+
     gallery_id = int(request.form.get('gallery_id'))
     # margin = request.form.get('margin')
-    wkspc = ar.Workspace(gallery_id)
-
-    algorithm_type = request.form.get('algorithm_type')
 
-    if algorithm_type == 'linear':
-        arr = ar.LinearArranger(wkspc)
-    elif algorithm_type == 'column':
-        arr = ar.ColumnArranger(wkspc)
-    elif algorithm_type == 'grid':
-        arr = ar.GridArranger(wkspc)
+    # Optional latency budget in milliseconds, arrangement stops in time for it
+    budget = request.form.get('budget', type=int)
+    if budget is not None:
+        deadline = (started + budget / 1000.0
+                    - app.config['ARRANGE_BUDGET_RESERVE'])
     else:
-        # Default to column arrangement
-        arr = ar.ColumnArranger(wkspc)
+        deadline = None
+
+    with span('load'):
+        records = ar.get_gallery_records(gallery_id)
+
+    # Optionally arrange several candidates and keep the best
+    candidates = request.form.get('candidates', 1, type=int)
+    candidates = max(1, min(candidates, app.config['ARRANGE_MAX_CANDIDATES']))
+
+    # Unknown types default to column arrangement, and types too slow for
+    # the gallery are downgraded
+    requested_type = request.form.get('algorithm_type')
+    algorithm_type = choose_algorithm(requested_type, len(records), candidates,
+                                      None if budget is None else budget / 1000.0)
+
+    layout = None
+
+    # Take a layout arranged ahead of time if one is ready
+    if algorithm_type in app.config['ARRANGE_BUFFER_ALGORITHMS']:
+        with span('buffer'):
+            layout = layout_buffer.pop((gallery_id, algorithm_type, candidates),
+                                       layout_producer(gallery_id, algorithm_type,
+                                                       candidates, records,
+                                                       fallback_ok=False,
+                                                       pool=buffer_pool))
+
+    if layout is None:
+        with span('arrange'):
+            produce = layout_producer(gallery_id, algorithm_type, candidates,
+                                      records, deadline=deadline)
+            layout = produce()
+
+    with span('persist'):
+        wall_id = Wall.init_from_layout(layout)
+
+    # Arranger actually used, which may be the fallback if out of time
+    new_wall_data = {'id': wall_id,
+                     'algorithm_type': layout.algorithm_type,
+                     'requested_type': requested_type}
+
+    with span('render'):
+        return jsonify(new_wall_data)
+
+
+def choose_algorithm(algorithm_type, n, candidates, budget=None):
+    """Return algorithm type to arrange n pictures with, within the latency budget.
+
+    Without a budget in seconds the configured one is used. Candidates are
+    arranged in rounds of as many as there are pool workers, each round gets
+    its share of the budget.
+    """
+
+    if budget is None:
+        budget = app.config['ARRANGE_LATENCY_BUDGET']
+
+    workers = float(app.config['ARRANGE_WORKERS'])
+
+    if hierarchical(algorithm_type, n):
+        # Clusters are arranged in rounds across the workers, then composed
+        cluster_size = app.config['ARRANGE_CLUSTER_SIZE']
+        rounds = math.ceil(math.ceil(n / float(cluster_size)) / workers) + 1
+
+        chosen = ar.choose_arranger(algorithm_type, cluster_size, budget / rounds)
+        if chosen == ar.get_arranger(algorithm_type).algorithm_type:
+            return chosen
+
+    rounds = math.ceil(candidates / workers)
+
+    return ar.choose_arranger(algorithm_type, n, budget / rounds)
+
+
+def hierarchical(algorithm_type, n):
+    """Return true if n pictures are arranged by the type in clusters."""
+
+    return (n > app.config['ARRANGE_HIERARCHICAL_SIZE'] and
+            ar.get_arranger(algorithm_type).algorithm_type in
+            app.config['ARRANGE_HIERARCHICAL_ALGORITHMS'])
+
+
+def layout_producer(gallery_id, algorithm_type, candidates, records,
+                    fallback_ok=True, deadline=None, pool=None):
+    """Return function that arranges a layout as requested, from any thread.
+
+    Unless fallback_ok, a fallback arrangement made when out of time is
+    discarded and None returned instead. Given a deadline, the layout is the
+    best arranged by then. Large galleries are arranged hierarchically, as
+    one candidate using all the workers. Arranged in the pool given, by
+    default the one for live requests.
+    """
+
+    arranger = ar.get_arranger(algorithm_type)
+
+    if pool is None:
+        pool = arrange_pool
+
+    def produce():
+        seeds = choose_seeds(candidates)
+
+        if hierarchical(algorithm_type, len(records)):
+            layout = pool.arrange_hierarchical(
+                algorithm_type, records, gallery_id,
+                seed=seeds[0] if seeds else None,
+                cluster_size=app.config['ARRANGE_CLUSTER_SIZE'],
+                deadline=deadline)
+        elif candidates > 1:
+            layout = pool.arrange_best(algorithm_type, records,
+                                       candidates, gallery_id,
+                                       seeds=seeds, deadline=deadline)
+        else:
+            layout = pool.arrange(algorithm_type, records, gallery_id,
+                                  seed=seeds[0] if seeds else None,
+                                  deadline=deadline)
+
+        if fallback_ok or layout.algorithm_type == arranger.algorithm_type:
+            return layout
+
+    return produce
+
+
+def choose_seeds(n):
+    """Return n different seeds from the configured pool, or None if no pool."""
+
+    pool_size = app.config['ARRANGE_SEEDS']
+
+    if not pool_size:
+        return None
+
+    return random.sample(xrange(pool_size), min(n, pool_size))
+
+
+@app.route('/arrange-stats.json')
+def get_arrange_stats():
+    """Get counts from the arrangement worker pool and cache, for monitoring."""
+
+    stats = arrange_pool.stats()
+    stats['buffer'] = layout_buffer.stats()
+    stats['buffer']['pool'] = buffer_pool.stats()
+    stats['display_walls'] = display_wall_worker.stats()
 
-    arr.arrange()
+    return jsonify(stats)
 
-    wall_id = Wall.init_from_workspace(wkspc)
 
-    new_wall_data = {'id': wall_id}
+@app.route('/timing-stats.json')
+def get_timing_stats():
+    """Get histograms of stage times of timed routes, for monitoring."""
 
-    return jsonify(new_wall_data)
+    return jsonify(request_timings.as_dict())
 
 
 @app.route('/gettime.json')
@@ -0,0 +1,171 @@
+"""Spatial indexes over placed pics, used to find nearby rectangles quickly.
+
+An index is attached to a workspace and holds every pic of it. Pics report
+coordinate changes to their index, which only marks them as stale; stale pics
+are refreshed in the index the next time it is queried. Unplaced pics (x1 of
+None) are never returned.
+
+Queries return candidates: every placed pic that may touch the query rectangle,
+possibly along with some that do not. Callers still make the exact check.
+"""
+
+import math
+from bisect import bisect_left, bisect_right, insort
+
+
+class SpatialIndex(object):
+    """Index of pic rectangles that scans every placed rect for each query.
+
+    Also the base of faster indexes, which store the rects their own way by
+    overriding insert_rect, remove_rect and candidates.
+    """
+
+    def __init__(self, pics):
+
+        self.pics = {}
+        self.rects = {}
+        self.stale = set()
+
+        for pic in pics:
+            self.pics[pic.id] = pic
+            pic.index = self
+            self.stale.add(pic.id)
+
+    def mark(self, pic):
+        """Note that a pic has moved, it will be refreshed before next query."""
+
+        self.stale.add(pic.id)
+
+    def refresh(self):
+        """Bring stored rectangles of all moved pics up to date."""
+
+        for pic_id in self.stale:
+            pic = self.pics[pic_id]
+            old = self.rects.pop(pic_id, None)
+            if old is not None:
+                self.remove_rect(pic_id, old)
+
+            if pic.x1 is not None:
+                new = (pic.x1, pic.x2, pic.y1, pic.y2)
+                self.rects[pic_id] = new
+                self.insert_rect(pic_id, new)
+
+        self.stale.clear()
+
+    def query(self, x1, x2, y1, y2):
+        """Return list of placed pics possibly touching the given rectangle."""
+
+        if self.stale:
+            self.refresh()
+
+        return [self.pics[pic_id] for pic_id in self.candidates(x1, x2, y1, y2)]
+
+    # Storage specific to each kind of index, here only the rects themselves
+    def insert_rect(self, pic_id, rect):
+        """Store the rect of a placed pic."""
+
+    def remove_rect(self, pic_id, rect):
+        """Forget the old rect of a pic that moved."""
+
+    def candidates(self, x1, x2, y1, y2):
+        """Return ids of placed pics touching the given rectangle, edges included."""
+
+        return [pic_id for pic_id, (r_x1, r_x2, r_y1, r_y2) in self.rects.items()
+                if r_x1 <= x2 and r_x2 >= x1 and r_y1 <= y2 and r_y2 >= y1]
+
+
+class GridIndex(SpatialIndex):
+    """Uniform grid spatial hash, each rect is listed in every cell it touches.
+
+    Cell size defaults to the median pic dimension, so a typical pic covers
+    only a few cells.
+    """
+
+    def __init__(self, pics, cell_size=None):
+
+        pics = list(pics)
+
+        if cell_size is None:
+            sides = sorted([pic.w for pic in pics] + [pic.h for pic in pics])
+            cell_size = sides[len(sides) / 2] if sides else 1
+
+        self.cell_size = float(max(cell_size, 1))
+        self.cells = {}
+
+        super(GridIndex, self).__init__(pics)
+
+    def cell_range(self, x1, x2, y1, y2):
+        """Return the (i, j) cell keys covered by a rectangle, edges included."""
+
+        size = self.cell_size
+        i1, i2 = int(math.floor(y1 / size)), int(math.floor(y2 / size))
+        j1, j2 = int(math.floor(x1 / size)), int(math.floor(x2 / size))
+
+        return [(i, j) for i in range(i1, i2 + 1) for j in range(j1, j2 + 1)]
+
+    def insert_rect(self, pic_id, rect):
+
+        for cell in self.cell_range(*rect):
+            self.cells.setdefault(cell, set()).add(pic_id)
+
+    def remove_rect(self, pic_id, rect):
+
+        for cell in self.cell_range(*rect):
+            members = self.cells[cell]
+            members.discard(pic_id)
+            if not members:
+                del self.cells[cell]
+
+    def candidates(self, x1, x2, y1, y2):
+
+        found = set()
+        for cell in self.cell_range(x1, x2, y1, y2):
+            if cell in self.cells:
+                found.update(self.cells[cell])
+
+        return found
+
+
+class IntervalIndex(SpatialIndex):
+    """Rects kept sorted by left edge, queried as a sweep band on x.
+
+    Since no pic is wider than the widest pic, any rect that can reach the
+    query starts within that width to the left of it.
+    """
+
+    def __init__(self, pics):
+
+        pics = list(pics)
+
+        self.starts = []
+        self.max_width = max([pic.w for pic in pics]) if pics else 0
+
+        super(IntervalIndex, self).__init__(pics)
+
+    def insert_rect(self, pic_id, rect):
+
+        insort(self.starts, (rect[0], pic_id))
+
+    def remove_rect(self, pic_id, rect):
+
+        del self.starts[bisect_left(self.starts, (rect[0], pic_id))]
+
+    def candidates(self, x1, x2, y1, y2):
+
+        lo = bisect_left(self.starts, (x1 - self.max_width,))
+        hi = bisect_right(self.starts, (x2, float('inf')))
+
+        found = []
+        for x1_start, pic_id in self.starts[lo:hi]:
+            rect = self.rects[pic_id]
+            if rect[1] >= x1 and rect[2] <= y2 and rect[3] >= y1:
+                found.append(pic_id)
+
+        return found
+
+
+SPATIAL_INDEXES = {
+    'scan': SpatialIndex,
+    'grid': GridIndex,
+    'interval': IntervalIndex,
+}
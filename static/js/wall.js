@@ -9,11 +9,25 @@ var wallIds = $('.wall-display').map( function(){
 }
 );
 
-// For each wall_id that we found, make an ajax request to get the information 
-// need for plotting it up. The success handler for these AJAX requests then 
-// calls the functions for displaying it.
-for(var i=0; i < wallIds.length; i++){
-    getWall(wallIds[i]);
+// Most walls the server will return from one request
+var wallsBatchSize = 100;
+
+// For all the wall_ids that we found, make one ajax request to get the
+// information needed for plotting them up (more for very many walls). The
+// success handler then calls the functions for displaying each.
+for(var i=0; i < wallIds.length; i += wallsBatchSize){
+    getWalls($.makeArray(wallIds).slice(i, i + wallsBatchSize));
+}
+
+// Galleries whose display walls are still being made in the background show
+// a placeholder, so ask for them again, waiting longer each time, and hang
+// each as it is ready. After the last attempt those left say so instead.
+var pendingDelay = 1000;
+var pendingDelayMax = 16000;
+var pendingAttempts = 8;
+
+if ($('.wall-pending').length > 0){
+    setTimeout(function(){ getDisplayWalls(pendingDelay, 1); }, pendingDelay);
 }
 
 
@@ -25,6 +39,10 @@ var canvasArrange = $('.canvas-arrange');
 
 var galleryId = $('.arrange-display').data('galleryid');
 
+// Number of candidate arrangements the server makes for each request, only
+// the best of them comes back
+var arrangeCandidates = 4;
+
 // save state of which walls have been generated most recently for each method
 var recentCall = null;
 var recentSaves = [];
@@ -33,8 +51,10 @@ var algorithmTypes = $('.arrange-select').map( function(){
 }
 );
 var recentWalls = {};
+var recentArrangedBy = {};
 for (i=0; i < algorithmTypes.length; i++){
     recentWalls[algorithmTypes[i]] = null;
+    recentArrangedBy[algorithmTypes[i]] = null;
 }
 
 // Listen for click on one of the arrangment icons
@@ -67,6 +87,7 @@ function handleArrangeAlgorithmSelect(arrangeAlgorithm){
 
     } else {
         // There is one, just re-display it.
+        showArrangedBy(arrangeAlgorithm, recentArrangedBy[arrangeAlgorithm]);
         handleArrangeWall(wallId);
     }
 }
@@ -74,7 +95,8 @@ function handleArrangeAlgorithmSelect(arrangeAlgorithm){
 function requestArrange(arrangeAlgorithm){
 
     var postData = {'gallery_id': galleryId,
-                    'algorithm_type': arrangeAlgorithm};
+                    'algorithm_type': arrangeAlgorithm,
+                    'candidates': arrangeCandidates};
 
     recentCall = arrangeAlgorithm;
 
@@ -95,9 +117,31 @@ function handleArrangeNewWall(results){
     // Set the trigger for type of arrangment to remember this most recent wall
     recentWalls[recentCall] = newWallId;
 
+    // The server may have used a faster arrangement for a large gallery
+    recentArrangedBy[recentCall] = arrangeResults.algorithm_type;
+    showArrangedBy(recentCall, arrangeResults.algorithm_type);
+
     handleArrangeWall(newWallId);
 }
 
+function showArrangedBy(arrangeAlgorithm, arrangedBy){
+    // Note under the save button when a wall was arranged another way than
+    // the one selected, naming it as on its option if it has one.
+
+    var note = $('#arranged-by');
+
+    if (!arrangedBy || arrangedBy === arrangeAlgorithm){
+        note.text('');
+        return;
+    }
+
+    var optionName = $('.arrange-select[data-algorithmtype=' + arrangedBy + ']')
+                         .siblings('h5').text();
+
+    note.text('Arranged as ' + (optionName || arrangedBy) +
+              ', which suits this gallery better.');
+}
+
 function handleArrangeWall(wallId){
 
     // Set buttons and such for the the recent call that generated this wall
@@ -114,8 +158,10 @@ function setArrangeWallDisplayed(wallId){
     // function doing all the steps to reset the arrangment area and other data and 
     // buttons to reflect the current state
 
-    // Set the display area to recieve the new wall via wall hanging functions
-    divArrange.data('wallid', wallId);
+    // Set the display area to recieve the new wall via wall hanging functions,
+    // no longer waiting for the display wall if it was still pending
+    divArrange.removeClass('wall-pending').data('wallid', wallId);
+    divArrange.children('p').remove();
     canvasArrange.attr('id', 'canvas' + wallId);
 
     //Set save button to know which wall is displayed
@@ -168,6 +214,72 @@ function getWall(wallId){
     $.get('getwall.json', {'wallid':wallId}, handleWall);
 }
 
+function getWalls(wallIds){
+    // Make one AJAX request for all the wallIds given
+    $.get('getwalls.json', {'wallids': wallIds.join(',')}, handleWalls);
+}
+
+function handleWalls(results){
+    // For walls returned from AJAX request, plot those found and give some
+    // information on the others
+    for (var wallId in results.walls){
+        hangWall(results.walls[wallId]);
+    }
+
+    for (var wallId in results.errors){
+        console.log("Wall " + wallId + ": " + results.errors[wallId]);
+    }
+}
+
+function getDisplayWalls(delay, attempt){
+    // Make one AJAX request for the display walls of all pending galleries
+    var galleryIds = $('.wall-pending').map( function(){
+        return $(this).data('galleryid');
+    }
+    );
+
+    $.get('display-walls.json', {'galleryids': $.makeArray(galleryIds).join(',')})
+        .done(function(results){ handleDisplayWalls(results, delay, attempt); })
+        .fail(function(){ handleDisplayWalls({'walls': {}}, delay, attempt); });
+}
+
+function handleDisplayWalls(results, delay, attempt){
+    // Hang the display walls that are ready, then check again later for the
+    // rest until out of attempts
+    var readyWallIds = [];
+
+    $('.wall-pending').each( function(){
+        var wallId = results.walls[$(this).data('galleryid')];
+
+        if (wallId === undefined){
+            return;
+        }
+
+        $(this).removeClass('wall-pending').addClass('wall-display')
+               .data('wallid', wallId);
+        $(this).children('p').remove();
+        $(this).children('canvas').attr('id', 'canvas' + wallId).show();
+        readyWallIds.push(wallId);
+    }
+    );
+
+    if (readyWallIds.length > 0){
+        getWalls(readyWallIds);
+    }
+
+    if ($('.wall-pending').length === 0){
+        return;
+    }
+
+    if (attempt < pendingAttempts){
+        var nextDelay = Math.min(delay * 2, pendingDelayMax);
+        setTimeout(function(){ getDisplayWalls(nextDelay, attempt + 1); }, nextDelay);
+    } else {
+        $('.wall-pending').children('p')
+            .text('This gallery could not be arranged for display, try again later.');
+    }
+}
+
 function handleWall(results){
     // For wall returned from AJAX request, see if a wall was found.
     // If so plot it, otherwise give some information
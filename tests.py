@@ -2,10 +2,26 @@ import unittest
 import server
 import utilities
 import doctest
+import json
 import os
+import pickle
+import random
+import shutil
+import tempfile
+import time
 import seed_database as seed
 import arrange as ar
-from model import Picture, User, connect_to_db
+import benchmark
+import spatial
+import timing
+from arrange_pool import ArrangementPool
+from arrange_cache import ArrangementCache
+from arrange_buffer import LayoutBuffer
+from display_worker import DisplayWallWorker
+from flask import Flask, jsonify
+from sqlalchemy.exc import IntegrityError
+import model
+from model import Gallery, Picture, User, Wall, connect_to_db
 
 # 
 connect_to_db(server.app)
@@ -15,6 +31,7 @@ def load_tests(loader, tests, ignore):
     """Also run our doctests and file-based doctests."""
 
     tests.addTests(doctest.DocTestSuite(server))
+    tests.addTests(doctest.DocTestSuite(ar))
     # tests.addTests(doctest.DocFileSuite("tests.txt"))
     return tests
 
@@ -205,6 +222,874 @@ class WorkspaceInitTestCase(unittest.TestCase):
         self.assertEqual(len(wkspc.pics), 3)
 
 
+class WallPersistenceTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        server.app.config['TESTING'] = True
+
+        seed.clean_db()
+
+        seed_files = {
+            'users': "seed/seed_test_users.txt",
+            'pictures': "seed/seed_test_pictures.txt",
+            'galleries': "seed/seed_test_galleries.txt",
+            'memberships': "seed/seed_test_memberships.txt",
+            'walls': "seed/seed_test_walls.txt",
+            'placements': "seed/seed_test_placements.txt",
+        }
+
+        seed.seed_all(seed_files)
+
+    def test_store_placements(self):
+
+        layout = ar.arrange_records('grid', ar.get_gallery_records(11), 11, seed=4)
+
+        # Small batches, so more than one insert is made
+        rows = model.PLACEMENT_INSERT_ROWS
+        model.PLACEMENT_INSERT_ROWS = 2
+        try:
+            wall_id = Wall.init_from_layout(layout)
+        finally:
+            model.PLACEMENT_INSERT_ROWS = rows
+
+        wall = Wall.query.get(wall_id)
+        self.assertEqual(wall.seed, 4)
+        self.assertEqual(dict((p.picture_id, (p.x_coord, p.y_coord))
+                              for p in wall.placements),
+                         layout.placements)
+
+    def test_save(self):
+
+        layout = ar.arrange_records('column', ar.get_gallery_records(11), 11, seed=4)
+        wall = Wall.query.get(Wall.init_from_layout(layout))
+
+        self.assertFalse(wall.saved)
+        wall.save()
+        self.assertTrue(Wall.query.get(wall.wall_id).saved)
+
+        # Placements are stored with the wall, and kept when saved
+        self.assertEqual(sorted(p.picture_id for p in wall.placements),
+                         [41, 42, 49])
+
+    def test_load_hanging_info(self):
+
+        layout = ar.arrange_records('grid', ar.get_gallery_records(11), 11, seed=4)
+        wall = Wall.query.get(Wall.init_from_layout(layout))
+
+        info = Wall.load_hanging_info(wall.wall_id)
+
+        self.assertEqual(info['id'], wall.wall_id)
+        self.assertEqual((info['width'], info['height']),
+                         (layout.width, layout.height))
+        self.assertFalse(info['is_gallery'])
+
+        for placement in wall.placements:
+            self.assertEqual(info['pictures_to_hang'][placement.picture_id], {
+                'x': placement.x_coord,
+                'y': placement.y_coord,
+                'width': placement.picture.width,
+                'height': placement.picture.height,
+                'image': placement.picture.image_file,
+                })
+
+        self.assertIsNone(Wall.load_hanging_info(-1))
+
+    def test_display_wall_ids(self):
+
+        galleries = Gallery.query.all()
+        arranged = []
+
+        def arrange_many(algorithm_type, jobs):
+            arranged.extend(gallery_id for records, gallery_id in jobs)
+            return [ar.arrange_records(algorithm_type, records, gallery_id)
+                    for records, gallery_id in jobs]
+
+        display_walls = Gallery.display_wall_ids(galleries, arrange_many)
+
+        self.assertEqual(sorted(display_walls),
+                         sorted(gallery.gallery_id for gallery in galleries))
+
+        for gallery_id, wall_id in display_walls.items():
+            wall = Wall.query.get(wall_id)
+            self.assertEqual(wall.gallery_id, gallery_id)
+            self.assertTrue(wall.gallery_display)
+            if gallery_id in arranged:
+                self.assertEqual(len(wall.placements),
+                                 len(wall.gallery.pictures))
+
+        # Found, not arranged, the next time
+        del arranged[:]
+        self.assertEqual(Gallery.display_wall_ids(galleries, arrange_many),
+                         display_walls)
+        self.assertEqual(arranged, [])
+
+    def test_display_wall_ids_serial(self):
+
+        galleries = Gallery.query.all()
+
+        display_walls = Gallery.display_wall_ids(galleries)
+
+        # One display wall each, with the gallery's pictures placed
+        for gallery in galleries:
+            walls = Wall.query.filter_by(gallery_id=gallery.gallery_id,
+                                         gallery_display=True).all()
+            self.assertEqual([wall.wall_id for wall in walls],
+                             [display_walls[gallery.gallery_id]])
+            self.assertEqual(sorted(p.picture_id for p in walls[0].placements),
+                             sorted(p.picture_id for p in gallery.pictures))
+
+    def test_make_display_walls(self):
+
+        gallery_ids = [gallery.gallery_id for gallery in Gallery.query.all()]
+        found = Gallery.find_display_wall_ids(gallery_ids)
+
+        made = Gallery.make_display_walls(gallery_ids)
+
+        # Only those without one are made, and then found
+        self.assertEqual(sorted(made),
+                         sorted(set(gallery_ids) - set(found)))
+        found.update(made)
+        self.assertEqual(Gallery.find_display_wall_ids(gallery_ids), found)
+        self.assertEqual(Gallery.make_display_walls(gallery_ids), {})
+
+        # Nor can another process store a second one
+        layout = ar.Layout(gallery_ids[0], 0, 0, {}, None, None, None)
+        self.assertRaises(IntegrityError, Wall.insert_display_walls, [layout])
+        model.db.session.rollback()
+
+    def test_galleries_page_pending(self):
+
+        client = server.app.test_client()
+        requested = []
+
+        # Seeded galleries have no display walls yet
+        server.display_wall_worker.request = requested.extend
+        try:
+            result = client.get('/galleries')
+        finally:
+            del server.display_wall_worker.request
+
+        # Shown as pending and asked for in background, not arranged
+        self.assertIn('wall-pending', result.data)
+        self.assertNotIn('wall-display', result.data)
+        self.assertEqual(Wall.query.filter_by(gallery_display=True).count(), 0)
+        self.assertEqual(sorted(requested),
+                         sorted(gallery.gallery_id for gallery
+                                in User.query.get(server.DEFAULT_USER_ID).galleries))
+
+    def test_display_walls_json(self):
+
+        client = server.app.test_client()
+        gallery_ids = sorted(gallery.gallery_id for gallery in Gallery.query.all())
+        made = Gallery.make_display_walls(gallery_ids[:1])
+        requested = []
+
+        server.display_wall_worker.request = requested.extend
+        try:
+            result = client.get('/display-walls.json?galleryids=%s,x' %
+                                ','.join(str(gallery_id) for gallery_id in gallery_ids))
+        finally:
+            del server.display_wall_worker.request
+
+        # Ready ones by gallery id, the rest asked for in background
+        data = json.loads(result.data)
+        self.assertEqual(data['walls'], {str(gallery_ids[0]): made[gallery_ids[0]]})
+        self.assertEqual(data['pending'], gallery_ids[1:])
+        self.assertEqual(requested, gallery_ids[1:])
+
+    def test_arrange_page_pending(self):
+
+        client = server.app.test_client()
+        gallery = User.query.get(server.DEFAULT_USER_ID).galleries[0]
+        requested = []
+
+        server.display_wall_worker.request = requested.extend
+        server.layout_buffer.warm = lambda key, produce: None
+        try:
+            result = client.get('/arrange?gallery_id=%d' % gallery.gallery_id)
+        finally:
+            del server.display_wall_worker.request
+            del server.layout_buffer.warm
+
+        # Asked for in background, not arranged while rendering
+        self.assertIn('wall-pending', result.data)
+        self.assertEqual(requested, [gallery.gallery_id])
+        self.assertEqual(Wall.query.filter_by(gallery_display=True).count(), 0)
+
+    def test_edit_pictures(self):
+
+        layout = ar.arrange_records('grid', ar.get_gallery_records(11), 11, seed=4)
+        wall = Wall.query.get(Wall.init_from_layout(layout))
+
+        wall.edit_pictures(remove=wall.placements[0].picture)
+        model.db.session.commit()
+
+        # No longer the arrangement of its seed
+        wall = Wall.query.get(wall.wall_id)
+        self.assertEqual(len(wall.placements), len(layout.placements) - 1)
+        self.assertIsNone(wall.algorithm_type)
+        self.assertIsNone(wall.algorithm_version)
+        self.assertIsNone(wall.seed)
+
+    def test_getwalls(self):
+
+        layout = ar.arrange_records('grid', ar.get_gallery_records(11), 11, seed=4)
+        saved = Wall.init_from_layout(layout)
+        Wall.query.get(saved).save()
+        unsaved = Wall.init_from_layout(layout)
+
+        client = server.app.test_client()
+        result = client.get('/getwalls.json?wallids={},{},-1,x'.format(saved,
+                                                                      unsaved))
+        walls = json.loads(result.data)
+
+        # Each wall as from getwall.json, errors only for those not found
+        self.assertEqual(walls['walls'][str(saved)],
+                         json.loads(json.dumps(Wall.load_hanging_info(saved))))
+        self.assertEqual(walls['walls'][str(unsaved)]['pictures_to_hang'],
+                         walls['walls'][str(saved)]['pictures_to_hang'])
+        self.assertEqual(sorted(walls['errors']), ['-1', 'x'])
+
+
+class WorkspaceFromRecordsTestCase(unittest.TestCase):
+
+    def test_init(self):
+
+        records = [(41, 4, 4), (42, 6, 6), (49, 10, 8)]
+        wkspc = ar.Workspace.from_records(records, options={'margin': 1})
+
+        self.assertIsNone(wkspc.gallery_id)
+        self.assertEqual(wkspc.len, 3)
+        self.assertEqual(wkspc.margin, 1)
+        self.assertEqual(wkspc.pics[49].w, 11)
+        self.assertEqual(wkspc.records, [ar.PictureRecord(*r) for r in records])
+
+    def test_layout(self):
+
+        records = [(41, 4, 4), (42, 6, 6), (49, 10, 8)]
+
+        for arranger in [ar.LinearArranger, ar.ColumnArranger, ar.GridArranger]:
+
+            wkspc = ar.Workspace.from_records(records, gallery_id=11)
+            arranger(wkspc).arrange()
+
+            # Detached result survives a trip to another process
+            layout = pickle.loads(pickle.dumps(wkspc.get_layout(), 2))
+
+            self.assertEqual(layout.gallery_id, 11)
+            self.assertEqual(layout.width, wkspc.width)
+            self.assertEqual(sorted(layout.placements), [41, 42, 49])
+            self.assertEqual(layout.placements[42],
+                             (wkspc.pics[42].x1, wkspc.pics[42].y1))
+
+    def test_seed_reproduces(self):
+
+        records = [(p, 4 + p % 5, 3 + p % 7) for p in range(1, 25)]
+
+        for algorithm_type in ['linear', 'column', 'grid']:
+
+            layout = ar.arrange_records(algorithm_type, records, 11, seed=7)
+
+            self.assertEqual(layout.algorithm_type, algorithm_type)
+            self.assertEqual(layout.algorithm_version,
+                             ar.get_arranger(algorithm_type).version)
+            self.assertEqual(layout.seed, 7)
+
+            # Same seed arranges the same, records in any order
+            again = ar.arrange_records(algorithm_type, records[::-1], 11, seed=7)
+            self.assertEqual(again, layout)
+
+            # A seed is drawn and recorded when none is given
+            drawn = ar.arrange_records(algorithm_type, records, 11)
+            self.assertIsNotNone(drawn.seed)
+            self.assertEqual(ar.arrange_records(algorithm_type, records, 11,
+                                                seed=drawn.seed), drawn)
+
+
+class ArrangementPoolTestCase(unittest.TestCase):
+
+    records = [(41, 4, 4), (42, 6, 6), (49, 10, 8)]
+
+    def test_arrange(self):
+
+        pool = ArrangementPool(workers=1, timeout=10.0)
+        layout = pool.arrange('column', self.records, 11)
+        pool.shutdown()
+
+        self.assertEqual(layout.gallery_id, 11)
+        self.assertEqual(sorted(layout.placements), [41, 42, 49])
+
+        stats = pool.stats()
+        self.assertEqual(stats['submitted'], 1)
+        self.assertEqual(stats['completed'], 1)
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['timeouts'], 0)
+
+    def test_fallback(self):
+
+        # No time at all, so the fallback arrangement is always used
+        pool = ArrangementPool(workers=1, timeout=0, fallback='linear')
+        layout = pool.arrange('grid', self.records, 11)
+        pool.shutdown()
+
+        # Linear arrangement is a single row, including margins of 2
+        self.assertEqual(layout.width, 6 + 8 + 12)
+        self.assertEqual(pool.stats()['timeouts'], 1)
+        self.assertEqual(pool.stats()['fallbacks'], 1)
+
+    def test_arrange_best(self):
+
+        pool = ArrangementPool(workers=2, timeout=10.0)
+        layout = pool.arrange_best('grid', self.records, 4, 11)
+        pool.shutdown()
+
+        self.assertEqual(sorted(layout.placements), [41, 42, 49])
+        self.assertEqual(pool.stats()['completed'], 4)
+
+    def test_arrange_many(self):
+
+        pool = ArrangementPool(workers=2, timeout=10.0)
+        layouts = pool.arrange_many('gallery', [(self.records, 11),
+                                                (self.records[:2], 12)])
+        pool.shutdown()
+
+        self.assertEqual([layout.gallery_id for layout in layouts], [11, 12])
+        self.assertEqual(sorted(layouts[1].placements), [41, 42])
+        self.assertEqual(pool.stats()['completed'], 2)
+
+    def test_arrange_many_no_fallback(self):
+
+        pool = ArrangementPool(workers=1, timeout=0)
+        layouts = pool.arrange_many('gallery', [(self.records, 11)],
+                                    fallback=False)
+        pool.shutdown()
+
+        # Out of time, and not arranged some other way instead
+        self.assertEqual(layouts, [None])
+        self.assertEqual(pool.stats()['fallbacks'], 0)
+
+    def test_job_deadline(self):
+
+        submitted = []
+
+        class RecordingPool(ArrangementPool):
+            def submit(self, job, *args):
+                submitted.append(args)
+                return ArrangementPool.submit(self, job, *args)
+
+        pool = RecordingPool(workers=1, timeout=10.0, grace=0.25)
+        start = time.time()
+
+        # Always by the timeout, so a worker is not kept arranging for nothing
+        pool.arrange('grid', self.records, 11)
+        deadline, refine = submitted[-1][-2:]
+        self.assertLessEqual(deadline, start + 10.0)
+        self.assertFalse(refine)
+
+        # Or by the request's deadline, with time left used to refine
+        pool.arrange('grid', self.records, 11, deadline=start + 2)
+        deadline, refine = submitted[-1][-2:]
+        self.assertEqual(deadline, start + 2)
+        self.assertTrue(refine)
+
+        pool.arrange_many('gallery', [(self.records, 11)])
+        self.assertIsNotNone(submitted[-1][-2])
+        pool.shutdown()
+
+    def test_errors(self):
+
+        class BrokenPool(ArrangementPool):
+            # Workers are given a picture they cannot arrange
+            def submit(self, job, algorithm_type, records, *args):
+                return ArrangementPool.submit(self, job, algorithm_type,
+                                              [(41, None, 4)], *args)
+
+        pool = BrokenPool(workers=2, timeout=10.0, fallback='linear')
+
+        # Each falls back to arranging here, instead of raising
+        layout = pool.arrange('grid', self.records, 11)
+        self.assertEqual(sorted(layout.placements), [41, 42, 49])
+
+        layout = pool.arrange_best('grid', self.records, 3, 11)
+        self.assertEqual(sorted(layout.placements), [41, 42, 49])
+
+        layouts = pool.arrange_many('gallery', [(self.records, 11)])
+        self.assertEqual(sorted(layouts[0].placements), [41, 42, 49])
+        pool.shutdown()
+
+        stats = pool.stats()
+        self.assertEqual(stats['errors'], 5)
+        self.assertEqual(stats['fallbacks'], 3)
+
+
+class ArrangementCacheTestCase(unittest.TestCase):
+
+    records = [(p, 4 + p % 5, 3 + p % 7) for p in range(1, 13)]
+
+    # Same dimensions, other ids in another order
+    other_records = [(100 - p, w, h) for p, w, h in records]
+
+    def test_remap(self):
+
+        cache = ArrangementCache()
+        layout = ar.arrange_records('grid', self.records, 11, seed=3)
+        cache.put(layout, self.records, score=0.5)
+
+        score, cached = cache.get('grid', self.other_records, 12, seed=3)
+
+        # Same as arranging the other pictures with that seed
+        self.assertEqual(score, 0.5)
+        self.assertEqual(cached, ar.arrange_records('grid', self.other_records,
+                                                    12, seed=3))
+
+        # Other margin, algorithm or seed is a miss
+        self.assertIsNone(cache.get('grid', self.records, options={'margin': 1},
+                                    seed=3))
+        self.assertIsNone(cache.get('linear', self.records, seed=3))
+        self.assertIsNone(cache.get('grid', self.records, seed=4))
+
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 3))
+
+    def test_evict(self):
+
+        cache = ArrangementCache(max_entries=2)
+        for arrange_seed in range(3):
+            cache.put(ar.arrange_records('linear', self.records,
+                                         seed=arrange_seed),
+                      self.records)
+
+        # Least recently used is gone
+        self.assertIsNone(cache.get('linear', self.records, seed=0))
+        self.assertIsNotNone(cache.get('linear', self.records, seed=2))
+        self.assertEqual(cache.stats()['evictions'], 1)
+        self.assertEqual(cache.stats()['entries'], 2)
+
+        # Too old
+        cache.max_age = -1
+        self.assertIsNone(cache.get('linear', self.records, seed=2))
+        self.assertEqual(cache.stats()['expirations'], 1)
+
+    def test_disk(self):
+
+        directory = tempfile.mkdtemp()
+
+        try:
+            layout = ar.arrange_records('column', self.records, seed=5)
+            ArrangementCache(directory=directory).put(layout, self.records)
+
+            # Another process sharing the directory
+            cache = ArrangementCache(directory=directory)
+            score, cached = cache.get('column', self.records, seed=5)
+
+            self.assertEqual(cached, layout)
+            self.assertEqual(cache.stats()['disk_hits'], 1)
+
+        finally:
+            shutil.rmtree(directory)
+
+    def test_pool(self):
+
+        pool = ArrangementPool(workers=1, timeout=10.0, cache=ArrangementCache())
+        first = pool.arrange_best('column', self.records, 2, 11, seeds=[1, 2])
+        again = pool.arrange_best('column', self.records, 2, 11, seeds=[2, 1])
+        pool.shutdown()
+
+        self.assertEqual(first, again)
+        self.assertEqual(pool.stats()['submitted'], 2)
+        self.assertEqual(pool.stats()['cache']['hits'], 2)
+
+
+class LayoutBufferTestCase(unittest.TestCase):
+
+    records = [(41, 4, 4), (42, 6, 6), (49, 10, 8)]
+
+    def produce(self):
+        return ar.arrange_records('column', self.records, 11)
+
+    def test_pop(self):
+
+        buf = LayoutBuffer(depth=2, refill_workers=1)
+        key = (11, 'column', 1)
+
+        # Nothing ready at first, but filled in the background
+        self.assertIsNone(buf.pop(key, self.produce))
+        buf.shutdown()
+        self.assertEqual(buf.stats()['ready'], 2)
+
+        layout = buf.pop(key, self.produce)
+        buf.shutdown()
+        self.assertEqual(sorted(layout.placements), [41, 42, 49])
+
+        stats = buf.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+        self.assertEqual(stats['refills'], 3)
+        self.assertEqual(stats['ready'], 2)
+
+    def test_warm_and_evict(self):
+
+        buf = LayoutBuffer(depth=1, refill_workers=1)
+        buf.warm((11, 'column', 1), self.produce)
+        buf.warm((11, 'grid', 1), lambda: None)
+        buf.shutdown()
+
+        self.assertEqual(buf.stats()['ready'], 1)
+        self.assertEqual(buf.stats()['discarded'], 1)
+
+        # Not used for longer than the idle time
+        buf.last_used[(11, 'column', 1)] = 0
+        buf.evict_idle()
+
+        self.assertEqual(buf.stats()['buffers'], 1)
+        self.assertEqual(buf.stats()['evictions'], 1)
+
+    def test_discard(self):
+
+        buf = LayoutBuffer(depth=1, refill_workers=1)
+        buf.warm((11, 'column', 1), self.produce)
+        buf.warm((12, 'column', 1), self.produce)
+        buf.shutdown()
+
+        # Pictures of gallery 11 changed
+        buf.discard(lambda key: key[0] == 11)
+        self.assertEqual(buf.stats()['ready'], 1)
+        self.assertEqual(buf.stats()['cleared'], 1)
+        self.assertIsNone(buf.pop((11, 'column', 1), self.produce))
+
+        # Refills started before are not kept
+        buf.discard(lambda key: key[0] == 11)
+        buf.shutdown()
+        self.assertEqual(buf.stats()['ready'], 1)
+        self.assertEqual(buf.stats()['refilling'], 0)
+
+
+class DisplayWallWorkerTestCase(unittest.TestCase):
+
+    def test_request(self):
+
+        made = []
+
+        def make_walls(gallery_ids):
+            made.append(gallery_ids)
+            # Gallery 12 not arranged in time, so no wall made
+            return {11: 101}
+
+        worker = DisplayWallWorker(make_walls)
+
+        self.assertEqual(worker.request([11, 12]), [11, 12])
+        worker.shutdown()
+        self.assertEqual(made, [[11, 12]])
+
+        stats = worker.stats()
+        self.assertEqual((stats['made'], stats['pending']), (1, 0))
+        self.assertNotIn(11, worker.requested)
+
+    def test_pending(self):
+
+        worker = DisplayWallWorker(lambda ids: time.sleep(0.1) or {},
+                                   pending_timeout=5)
+
+        # Not asked for again while pending
+        self.assertEqual(worker.request([11]), [11])
+        self.assertEqual(worker.request([11, 12]), [12])
+
+        # Unless pending for longer than the timeout
+        worker.requested[11] -= 10
+        self.assertEqual(worker.request([11]), [11])
+        worker.shutdown()
+
+        stats = worker.stats()
+        self.assertEqual((stats['requests'], stats['expired']), (3, 1))
+        self.assertEqual(stats['pending'], 0)
+
+    def test_errors(self):
+
+        def fail(gallery_ids):
+            raise ValueError('no such gallery')
+
+        worker = DisplayWallWorker(fail)
+        worker.request([11])
+        worker.shutdown()
+
+        # Counted, and no longer pending so asked for again next time
+        self.assertEqual(worker.stats()['errors'], 1)
+        self.assertEqual(worker.request([11]), [11])
+        worker.shutdown()
+
+
+class TraceTestCase(unittest.TestCase):
+
+    records = [(p, 4 + p % 5, 3 + p % 7) for p in range(1, 25)]
+
+    def test_conflict_checks(self):
+
+        wkspc = ar.Workspace.from_records(self.records[:3],
+                                          options={'trace': True})
+        arngr = ar.Arranger(wkspc)
+
+        for pic, x in zip(wkspc.pics.values()[:2], [0, 20]):
+            pic.x1, pic.y1 = x, 0
+            pic.x2, pic.y2 = x + pic.w, pic.h
+
+        # Only the other placed picture is checked, as for any_conflict
+        this_pic = wkspc.pics.values()[0]
+        arngr.blocking_pics(0, 40, 0, 10, this_pic)
+        self.assertEqual(wkspc.trace.counts['is_conflict'], 1)
+
+        arngr.any_conflict(0, 40, 0, 10, this_pic)
+        self.assertEqual(wkspc.trace.counts['is_conflict'], 2)
+
+    def test_trace(self):
+
+        wkspc = ar.Workspace.from_records(self.records, options={'trace': True})
+        arngr = ar.GridArranger(wkspc, 3)
+        arngr.arrange()
+
+        trace = wkspc.trace
+        self.assertGreater(trace.counts['blocking_pics'], 0)
+        self.assertGreater(trace.counts['is_conflict'], 0)
+        self.assertEqual(trace.counts['pull_in_sweeps'], arngr.pull_in_sweeps)
+
+        # Every picture walks, and the total is their sum
+        self.assertEqual(sorted(trace.walk_steps), range(1, 25))
+        self.assertEqual(trace.counts['walk_steps'], sum(trace.walk_steps.values()))
+
+        for phase in ['arrange', 'place_in_grid', 'expand_grid', 'pull_in',
+                      'realign_to_origin', 'get_wall_size', 'remove_margins']:
+            self.assertIn(phase, trace.phases)
+
+        self.assertEqual(trace.summary()['most_walk_steps'],
+                         max(trace.walk_steps.values()))
+
+        # Tracing does not change the arrangement
+        untraced = ar.Workspace.from_records(self.records)
+        ar.GridArranger(untraced, 3).arrange()
+
+        self.assertIsNone(untraced.trace)
+        self.assertEqual(untraced.get_layout(), wkspc.get_layout())
+
+    def test_walk_steps(self):
+
+        # Jumping takes the same steps as walking one at a time
+        traces = []
+        for walk in ['step', 'jump']:
+            wkspc = ar.Workspace.from_records(self.records, options={'trace': True})
+            arngr = ar.GridArranger(wkspc, 5, walk=walk, pull_in='step')
+            arngr.arrange()
+            traces.append(wkspc.trace)
+
+        self.assertEqual(traces[0].walk_steps, traces[1].walk_steps)
+        self.assertGreater(traces[0].counts['any_conflict'], 0)
+        self.assertGreater(traces[0].counts['pull_in_moves'], 0)
+
+
+class WallEditorTestCase(unittest.TestCase):
+
+    records = [(p, 4 + p % 5, 3 + p % 7) for p in range(1, 31)]
+
+    def edit(self, records, layout):
+
+        wkspc = ar.Workspace.from_layout(records, layout)
+        return wkspc, ar.WallEditor(wkspc)
+
+    def assertNoConflicts(self, wkspc, editor):
+
+        for pic in wkspc.pics.values():
+            self.assertFalse(editor.any_conflict(pic.x1, pic.x2, pic.y1, pic.y2, pic))
+
+    def test_unedited(self):
+
+        layout = ar.arrange_records('grid', self.records, 11, seed=2)
+        wkspc, editor = self.edit(self.records, layout)
+        editor.finish()
+
+        edited = wkspc.get_layout()
+        self.assertEqual((edited.width, edited.height), (layout.width, layout.height))
+        for pic_id, (x, y) in layout.placements.items():
+            self.assertAlmostEqual(edited.placements[pic_id][0], x)
+            self.assertAlmostEqual(edited.placements[pic_id][1], y)
+
+    def test_add(self):
+
+        layout = ar.arrange_records('grid', self.records[:-1], 11, seed=2)
+        wkspc, editor = self.edit(self.records, layout)
+        editor.add(30)
+        editor.finish()
+
+        edited = wkspc.get_layout()
+        self.assertIn(30, edited.placements)
+        self.assertIsNone(edited.seed)
+        self.assertNoConflicts(wkspc, editor)
+
+        # Pictures already on the wall stay where they were
+        for pic_id, (x, y) in layout.placements.items():
+            self.assertAlmostEqual(edited.placements[pic_id][0], x)
+            self.assertAlmostEqual(edited.placements[pic_id][1], y)
+
+    def test_remove(self):
+
+        layout = ar.arrange_records('grid', self.records, 11, seed=2)
+        wkspc, editor = self.edit(self.records, layout)
+        moved = editor.remove(7)
+        editor.finish()
+
+        edited = wkspc.get_layout()
+        self.assertNotIn(7, edited.placements)
+        self.assertEqual(len(edited.placements), 29)
+        self.assertNoConflicts(wkspc, editor)
+
+        # Only pictures reported moved may have new placements
+        changed = set(pic_id for pic_id, xy in edited.placements.items()
+                      if xy != layout.placements[pic_id])
+        self.assertLessEqual(changed, moved)
+
+    def test_add_keeps_placements(self):
+
+        # Even for walls with no room inside, such as bottom aligned rows
+        for algorithm_type in ['grid', 'gallery', 'column', 'skyline']:
+            for arrange_seed in range(5):
+                layout = ar.arrange_records(algorithm_type, self.records[:-1],
+                                            11, seed=arrange_seed)
+                wkspc, editor = self.edit(self.records, layout)
+                editor.add(30)
+                editor.finish()
+
+                edited = wkspc.get_layout()
+                changed = [pic_id for pic_id, xy in layout.placements.items()
+                           if edited.placements[pic_id] != xy]
+                self.assertEqual(changed, [])
+                self.assertNoConflicts(wkspc, editor)
+
+    def test_remove_keeps_rows(self):
+
+        for arrange_seed in range(5):
+            layout = ar.arrange_records('gallery', self.records, 11,
+                                        seed=arrange_seed)
+            wkspc, editor = self.edit(self.records, layout)
+            moved = editor.remove(7 + arrange_seed)
+            editor.finish()
+
+            edited = wkspc.get_layout()
+            changed = [pic_id for pic_id, xy in edited.placements.items()
+                       if xy != layout.placements[pic_id]]
+
+            # A few pictures slide along their row, none up or down
+            self.assertEqual(sorted(changed), sorted(moved))
+            self.assertLessEqual(len(changed), 5)
+            for pic_id in changed:
+                self.assertAlmostEqual(edited.placements[pic_id][1],
+                                       layout.placements[pic_id][1])
+            self.assertNoConflicts(wkspc, editor)
+
+
+class TimingTestCase(unittest.TestCase):
+
+    def test_histogram(self):
+
+        histogram = timing.Histogram(bounds=[1, 10, 100])
+        for ms in [0.5, 3, 4, 5, 50, 500]:
+            histogram.add(ms)
+
+        self.assertEqual(histogram.buckets, [1, 3, 1, 1])
+        self.assertEqual(histogram.quantile(0.5), 10)
+        self.assertEqual(histogram.quantile(0.99), 500)
+        self.assertEqual(histogram.as_dict()['count'], 6)
+        self.assertEqual(histogram.as_dict()['buckets']['inf'], 1)
+
+    def test_server_timing(self):
+
+        app = Flask(__name__)
+        timings = timing.init_app(app, routes=['/timed'])
+
+        @app.route('/timed')
+        def timed():
+            with timing.span('load'):
+                pass
+            with timing.span('render'):
+                return jsonify({})
+
+        @app.route('/untimed')
+        def untimed():
+            with timing.span('load'):
+                return jsonify({})
+
+        client = app.test_client()
+
+        header = client.get('/timed').headers['Server-Timing']
+        self.assertEqual([entry.split(';')[0] for entry in header.split(', ')],
+                         ['load', 'render', 'total'])
+        self.assertNotIn('Server-Timing', client.get('/untimed').headers)
+
+        client.get('/timed')
+        stats = timings.as_dict()
+        self.assertEqual(sorted(stats), ['/timed'])
+        self.assertEqual(stats['/timed']['total']['count'], 2)
+
+        # Outside a request spans do nothing
+        with timing.span('load'):
+            pass
+
+
+class BenchmarkTestCase(unittest.TestCase):
+
+    def test_make_records(self):
+
+        sizes = benchmark.load_sizes()
+        records = benchmark.make_records(50, sizes, seed=1)
+
+        self.assertEqual([r.picture_id for r in records], range(1, 51))
+        for record in records:
+            self.assertIn((record.width, record.height), sizes)
+
+        self.assertEqual(records, benchmark.make_records(50, sizes, seed=1))
+
+    def test_run_case(self):
+
+        sizes = benchmark.load_sizes()
+        result = benchmark.run_case(('grid', 20, 0, 1, sizes, None))
+
+        self.assertEqual((result['arranger'], result['size']), ('grid', 20))
+        self.assertGreater(result['conflict_checks'], 0)
+        self.assertGreater(result['walk_steps'], 0)
+        self.assertGreater(result['peak_memory_kb'], 0)
+
+    def test_find_regressions(self):
+
+        baseline = {'results': [{'arranger': 'grid', 'size': 10, 'repeat': 0,
+                                 'wall_time': 1.0}]}
+        slower = [{'arranger': 'grid', 'size': 10, 'repeat': 0, 'wall_time': 1.5}]
+        faster = [{'arranger': 'grid', 'size': 10, 'repeat': 0, 'wall_time': 1.1}]
+
+        self.assertEqual(benchmark.find_regressions(slower, baseline),
+                         [(slower[0], 1.0)])
+        self.assertEqual(benchmark.find_regressions(faster, baseline), [])
+
+
+class WallQualityTestCase(unittest.TestCase):
+
+    def test_wall_quality(self):
+
+        # Two 4x4 pictures side by side, no margin
+        wkspc = ar.Workspace.from_records([(1, 4, 4), (2, 4, 4)],
+                                          options={'margin': 0})
+        wkspc.pics[1].x1, wkspc.pics[1].y1 = 0, 0
+        wkspc.pics[2].x1, wkspc.pics[2].y1 = 4, 0
+        wkspc.width, wkspc.height = 8, 4
+
+        # Fully filled, balanced, aspect 2 against a target of 1.5
+        self.assertAlmostEqual(ar.wall_quality(wkspc, target_aspect=1.5), 0.75)
+        self.assertAlmostEqual(ar.wall_quality(wkspc, target_aspect=2), 1.0)
+
+        # Same pictures with a gap between them, and off center
+        wkspc.pics[2].x1 = 12
+        wkspc.width = 16
+        self.assertAlmostEqual(ar.wall_quality(wkspc, target_aspect=4), 0.5)
+
+        wkspc.width = 32
+        self.assertLess(ar.wall_quality(wkspc, target_aspect=8), 0.25)
+
+
 class WorkspaceRealignTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -360,6 +1245,150 @@ class WorkspaceWallSizeTestCase(unittest.TestCase):
         self.assertEqual(wkspc.width, 17)
 
 
+class WorkspaceConflictFreeTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        server.app.config['TESTING'] = True
+        seed.clean_db()
+
+        seed_files = {
+            'users': "seed/seed_test_users.txt",
+            'pictures': "seed/seed_test_pictures.txt",
+            'galleries': "seed/seed_test_galleries.txt",
+            'memberships': "seed/seed_test_memberships.txt",
+            'walls': "seed/seed_test_walls.txt",
+            'placements': "seed/seed_test_placements.txt",
+        }
+
+        seed.seed_all(seed_files)
+
+    def test_conflict_free(self):
+
+        wkspc = ar.Workspace(11)
+        arngr = ar.Arranger(wkspc)
+
+        # Test Gallery (11), sizes with margin 41: 6x6, 42: 8x8
+        wkspc.pics[41].x1 = 0
+        wkspc.pics[41].y1 = 0
+        wkspc.pics[41].x2 = wkspc.pics[41].x1 + wkspc.pics[41].w
+        wkspc.pics[41].y2 = wkspc.pics[41].y1 + wkspc.pics[41].h
+
+        free = arngr.conflict_free(wkspc.pics[42], [-9, -8, 7, 0], [0, 0, 0, 7])
+        self.assertEqual(list(free), [True, False, True, True])
+
+        # A picture does not conflict with itself
+        free = arngr.conflict_free(wkspc.pics[41], [0], [0])
+        self.assertEqual(list(free), [True])
+
+
+class BatchConflictTestCase(unittest.TestCase):
+
+    def test_matches_is_conflict(self):
+
+        random.seed(0)
+        rects = []
+        for n in range(60):
+            x1 = random.randint(-10, 10)
+            y1 = random.randint(-10, 10)
+            rects.append((x1, x1 + random.randint(0, 8),
+                          y1, y1 + random.randint(0, 8)))
+
+        coords = zip(*rects)
+        conflicts = ar.batch_conflicts(*(coords + coords))
+
+        for i, a in enumerate(rects):
+            for j, b in enumerate(rects):
+                self.assertEqual(conflicts[i, j], ar.is_conflict(*(a + b)))
+
+
+class WorkspaceSpatialIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        server.app.config['TESTING'] = True
+        seed.clean_db()
+
+        seed_files = {
+            'users': "seed/seed_test_users.txt",
+            'pictures': "seed/seed_test_pictures.txt",
+            'galleries': "seed/seed_test_galleries.txt",
+            'memberships': "seed/seed_test_memberships.txt",
+            'walls': "seed/seed_test_walls.txt",
+            'placements': "seed/seed_test_placements.txt",
+        }
+
+        seed.seed_all(seed_files)
+
+    def place(self, wkspc):
+
+        # Test Gallery (11), sizes with margin 41: 6x6, 42: 8x8, 49: 12x10
+        wkspc.pics[41].x1 = 0
+        wkspc.pics[41].y1 = 0
+        wkspc.pics[41].x2 = wkspc.pics[41].x1 + wkspc.pics[41].w
+        wkspc.pics[41].y2 = wkspc.pics[41].y1 + wkspc.pics[41].h
+
+        wkspc.pics[42].x1 = 20
+        wkspc.pics[42].y1 = 0
+        wkspc.pics[42].x2 = wkspc.pics[42].x1 + wkspc.pics[42].w
+        wkspc.pics[42].y2 = wkspc.pics[42].y1 + wkspc.pics[42].h
+
+    def test_query(self):
+
+        for index_type in spatial.SPATIAL_INDEXES:
+
+            wkspc = ar.Workspace(11, {'index': index_type})
+            self.place(wkspc)
+
+            # Unplaced pictures are never found
+            found = wkspc.index.query(-100, 100, -100, 100)
+            self.assertEqual(set(p.id for p in found), set([41, 42]))
+
+            # Touching edges count as nearby
+            found = wkspc.index.query(6, 10, 6, 10)
+            self.assertIn(41, [p.id for p in found])
+
+            # Index follows moved pictures
+            wkspc.pics[42].x1 += -20
+            wkspc.pics[42].x2 += -20
+            wkspc.pics[42].y1 += 30
+            wkspc.pics[42].y2 += 30
+            found = wkspc.index.query(0, 8, 30, 38)
+            self.assertEqual([p.id for p in found], [42])
+
+    def test_default_index(self):
+
+        small = [(i, 10, 10) for i in range(ar.INDEX_MIN_SIZE)]
+        large = small + [(ar.INDEX_MIN_SIZE, 10, 10)]
+
+        # Small galleries are scanned, and their pics keep no index up to date
+        wkspc = ar.Workspace.from_records(small)
+        self.assertIsNone(wkspc.index)
+        self.assertTrue(all(type(pic) is ar.Pic for pic in wkspc.pics.values()))
+
+        wkspc = ar.Workspace.from_records(large)
+        self.assertIsInstance(wkspc.index, spatial.GridIndex)
+        self.assertTrue(all(isinstance(pic, ar.IndexedPic)
+                            for pic in wkspc.pics.values()))
+
+        # Unless asked for
+        wkspc = ar.Workspace.from_records(small, options={'index': 'grid'})
+        self.assertIsInstance(wkspc.index, spatial.GridIndex)
+
+    def test_any_conflict(self):
+
+        for index_type in [None] + list(spatial.SPATIAL_INDEXES):
+
+            wkspc = ar.Workspace(11, {'index': index_type})
+            arngr = ar.Arranger(wkspc)
+            self.place(wkspc)
+
+            self.assertTrue(arngr.any_conflict(6, 18, 0, 10))
+            self.assertTrue(arngr.any_conflict(8, 20, 0, 10))
+            self.assertFalse(arngr.any_conflict(7, 19, 0, 10))
+            self.assertFalse(arngr.any_conflict(0, 6, 0, 6, wkspc.pics[41]))
+
+
 class WorkspaceArrangerPopTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -512,6 +1541,419 @@ class WorkspaceArrangerPopTestCase(unittest.TestCase):
         self.assertNotIn(returned, arngr.pics_remaining)
 
 
+class GridArrangerWalkTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        server.app.config['TESTING'] = True
+        seed.clean_db()
+
+        seed_files = {
+            'users': "seed/seed_test_users.txt",
+            'pictures': "seed/seed_test_pictures.txt",
+            'galleries': "seed/seed_test_galleries.txt",
+            'memberships': "seed/seed_test_memberships.txt",
+            'walls': "seed/seed_test_walls.txt",
+            'placements': "seed/seed_test_placements.txt",
+        }
+
+        seed.seed_all(seed_files)
+
+    def walk_out(self, walk, random_seed):
+
+        wkspc = ar.Workspace(4)
+        arngr = ar.GridArranger(wkspc, random_seed, walk=walk)
+        arngr.expand_grid_to_arrangment(arngr.random_place_in_grid())
+
+        return arngr, {p: (wkspc.pics[p].x1, wkspc.pics[p].y1) for p in wkspc.pics}
+
+    def test_jump_matches_step(self):
+
+        for random_seed in range(5):
+
+            arngr, stepped = self.walk_out('step', random_seed)
+            arngr, jumped = self.walk_out('jump', random_seed)
+
+            self.assertEqual(stepped, jumped)
+
+            # Placed pictures do not conflict
+            for p, pic in arngr.ws.pics.items():
+                self.assertFalse(arngr.any_conflict(pic.x1, pic.x2,
+                                                    pic.y1, pic.y2, pic))
+
+
+class GridArrangerPullInTestCase(unittest.TestCase):
+
+    def setUp(self):
+
+        server.app.config['TESTING'] = True
+        seed.clean_db()
+
+        seed_files = {
+            'users': "seed/seed_test_users.txt",
+            'pictures': "seed/seed_test_pictures.txt",
+            'galleries': "seed/seed_test_galleries.txt",
+            'memberships': "seed/seed_test_memberships.txt",
+            'walls': "seed/seed_test_walls.txt",
+            'placements': "seed/seed_test_placements.txt",
+        }
+
+        seed.seed_all(seed_files)
+
+    def test_slide_in_picture(self):
+
+        # Test Gallery (11), sizes with margin 41: 6x6, 42: 8x8
+        wkspc = ar.Workspace(11)
+        arngr = ar.GridArranger(wkspc)
+
+        wkspc.pics[41].x1 = -3
+        wkspc.pics[41].y1 = -3
+        wkspc.pics[41].x2 = wkspc.pics[41].x1 + wkspc.pics[41].w
+        wkspc.pics[41].y2 = wkspc.pics[41].y1 + wkspc.pics[41].h
+
+        wkspc.pics[42].x1 = 20
+        wkspc.pics[42].y1 = 10
+        wkspc.pics[42].x2 = wkspc.pics[42].x1 + wkspc.pics[42].w
+        wkspc.pics[42].y2 = wkspc.pics[42].y1 + wkspc.pics[42].h
+
+        # Centered picture stays put
+        self.assertEqual(arngr.slide_in_picture(41), (0, 0))
+
+        # Free in x until its center reaches the origin, blocked in y
+        self.assertEqual(arngr.slide_in_picture(42), (24, 6))
+        self.assertEqual(wkspc.pics[42].x1, -4)
+        self.assertEqual(wkspc.pics[42].y1, 4)
+
+    def test_slide_in_pictures(self):
+
+        for random_seed in range(5):
+
+            wkspc = ar.Workspace(4)
+            arngr = ar.GridArranger(wkspc, random_seed, pull_in='slide')
+            arngr.expand_grid_to_arrangment(arngr.random_place_in_grid())
+            arngr.pull_in_pictures()
+
+            # Nothing left to move, and no conflicts made along the way
+            for p, pic in wkspc.pics.items():
+                self.assertEqual(arngr.slide_in_picture(p), (0, 0))
+                self.assertFalse(arngr.any_conflict(pic.x1, pic.x2,
+                                                    pic.y1, pic.y2, pic))
+
+            self.assertGreaterEqual(arngr.pull_in_sweeps, 1)
+            self.assertGreaterEqual(arngr.pull_in_sweeps_saved, 0)
+
+
+class GridArrangerDeadlineTestCase(unittest.TestCase):
+
+    records = [ar.PictureRecord(p, 4 + p % 5, 3 + p % 7) for p in range(1, 41)]
+
+    def arrange(self, deadline):
+
+        wkspc = ar.Workspace.from_records(self.records)
+        arngr = ar.GridArranger(wkspc, 3, deadline=deadline)
+        arngr.arrange()
+
+        # Every picture placed, without conflict
+        pics = wkspc.pics.values()
+        for pic in pics:
+            self.assertIsNotNone(pic.x1)
+            self.assertFalse(any(ar.is_conflict(pic.x1, pic.x2, pic.y1, pic.y2,
+                                                other.x1, other.x2, other.y1, other.y2)
+                                 for other in pics if other is not pic))
+
+        return wkspc, arngr
+
+    def test_deadline_passed(self):
+
+        wkspc, arngr = self.arrange(time.time() - 1)
+
+        self.assertTrue(arngr.cut_short)
+        self.assertEqual(arngr.attempts, 1)
+
+        # Depends on timing, so cannot be arranged again from the seed
+        self.assertIsNone(wkspc.get_layout().seed)
+
+    def test_refines_while_time_remains(self):
+
+        wkspc, arngr = self.arrange(time.time() + 0.3)
+
+        self.assertGreater(arngr.attempts, 1)
+
+        # The best arrangement is kept, so no worse than the seed alone gives
+        first = ar.Workspace.from_records(self.records)
+        ar.GridArranger(first, 3).arrange_once()
+
+        self.assertGreaterEqual(arngr.best_quality, ar.placed_quality(first))
+
+    def test_no_refine(self):
+
+        wkspc = ar.Workspace.from_records(self.records)
+        arngr = ar.GridArranger(wkspc, 3, deadline=time.time() + 30,
+                                refine=False)
+        arngr.arrange()
+
+        # Arranged once, the same as from the seed alone
+        self.assertEqual(arngr.attempts, 1)
+        self.assertEqual(wkspc.get_layout(),
+                         ar.arrange_records('grid', self.records, seed=3))
+
+    def test_stops_without_improvement(self):
+
+        start = time.time()
+        wkspc, arngr = self.arrange(start + 30)
+
+        # Stops once an arrangement is no better, long before the deadline
+        self.assertLess(time.time() - start, 10)
+        self.assertGreater(arngr.attempts, 1)
+
+    def test_pool_share_deadline(self):
+
+        pool = ArrangementPool(workers=2)
+        deadline = time.time() + 3
+
+        deadlines = pool.share_deadline(5, deadline)
+
+        # Three turns of a second each, the last ending at the deadline
+        self.assertEqual(deadlines[0], deadlines[1])
+        self.assertAlmostEqual(deadlines[0], deadline - 2, places=1)
+        self.assertAlmostEqual(deadlines[2], deadline - 1, places=1)
+        self.assertAlmostEqual(deadlines[4], deadline, places=1)
+
+        self.assertEqual(pool.share_deadline(2), [None, None])
+
+    def test_pool_wait_time(self):
+
+        pool = ArrangementPool(timeout=5.0, grace=0.25)
+
+        self.assertEqual(pool.wait_time(), 5.0)
+        self.assertAlmostEqual(pool.wait_time(time.time() + 1), 1.25, places=1)
+        self.assertEqual(pool.wait_time(time.time() - 1), 0.25)
+        self.assertEqual(pool.wait_time(time.time() + 60), 5.0)
+
+
+class SkylineArrangerTestCase(unittest.TestCase):
+
+    records = [ar.PictureRecord(p, 4 + p % 5, 3 + p % 7) for p in range(1, 201)]
+
+    def test_arrange(self):
+
+        wkspc = ar.Workspace.from_records(self.records)
+        ar.SkylineArranger(wkspc, 3).arrange()
+
+        # Pictures do not overlap, margins between them kept
+        pics = wkspc.pics.values()
+        margin = wkspc.margin
+        for pic in pics:
+            for other in pics:
+                if other is not pic:
+                    self.assertFalse(ar.is_conflict(
+                        pic.x1, pic.x1 + pic.picture.width + margin - 1e-9,
+                        pic.y1, pic.y1 + pic.picture.height + margin - 1e-9,
+                        other.x1, other.x1 + other.picture.width,
+                        other.y1, other.y1 + other.picture.height))
+
+        # Close to the target aspect, and mostly filled
+        aspect = wkspc.width / float(wkspc.height)
+        self.assertGreater(aspect, ar.TARGET_ASPECT / 1.5)
+        self.assertLess(aspect, ar.TARGET_ASPECT * 1.5)
+        self.assertGreater(ar.wall_quality(wkspc), 0.3)
+
+        self.assertEqual(wkspc.get_layout().algorithm_type, 'skyline')
+
+    def test_seed_reproduces(self):
+
+        layouts = [ar.arrange_records('skyline', self.records, seed=5)
+                   for i in range(2)]
+
+        self.assertEqual(layouts[0], layouts[1])
+
+    def test_raise_skyline(self):
+
+        wkspc = ar.Workspace.from_records(self.records[:1])
+        arngr = ar.SkylineArranger(wkspc, 3)
+
+        skyline = [[0, 0]]
+        arngr.raise_skyline(skyline, 0, 0, 4, 5)
+        self.assertEqual(skyline, [[0, 5], [4, 0]])
+
+        # Fits at the lowest point, beside the first
+        self.assertEqual(arngr.lowest_fit(skyline, 3, 10), (1, 4, 0))
+        arngr.raise_skyline(skyline, 1, 4, 7, 5)
+        self.assertEqual(skyline, [[0, 5], [7, 0]])
+
+        # Too wide to fit beside, so rests on the highest it spans
+        self.assertEqual(arngr.lowest_fit(skyline, 4, 10), (0, 0, 5))
+        arngr.raise_skyline(skyline, 0, 0, 4, 8)
+        self.assertEqual(skyline, [[0, 8], [4, 5], [7, 0]])
+
+
+class ArrangerChoiceTestCase(unittest.TestCase):
+
+    def test_downgrades(self):
+
+        # Every downgrade is registered, and ends with one for any size
+        for algorithm_type, arranger in ar.ARRANGERS.items():
+            self.assertEqual(arranger.algorithm_type, algorithm_type)
+
+            seen = set()
+            while arranger.downgrade is not None:
+                self.assertNotIn(arranger.algorithm_type, seen)
+                seen.add(arranger.algorithm_type)
+                arranger = ar.ARRANGERS[arranger.downgrade]
+
+            self.assertIsNone(arranger.max_size)
+
+    def test_choose_arranger(self):
+
+        self.assertEqual(ar.choose_arranger('grid', 30), 'grid')
+        self.assertEqual(ar.choose_arranger('grid', 30, budget=1.0), 'grid')
+        self.assertEqual(ar.choose_arranger('linear', 200), 'skyline')
+        self.assertEqual(ar.choose_arranger('skyline', 10 ** 6, budget=0.01),
+                         'skyline')
+
+        # Larger galleries are estimated to take longer
+        grid = ar.get_arranger('grid')
+        self.assertLess(grid.estimate_seconds(100), grid.estimate_seconds(1000))
+        self.assertTrue(grid.suits(300))
+        self.assertFalse(grid.suits(300, budget=0.1))
+
+
+class HierarchicalArrangementTestCase(unittest.TestCase):
+
+    records = [ar.PictureRecord(p, 4 + p % 5, 3 + p % 7) for p in range(1, 251)]
+
+    def assertNoOverlaps(self, layout, margin=ar.DEFAULT_MARGIN):
+
+        sizes = dict((r.picture_id, (r.width, r.height)) for r in self.records)
+        placed = [(x, y) + sizes[p] for p, (x, y) in layout.placements.items()]
+
+        for i, (x, y, w, h) in enumerate(placed):
+            self.assertGreaterEqual(x, 0)
+            self.assertGreaterEqual(y, 0)
+            self.assertLessEqual(x + w, layout.width)
+            self.assertLessEqual(y + h, layout.height)
+
+            # Margins kept between pictures, whichever cluster they are in
+            for x_o, y_o, w_o, h_o in placed[i + 1:]:
+                self.assertFalse(ar.is_conflict(x, x + w + margin - 1e-9,
+                                                y, y + h + margin - 1e-9,
+                                                x_o, x_o + w_o, y_o, y_o + h_o) or
+                                 ar.is_conflict(x_o, x_o + w_o + margin - 1e-9,
+                                                y_o, y_o + h_o + margin - 1e-9,
+                                                x, x + w, y, y + h))
+
+    def test_partition_records(self):
+
+        clusters = ar.partition_records(self.records, 100, 3)
+
+        self.assertEqual(len(clusters), 3)
+        self.assertEqual(sorted([len(cluster) for cluster, seed in clusters]),
+                         [83, 83, 84])
+        self.assertEqual(sorted([r.picture_id for cluster, seed in clusters
+                                 for r in cluster]), range(1, 251))
+
+        # Each cluster has pictures from across the range of sizes
+        for cluster, seed in clusters:
+            self.assertEqual(set([(r.width, r.height) for r in cluster]),
+                             set([(r.width, r.height) for r in self.records]))
+
+        self.assertEqual(ar.partition_records(self.records, 100, 3), clusters)
+
+    def test_arrange_hierarchical(self):
+
+        for algorithm_type in ['column', 'grid']:
+            layout = ar.arrange_hierarchical(algorithm_type, self.records, 11,
+                                             seed=5, cluster_size=100)
+
+            self.assertEqual(sorted(layout.placements), range(1, 251))
+            self.assertEqual(layout.algorithm_type, algorithm_type)
+            self.assertIsNone(layout.seed)
+            self.assertNoOverlaps(layout)
+
+    def test_cluster_counts(self):
+
+        # Few blocks leave gaps in the grid, which must still all be placed
+        for cluster_size, n_clusters in [(125, 2), (50, 5), (42, 6)]:
+            self.assertEqual(len(ar.partition_records(self.records,
+                                                      cluster_size, 0)),
+                             n_clusters)
+
+            for arrange_seed in range(10):
+                layout = ar.arrange_hierarchical('grid', self.records, 11,
+                                                 seed=arrange_seed,
+                                                 cluster_size=cluster_size)
+
+                self.assertEqual(sorted(layout.placements), range(1, 251))
+                self.assertNoOverlaps(layout)
+
+    def test_pool_compose_error(self):
+
+        class BrokenPool(ArrangementPool):
+            # Clusters come back with no size, so cannot be composed
+            def get_cached(self, algorithm_type, records, *args):
+                return 1.0, ar.Layout(None, None, None, {}, algorithm_type,
+                                      None, None)
+
+        pool = BrokenPool(workers=2, timeout=10.0, fallback='linear')
+        layout = pool.arrange_hierarchical('grid', self.records, 11, seed=5,
+                                           cluster_size=100)
+        pool.shutdown()
+
+        self.assertEqual(sorted(layout.placements), range(1, 251))
+        self.assertEqual(pool.stats()['errors'], 1)
+        self.assertEqual(pool.stats()['fallbacks'], 1)
+
+    def test_pool(self):
+
+        pool = ArrangementPool(workers=2, timeout=10.0, cache=ArrangementCache())
+        layout = pool.arrange_hierarchical('grid', self.records, 11, seed=5,
+                                           cluster_size=100)
+
+        self.assertEqual(pool.stats()['completed'], 3)
+        self.assertEqual(layout, ar.arrange_hierarchical('grid', self.records, 11,
+                                                         seed=5, cluster_size=100))
+
+        # Clusters are cached, so arranging again needs no workers
+        pool.arrange_hierarchical('grid', self.records, 11, seed=5,
+                                  cluster_size=100)
+        pool.shutdown()
+
+        self.assertEqual(pool.stats()['submitted'], 3)
+
+
+class PicSelectorTestCase(unittest.TestCase):
+
+    def test_random_bag(self):
+
+        bag = ar.RandomBag([1, 2, 3, 4])
+        bag.discard(2)
+        bag.discard(2)
+        bag.discard(4)
+
+        self.assertEqual(sorted(bag.items), [1, 3])
+        self.assertEqual(len(bag), 2)
+
+    def test_lazy_deletion(self):
+
+        remaining = set(range(10))
+        selector = ar.PicSelector(range(10), remaining)
+
+        self.assertEqual(sorted(selector.lower_third.items), [0, 1, 2])
+        self.assertEqual(sorted(selector.upper_third.items), [7, 8, 9])
+
+        for p in [0, 1, 9, 5]:
+            remaining.remove(p)
+            selector.discard(p)
+
+        self.assertEqual(selector.smallest(), 2)
+        self.assertEqual(selector.largest(), 8)
+        self.assertEqual(sorted(selector.lower_third.items), [2])
+
+        remaining.clear()
+        self.assertIsNone(selector.smallest())
+        self.assertIsNone(selector.largest())
+
+
 class PicInitTestCase(unittest.TestCase):
 
     def setUp(self):
@@ -0,0 +1,159 @@
+"""Request timing: named spans sent as Server-Timing headers and kept as histograms.
+
+Code times a stage of handling a request with span(name). Spans only record
+anything within a request of an app set up with init_app, so model and other
+code can use them freely. Times of spans with the same name in one request
+are added together, and spans may be nested, in which case the outer span
+includes the inner one.
+
+After each request the stage times, and the total, are sent in the
+Server-Timing header for browser devtools, and added to a histogram for the
+route and stage, for dashboards.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request, has_request_context
+
+# Upper bounds of histogram buckets in milliseconds, the last is unbounded
+BUCKET_BOUNDS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500,
+                    1000, 2000, 5000, 10000, 30000]
+
+
+class Histogram(object):
+    """Counts of durations in fixed buckets, with count, sum and maximum."""
+
+    def __init__(self, bounds=BUCKET_BOUNDS_MS):
+
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        """Add a duration in milliseconds."""
+
+        self.buckets[bisect.bisect_left(self.bounds, ms)] += 1
+        self.count += 1
+        self.total += ms
+        self.max = max(self.max, ms)
+
+    def quantile(self, q):
+        """Return upper bound of the bucket holding the q quantile, in ms.
+
+        The maximum is returned for the unbounded bucket, and 0 if empty.
+        """
+
+        if not self.count:
+            return 0
+
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank and n:
+                return self.bounds[i] if i < len(self.bounds) else self.max
+
+        return self.max
+
+    def as_dict(self):
+        """Return summary and bucket counts, keyed by upper bound."""
+
+        labels = ['le_{}'.format(bound) for bound in self.bounds] + ['inf']
+
+        return {
+            'count': self.count,
+            'sum_ms': self.total,
+            'max_ms': self.max,
+            'p50_ms': self.quantile(0.5),
+            'p90_ms': self.quantile(0.9),
+            'p99_ms': self.quantile(0.99),
+            'buckets': dict(zip(labels, self.buckets)),
+        }
+
+
+class RequestTimings(object):
+    """Histograms of stage times by route, shared by all requests of an app."""
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def add(self, route, stage, ms):
+
+        with self.lock:
+            key = (route, stage)
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].add(ms)
+
+    def as_dict(self):
+        """Return {route: {stage: histogram summary}}."""
+
+        stats = {}
+
+        with self.lock:
+            for (route, stage), histogram in self.histograms.items():
+                stats.setdefault(route, {})[stage] = histogram.as_dict()
+
+        return stats
+
+
+@contextmanager
+def span(name):
+    """Time the enclosed block as a stage of the current request, if timed."""
+
+    if not (has_request_context() and hasattr(g, 'timing_spans')):
+        yield
+        return
+
+    start = time.time()
+    try:
+        yield
+    finally:
+        spans = g.timing_spans
+        spans[name] = spans.get(name, 0) + (time.time() - start) * 1000
+
+
+def init_app(app, routes=None):
+    """Time requests of an app, return the RequestTimings they are added to.
+
+    Only requests to the given routes (rule strings such as '/galleries') are
+    timed, or all if none are given.
+    """
+
+    timings = RequestTimings()
+
+    def timed():
+        rule = request.url_rule
+        return rule is not None and (routes is None or rule.rule in routes)
+
+    @app.before_request
+    def start_timing():
+        if timed():
+            g.timing_start = time.time()
+            g.timing_spans = {}
+
+    @app.after_request
+    def finish_timing(response):
+        if not hasattr(g, 'timing_spans'):
+            return response
+
+        spans = g.timing_spans
+        spans['total'] = (time.time() - g.timing_start) * 1000
+
+        response.headers['Server-Timing'] = ', '.join(
+            '{};dur={:.1f}'.format(name, ms) for name, ms in sorted(spans.items()))
+
+        route = request.url_rule.rule
+        for name, ms in spans.items():
+            timings.add(route, name, ms)
+
+        return response
+
+    return timings
@@ -104,9 +104,9 @@ def attempt_upload():
 
 
 def attempt_curation():
-    """Creates gallery from POST request pictures and returns True is successful.
+    """Creates gallery from POST request pictures and returns it if successful.
 
-    Returns false otherwise."""
+    Returns None otherwise."""
 
     user_id = session.get('user_id', None)
 
@@ -119,9 +119,9 @@ def attempt_curation():
                                              picture_list=picture_ids,
                                              gallery_name=gallery_name)
         gallery.print_seed()
-        return True
+        return gallery
     else:
-        return False
+        return None
 
 def get_arrange_options_for_display():
     """Returns a list of dicts with display information for the arrange page.
@@ -151,6 +151,13 @@ def get_arrange_options_for_display():
             'image': "/static/img/cloud_icon.jpg",
             'description': "Oh look a random walk!",
         },
+
+        {
+            'algorithm_type': 'skyline',
+            'display_name': 'Packed',
+            'image': "/static/img/wall_icon.jpg",
+            'description': "Any number, tightly packed!",
+        },
     ]
 
     return arrange_options